@@ -1,14 +1,1438 @@
 #include <Python.h>
+#include <structmember.h>
 #include <numpy/arrayobject.h>
 #include "spectrum.h"
 #define NPY_NO_DEPRECATED_API NPY_1_7_API_VERSION
 
+/*************************************************************
+ * WaveGrid: wavelength lookup descriptor, built once per spectrum
+ *************************************************************/
+
+typedef struct {
+    PyObject_HEAD
+    PyArrayObject *waves;   /* owned reference, keeps grid.waves alive */
+    wave_grid grid;
+} WaveGridObject;
+
+static PyTypeObject WaveGridType;
+
+static int grid_ready(WaveGridObject *self)
+{
+    /* objects made with WaveGrid.__new__ have no waves until __init__ has run */
+    if (self->waves == NULL) {
+        PyErr_SetString(PyExc_RuntimeError, "WaveGrid is not initialized");
+        return 0;
+    }
+    return 1;
+}
+
+static void WaveGrid_dealloc(WaveGridObject *self)
+{
+    Py_XDECREF(self->waves);
+    Py_TYPE(self)->tp_free((PyObject*)self);
+}
+
+static int WaveGrid_init(WaveGridObject *self, PyObject *args, PyObject *kwds)
+{
+    static char *kwlist[] = {"waves", "crval", "cdelt", "crpix", "loglin", NULL};
+    PyObject *wave_obj;
+    PyObject *crval_obj = Py_None, *cdelt_obj = Py_None;
+    double crpix = 1.0;
+    int loglin = 0;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O|OOdp", kwlist,
+                                     &wave_obj, &crval_obj, &cdelt_obj,
+                                     &crpix, &loglin)){
+        return -1;
+    }
+    PyArrayObject *wave_arr = (PyArrayObject*)PyArray_FROM_OTF(wave_obj, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
+    if (wave_arr == NULL) {
+        return -1;
+    }
+    if (PyArray_NDIM(wave_arr) != 1) {
+        Py_DECREF(wave_arr);
+        PyErr_SetString(PyExc_ValueError, "waves must be one dimensional");
+        return -1;
+    }
+    int wcs = crval_obj != Py_None && cdelt_obj != Py_None;
+    double crval = 0., cdelt = 0.;
+    if (wcs) {
+        crval = PyFloat_AsDouble(crval_obj);
+        cdelt = PyFloat_AsDouble(cdelt_obj);
+        if (PyErr_Occurred()) {
+            Py_DECREF(wave_arr);
+            return -1;
+        }
+    }
+    /* nothing can fail from here, so the grid never points at freed waves */
+    Py_XDECREF(self->waves);
+    self->waves = wave_arr;
+
+    const double *waves = (double*)PyArray_DATA(wave_arr);
+    size_t size = (size_t)PyArray_DIM(wave_arr, 0);
+
+    if (wcs) {
+        grid_init_wcs(&self->grid, waves, size, crval, cdelt, crpix, loglin ? true : false);
+    } else {
+        grid_init(&self->grid, waves, size);
+    }
+    return 0;
+}
+
+static PyObject *WaveGrid_index(WaveGridObject *self, PyObject *arg)
+{
+    if (!grid_ready(self)) {
+        return NULL;
+    }
+    /* scalar in, int out.  array in, int array out */
+    if (PyFloat_Check(arg) || PyLong_Check(arg)) {
+        double wave = PyFloat_AsDouble(arg);
+        if (PyErr_Occurred()) {
+            return NULL;
+        }
+        return PyLong_FromLong(grid_index(&self->grid, wave));
+    }
+    PyArrayObject *wave_arr = (PyArrayObject*)PyArray_FROM_OTF(arg, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
+    if (wave_arr == NULL) {
+        return NULL;
+    }
+    PyArrayObject *out = (PyArrayObject*)PyArray_SimpleNew(PyArray_NDIM(wave_arr),
+                                                           PyArray_DIMS(wave_arr), NPY_INT);
+    if (out == NULL) {
+        Py_DECREF(wave_arr);
+        return NULL;
+    }
+    const double *waves = (double*)PyArray_DATA(wave_arr);
+    int *index = (int*)PyArray_DATA(out);
+    npy_intp i, n = PyArray_SIZE(wave_arr);
+    for (i = 0; i < n; ++i) {
+        index[i] = grid_index(&self->grid, waves[i]);
+    }
+    Py_DECREF(wave_arr);
+    return (PyObject*)out;
+}
+
+static PyObject *WaveGrid_get_kind(WaveGridObject *self, void *closure)
+{
+    if (!grid_ready(self)) {
+        return NULL;
+    }
+    switch (self->grid.kind) {
+    case GRID_LINEAR:
+        return PyUnicode_FromString("linear");
+    case GRID_LOGLIN:
+        return PyUnicode_FromString("loglin");
+    default:
+        return PyUnicode_FromString("arbitrary");
+    }
+}
+
+static PyObject *WaveGrid_get_size(WaveGridObject *self, void *closure)
+{
+    if (!grid_ready(self)) {
+        return NULL;
+    }
+    return PyLong_FromSize_t(self->grid.size);
+}
+
+static PyObject *WaveGrid_get_waves(WaveGridObject *self, void *closure)
+{
+    if (!grid_ready(self)) {
+        return NULL;
+    }
+    Py_INCREF(self->waves);
+    return (PyObject*)self->waves;
+}
+
+static PyMethodDef WaveGrid_methods[] = {
+    {"index", (PyCFunction)WaveGrid_index, METH_O,
+     "index(wave): last pixel with waves[i] <= wave (-1 if blueward of the grid)"},
+    {NULL, NULL, 0, NULL}
+};
+
+static PyGetSetDef WaveGrid_getset[] = {
+    {"kind", (getter)WaveGrid_get_kind, NULL, "'linear', 'loglin' or 'arbitrary'", NULL},
+    {"size", (getter)WaveGrid_get_size, NULL, "number of pixels", NULL},
+    {"waves", (getter)WaveGrid_get_waves, NULL, "the wavelength array", NULL},
+    {NULL}
+};
+
+static PyTypeObject WaveGridType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name = "_spectrum.WaveGrid",
+    .tp_doc = "WaveGrid(waves, crval=None, cdelt=None, crpix=1., loglin=False)\n\n"
+              "wavelength grid descriptor.  linear and log-linear grids are inverted\n"
+              "analytically, anything else is binary searched.",
+    .tp_basicsize = sizeof(WaveGridObject),
+    .tp_itemsize = 0,
+    .tp_flags = Py_TPFLAGS_DEFAULT,
+    .tp_new = PyType_GenericNew,
+    .tp_init = (initproc)WaveGrid_init,
+    .tp_dealloc = (destructor)WaveGrid_dealloc,
+    .tp_methods = WaveGrid_methods,
+    .tp_getset = WaveGrid_getset,
+};
+
+/*************************************************************
+ * SpectrumContext: spectrum arrays, fit regions and scratch buffers
+ * that persist between model evaluations
+ *************************************************************/
+
+typedef struct {
+    PyObject_HEAD
+    WaveGridObject *grid;   /* owns the waves */
+    PyArrayObject *flux;
+    PyArrayObject *err;
+    spec_context ctx;
+    PyThread_type_lock lock;    /* one evaluation at a time, held without the GIL */
+    int ready;
+} SpectrumContextObject;
+
+static PyTypeObject SpectrumContextType;
+
+static PyArrayObject *double_array(PyObject *obj, const char *name)
+{
+    /* contiguous 1-d array of doubles, new reference */
+    PyArrayObject *arr = (PyArrayObject*)PyArray_FROM_OTF(obj, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
+    if (arr == NULL) {
+        return NULL;
+    }
+    if (PyArray_NDIM(arr) != 1) {
+        PyErr_Format(PyExc_ValueError, "%s must be one dimensional", name);
+        Py_DECREF(arr);
+        return NULL;
+    }
+    return arr;
+}
+
+static PyArrayObject *int_array(PyObject *obj, const char *name)
+{
+    /* contiguous 1-d array of ints, new reference */
+    PyArrayObject *arr = (PyArrayObject*)PyArray_FROM_OTF(obj, NPY_INT, NPY_ARRAY_IN_ARRAY | NPY_ARRAY_FORCECAST);
+    if (arr == NULL) {
+        return NULL;
+    }
+    if (PyArray_NDIM(arr) != 1) {
+        PyErr_Format(PyExc_ValueError, "%s must be one dimensional", name);
+        Py_DECREF(arr);
+        return NULL;
+    }
+    return arr;
+}
+
+static void acquire_lock(PyThread_type_lock lock)
+{
+    /* wait for the lock without holding up other python threads */
+    if (!PyThread_acquire_lock(lock, NOWAIT_LOCK)) {
+        Py_BEGIN_ALLOW_THREADS
+        PyThread_acquire_lock(lock, WAIT_LOCK);
+        Py_END_ALLOW_THREADS
+    }
+}
+
+static int context_ready(SpectrumContextObject *self)
+{
+    /* objects made with SpectrumContext.__new__ have no context or lock until __init__ has run */
+    if (!self->ready) {
+        PyErr_SetString(PyExc_RuntimeError, "SpectrumContext is not initialized");
+        return 0;
+    }
+    return 1;
+}
+
+static void context_acquire(SpectrumContextObject *self)
+{
+    acquire_lock(self->lock);
+}
+
+static PyArrayObject *out_array(PyObject *obj, const char *name, npy_intp size)
+{
+    /*
+    a caller-supplied output buffer, which has to be written in place: a
+    writeable, contiguous 1-d array of size doubles.  new reference
+    */
+    if (!PyArray_Check(obj)) {
+        PyErr_Format(PyExc_TypeError, "%s must be a numpy array", name);
+        return NULL;
+    }
+    PyArrayObject *arr = (PyArrayObject*)obj;
+    if (PyArray_TYPE(arr) != NPY_DOUBLE || PyArray_NDIM(arr) != 1 ||
+        !PyArray_IS_C_CONTIGUOUS(arr) || !PyArray_ISWRITEABLE(arr)) {
+        PyErr_Format(PyExc_ValueError, "%s must be a writeable, contiguous 1-d float64 array", name);
+        return NULL;
+    }
+    if (PyArray_DIM(arr, 0) != size) {
+        PyErr_Format(PyExc_ValueError, "%s has %ld entries, expected %ld", name,
+                     (long)PyArray_DIM(arr, 0), (long)size);
+        return NULL;
+    }
+    Py_INCREF(arr);
+    return arr;
+}
+
+static PyArrayObject *output(PyObject *obj, const char *name, npy_intp size)
+{
+    /* out_array for obj, or a new array if it is None.  new reference */
+    if (obj == NULL || obj == Py_None) {
+        return (PyArrayObject*)PyArray_SimpleNew(1, &size, NPY_DOUBLE);
+    }
+    return out_array(obj, name, size);
+}
+
+static int SpectrumContext_set_pairs(SpectrumContextObject *self, PyObject *starts_obj, PyObject *ends_obj)
+{
+    PyArrayObject *starts_arr = int_array(starts_obj, "starts");
+    if (starts_arr == NULL) {
+        return -1;
+    }
+    PyArrayObject *ends_arr = int_array(ends_obj, "ends");
+    if (ends_arr == NULL) {
+        Py_DECREF(starts_arr);
+        return -1;
+    }
+    if (PyArray_DIM(starts_arr, 0) != PyArray_DIM(ends_arr, 0)) {
+        PyErr_SetString(PyExc_ValueError, "starts and ends must have the same length");
+        Py_DECREF(starts_arr);
+        Py_DECREF(ends_arr);
+        return -1;
+    }
+    context_acquire(self);
+    int status = context_set_regions(&self->ctx, (int*)PyArray_DATA(starts_arr),
+                                     (int*)PyArray_DATA(ends_arr),
+                                     (size_t)PyArray_DIM(starts_arr, 0));
+    PyThread_release_lock(self->lock);
+    Py_DECREF(starts_arr);
+    Py_DECREF(ends_arr);
+    if (status < 0) {
+        PyErr_NoMemory();
+        return -1;
+    }
+    return 0;
+}
+
+static void SpectrumContext_dealloc(SpectrumContextObject *self)
+{
+    if (self->ready) {
+        context_free(&self->ctx);
+    }
+    if (self->lock != NULL) {
+        PyThread_free_lock(self->lock);
+    }
+    Py_XDECREF(self->grid);
+    Py_XDECREF(self->flux);
+    Py_XDECREF(self->err);
+    Py_TYPE(self)->tp_free((PyObject*)self);
+}
+
+static int SpectrumContext_init(SpectrumContextObject *self, PyObject *args, PyObject *kwds)
+{
+    static char *kwlist[] = {"waves", "flux", "error", "starts", "ends", "grid", NULL};
+    PyObject *wave_obj, *flux_obj, *err_obj;
+    PyObject *starts_obj = Py_None, *ends_obj = Py_None;
+    WaveGridObject *grid_obj = NULL;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OOO|OOO!", kwlist,
+                                     &wave_obj, &flux_obj, &err_obj,
+                                     &starts_obj, &ends_obj,
+                                     &WaveGridType, &grid_obj)) {
+        return -1;
+    }
+    if (self->ready) {
+        PyErr_SetString(PyExc_RuntimeError, "SpectrumContext is already initialized");
+        return -1;
+    }
+    if (grid_obj != NULL && !grid_ready(grid_obj)) {
+        return -1;
+    }
+
+    /* whatever a failed earlier __init__ left behind */
+    Py_CLEAR(self->grid);
+    Py_CLEAR(self->flux);
+    Py_CLEAR(self->err);
+
+    if (grid_obj != NULL) {
+        Py_INCREF(grid_obj);
+    } else {
+        grid_obj = (WaveGridObject*)PyObject_CallFunctionObjArgs((PyObject*)&WaveGridType, wave_obj, NULL);
+        if (grid_obj == NULL) {
+            return -1;
+        }
+    }
+    self->grid = grid_obj;
+    self->flux = double_array(flux_obj, "flux");
+    self->err = double_array(err_obj, "error");
+    if (self->flux == NULL || self->err == NULL) {
+        return -1;
+    }
+
+    size_t size = grid_obj->grid.size;
+    if ((size_t)PyArray_DIM(self->flux, 0) != size || (size_t)PyArray_DIM(self->err, 0) != size) {
+        PyErr_SetString(PyExc_ValueError, "waves, flux and error must have the same length");
+        return -1;
+    }
+
+    if (self->lock == NULL) {
+        self->lock = PyThread_allocate_lock();
+    }
+    if (self->lock == NULL) {
+        PyErr_NoMemory();
+        return -1;
+    }
+    if (context_init(&self->ctx, &grid_obj->grid,
+                     (double*)PyArray_DATA(self->flux), (double*)PyArray_DATA(self->err)) < 0) {
+        PyErr_NoMemory();
+        return -1;
+    }
+    self->ready = 1;
+
+    if (starts_obj != Py_None && ends_obj != Py_None) {
+        return SpectrumContext_set_pairs(self, starts_obj, ends_obj);
+    }
+    return 0;
+}
+
+static PyObject *SpectrumContext_set_regions(SpectrumContextObject *self, PyObject *args, PyObject *kwds)
+{
+    if (!context_ready(self)) {
+        return NULL;
+    }
+    static char *kwlist[] = {"starts", "ends", NULL};
+    PyObject *starts_obj, *ends_obj;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OO", kwlist, &starts_obj, &ends_obj)) {
+        return NULL;
+    }
+    if (SpectrumContext_set_pairs(self, starts_obj, ends_obj) < 0) {
+        return NULL;
+    }
+    Py_RETURN_NONE;
+}
+
+static PyObject *SpectrumContext_evaluate(SpectrumContextObject *self, PyObject *args, PyObject *kwds)
+{
+    if (!context_ready(self)) {
+        return NULL;
+    }
+    static char *kwlist[] = {"N", "b", "z", "rest", "gamma", "f", "x", "y", "arrays",
+                             "out_cont", "out_abs", NULL};
+    PyObject *objs[8];
+    PyArrayObject *arrs[8] = {NULL};
+    PyObject *out_cont_obj = Py_None, *out_abs_obj = Py_None;
+    PyArrayObject *cont_out = NULL, *abs_out = NULL;
+    PyObject *result = NULL;
+    absorber *lines = NULL;
+    continuum_point *cont_points = NULL;
+    int want_arrays = 1;
+    int i;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OOOOOOOO|p$OO", kwlist,
+                                     &objs[0], &objs[1], &objs[2], &objs[3],
+                                     &objs[4], &objs[5], &objs[6], &objs[7],
+                                     &want_arrays, &out_cont_obj, &out_abs_obj)) {
+        return NULL;
+    }
+    for (i = 0; i < 8; ++i) {
+        arrs[i] = double_array(objs[i], kwlist[i]);
+        if (arrs[i] == NULL) {
+            goto done;
+        }
+    }
+    npy_intp len_lines = PyArray_DIM(arrs[0], 0);
+    npy_intp len_cont_points = PyArray_DIM(arrs[6], 0);
+    for (i = 1; i < 6; ++i) {
+        if (PyArray_DIM(arrs[i], 0) != len_lines) {
+            PyErr_SetString(PyExc_ValueError, "N, b, z, rest, gamma and f must have the same length");
+            goto done;
+        }
+    }
+    if (PyArray_DIM(arrs[7], 0) != len_cont_points) {
+        PyErr_SetString(PyExc_ValueError, "x and y must have the same length");
+        goto done;
+    }
+
+    {
+        double *N = (double*)PyArray_DATA(arrs[0]), *b = (double*)PyArray_DATA(arrs[1]);
+        double *z = (double*)PyArray_DATA(arrs[2]), *rest = (double*)PyArray_DATA(arrs[3]);
+        double *gamma = (double*)PyArray_DATA(arrs[4]), *f = (double*)PyArray_DATA(arrs[5]);
+        double *x = (double*)PyArray_DATA(arrs[6]), *y = (double*)PyArray_DATA(arrs[7]);
+
+        /*on the heap: the line list can be arbitrarily long*/
+        lines = (absorber*)PyMem_Malloc((len_lines > 0 ? len_lines : 1)*sizeof(absorber));
+        cont_points = (continuum_point*)PyMem_Malloc((len_cont_points > 0 ? len_cont_points : 1)*sizeof(continuum_point));
+        if (lines == NULL || cont_points == NULL) {
+            PyErr_NoMemory();
+            goto done;
+        }
+        for (i = 0; i < len_lines; ++i) {
+            lines[i] = (absorber) { .N=N[i], .b=b[i], .z=z[i],
+                                    .rest=rest[i], .gamma=gamma[i], .f=f[i]};
+        }
+        for (i = 0; i < len_cont_points; ++i) {
+            cont_points[i] = (continuum_point){.x=x[i], .y=y[i]};
+        }
+
+        double chi2;
+        context_acquire(self);
+        Py_BEGIN_ALLOW_THREADS
+        chi2 = context_evaluate(&self->ctx, cont_points, len_cont_points, lines, len_lines);
+        Py_END_ALLOW_THREADS
+        if (chi2 < 0.0) {
+            PyThread_release_lock(self->lock);
+            PyErr_NoMemory();
+            goto done;
+        }
+
+        if (!want_arrays) {
+            PyThread_release_lock(self->lock);
+            result = PyFloat_FromDouble(chi2);
+            goto done;
+        }
+        npy_intp size = (npy_intp)self->ctx.grid.size;
+        cont_out = output(out_cont_obj, "out_cont", size);
+        abs_out = cont_out != NULL ? output(out_abs_obj, "out_abs", size) : NULL;
+        if (abs_out != NULL) {
+            memcpy(PyArray_DATA(cont_out), self->ctx.continuum, size*sizeof(double));
+            memcpy(PyArray_DATA(abs_out), self->ctx.absorption, size*sizeof(double));
+            result = Py_BuildValue("OOd", cont_out, abs_out, chi2);
+        }
+        PyThread_release_lock(self->lock);
+    }
+
+done:
+    PyMem_Free(lines);
+    PyMem_Free(cont_points);
+    Py_XDECREF(cont_out);
+    Py_XDECREF(abs_out);
+    for (i = 0; i < 8; ++i) {
+        Py_XDECREF(arrs[i]);
+    }
+    return result;
+}
+
+static PyArrayObject *batch_array(PyObject *obj, const char *name, npy_intp *num)
+{
+    /*
+    contiguous array of doubles, one row per candidate (2-d) or shared by
+    all of them (1-d).  *num is the number of candidates seen so far, -1 if
+    none yet.  new reference
+    */
+    PyArrayObject *arr = (PyArrayObject*)PyArray_FROM_OTF(obj, NPY_DOUBLE, NPY_ARRAY_IN_ARRAY);
+    if (arr == NULL) {
+        return NULL;
+    }
+    if (PyArray_NDIM(arr) == 2) {
+        if (*num >= 0 && PyArray_DIM(arr, 0) != *num) {
+            PyErr_Format(PyExc_ValueError, "%s has %ld rows, expected %ld", name,
+                         (long)PyArray_DIM(arr, 0), (long)*num);
+            Py_DECREF(arr);
+            return NULL;
+        }
+        *num = PyArray_DIM(arr, 0);
+    } else if (PyArray_NDIM(arr) != 1) {
+        PyErr_Format(PyExc_ValueError, "%s must be one or two dimensional", name);
+        Py_DECREF(arr);
+        return NULL;
+    }
+    return arr;
+}
+
+static PyObject *SpectrumContext_evaluate_many(SpectrumContextObject *self, PyObject *args, PyObject *kwds)
+{
+    if (!context_ready(self)) {
+        return NULL;
+    }
+    static char *kwlist[] = {"N", "b", "z", "rest", "gamma", "f", "x", "y", "absorption", NULL};
+    PyObject *objs[8];
+    PyArrayObject *arrs[8] = {NULL};
+    PyArrayObject *chi2_out = NULL, *abs_out = NULL;
+    PyObject *result = NULL;
+    absorber *lines = NULL;
+    continuum_point *cont_points = NULL;
+    int want_absorption = 0;
+    npy_intp num = -1, k;
+    int i;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OOOOOOOO|p", kwlist,
+                                     &objs[0], &objs[1], &objs[2], &objs[3],
+                                     &objs[4], &objs[5], &objs[6], &objs[7],
+                                     &want_absorption)) {
+        return NULL;
+    }
+    for (i = 0; i < 8; ++i) {
+        arrs[i] = batch_array(objs[i], kwlist[i], &num);
+        if (arrs[i] == NULL) {
+            goto done;
+        }
+    }
+    if (num < 0) {
+        num = 1;
+    }
+
+    npy_intp len_lines = PyArray_DIM(arrs[0], PyArray_NDIM(arrs[0]) - 1);
+    npy_intp len_cont_points = PyArray_DIM(arrs[6], PyArray_NDIM(arrs[6]) - 1);
+    for (i = 1; i < 6; ++i) {
+        if (PyArray_DIM(arrs[i], PyArray_NDIM(arrs[i]) - 1) != len_lines) {
+            PyErr_SetString(PyExc_ValueError, "N, b, z, rest, gamma and f must have the same number of lines");
+            goto done;
+        }
+    }
+    if (PyArray_DIM(arrs[7], PyArray_NDIM(arrs[7]) - 1) != len_cont_points) {
+        PyErr_SetString(PyExc_ValueError, "x and y must have the same number of points");
+        goto done;
+    }
+
+    npy_intp size = (npy_intp)self->ctx.grid.size;
+    npy_intp dims[2] = {num, size};
+    chi2_out = (PyArrayObject*)PyArray_SimpleNew(1, dims, NPY_DOUBLE);
+    if (chi2_out == NULL) {
+        goto done;
+    }
+    if (want_absorption) {
+        abs_out = (PyArrayObject*)PyArray_SimpleNew(2, dims, NPY_DOUBLE);
+        if (abs_out == NULL) {
+            goto done;
+        }
+    }
+    lines = (absorber*)malloc((len_lines > 0 ? len_lines : 1)*sizeof(absorber));
+    cont_points = (continuum_point*)malloc((len_cont_points > 0 ? len_cont_points : 1)*sizeof(continuum_point));
+    if (lines == NULL || cont_points == NULL) {
+        PyErr_NoMemory();
+        goto done;
+    }
+
+    {
+        const double *data[8];
+        npy_intp stride[8];
+        double *chi2 = (double*)PyArray_DATA(chi2_out);
+        double *abs_data = abs_out != NULL ? (double*)PyArray_DATA(abs_out) : NULL;
+        int failed = 0;
+        npy_intp j;
+
+        for (i = 0; i < 8; ++i) {
+            data[i] = (double*)PyArray_DATA(arrs[i]);
+            stride[i] = PyArray_NDIM(arrs[i]) == 2 ? PyArray_DIM(arrs[i], 1) : 0;
+        }
+        context_acquire(self);
+        Py_BEGIN_ALLOW_THREADS
+        for (k = 0; k < num; ++k) {
+            for (j = 0; j < len_lines; ++j) {
+                lines[j] = (absorber) { .N=data[0][k*stride[0] + j], .b=data[1][k*stride[1] + j],
+                                        .z=data[2][k*stride[2] + j], .rest=data[3][k*stride[3] + j],
+                                        .gamma=data[4][k*stride[4] + j], .f=data[5][k*stride[5] + j]};
+            }
+            for (j = 0; j < len_cont_points; ++j) {
+                cont_points[j] = (continuum_point){.x=data[6][k*stride[6] + j], .y=data[7][k*stride[7] + j]};
+            }
+            chi2[k] = context_evaluate(&self->ctx, cont_points, len_cont_points, lines, len_lines);
+            if (chi2[k] < 0.0) {
+                failed = 1;
+                break;
+            }
+            if (abs_data != NULL) {
+                memcpy(abs_data + k*size, self->ctx.absorption, size*sizeof(double));
+            }
+        }
+        Py_END_ALLOW_THREADS
+        PyThread_release_lock(self->lock);
+        if (failed) {
+            PyErr_NoMemory();
+            goto done;
+        }
+    }
+
+    if (abs_out != NULL) {
+        result = Py_BuildValue("OO", chi2_out, abs_out);
+    } else {
+        result = (PyObject*)chi2_out;
+        Py_INCREF(result);
+    }
+
+done:
+    free(lines);
+    free(cont_points);
+    Py_XDECREF(chi2_out);
+    Py_XDECREF(abs_out);
+    for (i = 0; i < 8; ++i) {
+        Py_XDECREF(arrs[i]);
+    }
+    return result;
+}
+
+static PyObject *SpectrumContext_jacobian(SpectrumContextObject *self, PyObject *args, PyObject *kwds)
+{
+    if (!context_ready(self)) {
+        return NULL;
+    }
+    static char *kwlist[] = {"N", "b", "z", "rest", "gamma", "f", "x", "y",
+                             "columns", "point_columns", "lsf", NULL};
+    PyObject *objs[8], *columns_obj, *point_columns_obj;
+    PyArrayObject *arrs[8] = {NULL};
+    PyArrayObject *columns = NULL, *point_columns = NULL;
+    PyArrayObject *pixels = NULL, *model = NULL, *jac = NULL;
+    PyObject *result = NULL;
+    absorber *lines = NULL;
+    continuum_point *cont_points = NULL;
+    int lsf = 1;
+    int i;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OOOOOOOOOO|p", kwlist,
+                                     &objs[0], &objs[1], &objs[2], &objs[3],
+                                     &objs[4], &objs[5], &objs[6], &objs[7],
+                                     &columns_obj, &point_columns_obj, &lsf)) {
+        return NULL;
+    }
+    for (i = 0; i < 8; ++i) {
+        arrs[i] = double_array(objs[i], kwlist[i]);
+        if (arrs[i] == NULL) {
+            goto done;
+        }
+    }
+    npy_intp len_lines = PyArray_DIM(arrs[0], 0);
+    npy_intp len_cont_points = PyArray_DIM(arrs[6], 0);
+    for (i = 1; i < 6; ++i) {
+        if (PyArray_DIM(arrs[i], 0) != len_lines) {
+            PyErr_SetString(PyExc_ValueError, "N, b, z, rest, gamma and f must have the same length");
+            goto done;
+        }
+    }
+    if (PyArray_DIM(arrs[7], 0) != len_cont_points) {
+        PyErr_SetString(PyExc_ValueError, "x and y must have the same length");
+        goto done;
+    }
+    columns = (PyArrayObject*)PyArray_FROM_OTF(columns_obj, NPY_INT, NPY_ARRAY_IN_ARRAY | NPY_ARRAY_FORCECAST);
+    point_columns = int_array(point_columns_obj, "point_columns");
+    if (columns == NULL || point_columns == NULL) {
+        goto done;
+    }
+    if (PyArray_SIZE(columns) != 3*len_lines) {
+        PyErr_SetString(PyExc_ValueError, "columns must have three entries (N, b, z) per line");
+        goto done;
+    }
+    if (PyArray_DIM(point_columns, 0) != len_cont_points) {
+        PyErr_SetString(PyExc_ValueError, "point_columns must have one entry per continuum point");
+        goto done;
+    }
+
+    {
+        double *N = (double*)PyArray_DATA(arrs[0]), *b = (double*)PyArray_DATA(arrs[1]);
+        double *z = (double*)PyArray_DATA(arrs[2]), *rest = (double*)PyArray_DATA(arrs[3]);
+        double *gamma = (double*)PyArray_DATA(arrs[4]), *f = (double*)PyArray_DATA(arrs[5]);
+        double *x = (double*)PyArray_DATA(arrs[6]), *y = (double*)PyArray_DATA(arrs[7]);
+        int *cols = (int*)PyArray_DATA(columns), *pcols = (int*)PyArray_DATA(point_columns);
+        int len_columns = 0;
+        double chi2;
+
+        for (i = 0; i < 3*len_lines; ++i) {
+            if (cols[i] >= len_columns) len_columns = cols[i] + 1;
+        }
+        for (i = 0; i < len_cont_points; ++i) {
+            if (pcols[i] >= len_columns) len_columns = pcols[i] + 1;
+        }
+        lines = (absorber*)malloc((len_lines > 0 ? len_lines : 1)*sizeof(absorber));
+        cont_points = (continuum_point*)malloc((len_cont_points > 0 ? len_cont_points : 1)*sizeof(continuum_point));
+        if (lines == NULL || cont_points == NULL) {
+            PyErr_NoMemory();
+            goto done;
+        }
+        for (i = 0; i < len_lines; ++i) {
+            lines[i] = (absorber) { .N=N[i], .b=b[i], .z=z[i],
+                                    .rest=rest[i], .gamma=gamma[i], .f=f[i]};
+        }
+        for (i = 0; i < len_cont_points; ++i) {
+            cont_points[i] = (continuum_point){.x=x[i], .y=y[i]};
+        }
+
+        context_acquire(self);
+        npy_intp dims[2] = {context_region_pixels(&self->ctx, NULL), len_columns};
+        pixels = (PyArrayObject*)PyArray_SimpleNew(1, dims, NPY_INT);
+        model = (PyArrayObject*)PyArray_SimpleNew(1, dims, NPY_DOUBLE);
+        jac = (PyArrayObject*)PyArray_ZEROS(2, dims, NPY_DOUBLE, 0);
+        if (pixels == NULL || model == NULL || jac == NULL) {
+            PyThread_release_lock(self->lock);
+            goto done;
+        }
+        Py_BEGIN_ALLOW_THREADS
+        context_region_pixels(&self->ctx, (int*)PyArray_DATA(pixels));
+        chi2 = context_jacobian(&self->ctx, cont_points, len_cont_points, lines, len_lines,
+                                cols, pcols, len_columns, lsf ? true : false,
+                                (double*)PyArray_DATA(model), (double*)PyArray_DATA(jac));
+        Py_END_ALLOW_THREADS
+        PyThread_release_lock(self->lock);
+        if (chi2 < 0.0) {
+            PyErr_NoMemory();
+            goto done;
+        }
+        result = Py_BuildValue("OOO", pixels, model, jac);
+    }
+
+done:
+    free(lines);
+    free(cont_points);
+    Py_XDECREF(columns);
+    Py_XDECREF(point_columns);
+    Py_XDECREF(pixels);
+    Py_XDECREF(model);
+    Py_XDECREF(jac);
+    for (i = 0; i < 8; ++i) {
+        Py_XDECREF(arrs[i]);
+    }
+    return result;
+}
+
+static PyObject *SpectrumContext_set_lsf(SpectrumContextObject *self, PyObject *args, PyObject *kwds)
+{
+    if (!context_ready(self)) {
+        return NULL;
+    }
+    static char *kwlist[] = {"kernel", "offset", NULL};
+    PyObject *kernel_obj, *offset_obj = Py_None;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "O|O", kwlist, &kernel_obj, &offset_obj)) {
+        return NULL;
+    }
+    PyArrayObject *kernel = double_array(kernel_obj, "kernel");
+    if (kernel == NULL) {
+        return NULL;
+    }
+    int len_kernel = (int)PyArray_DIM(kernel, 0);
+    int offset = (len_kernel - 1)/2;
+    if (offset_obj != Py_None) {
+        offset = (int)PyLong_AsLong(offset_obj);
+        if (offset == -1 && PyErr_Occurred()) {
+            Py_DECREF(kernel);
+            return NULL;
+        }
+    }
+    context_acquire(self);
+    int status = context_set_lsf(&self->ctx, (double*)PyArray_DATA(kernel), len_kernel, offset);
+    PyThread_release_lock(self->lock);
+    Py_DECREF(kernel);
+    if (status < 0) {
+        return PyErr_NoMemory();
+    }
+    Py_RETURN_NONE;
+}
+
+static PyObject *SpectrumContext_set_lsf_segments(SpectrumContextObject *self, PyObject *args, PyObject *kwds)
+{
+    if (!context_ready(self)) {
+        return NULL;
+    }
+    static char *kwlist[] = {"starts", "kernels", "offsets", NULL};
+    PyObject *starts_obj, *kernels_obj, *offsets_obj = Py_None;
+    PyArrayObject *starts = NULL, *offsets = NULL;
+    PyArrayObject **kernels = NULL;
+    PyObject *seq = NULL;
+    PyObject *result = NULL;
+    double *data = NULL;
+    int *lens = NULL, *offs = NULL;
+    Py_ssize_t i, num = 0;
+    size_t total = 0;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OO|O", kwlist, &starts_obj, &kernels_obj, &offsets_obj)) {
+        return NULL;
+    }
+    starts = int_array(starts_obj, "starts");
+    seq = PySequence_Fast(kernels_obj, "kernels must be a sequence of arrays");
+    if (starts == NULL || seq == NULL) {
+        goto done;
+    }
+    num = PySequence_Fast_GET_SIZE(seq);
+    if (PyArray_DIM(starts, 0) != num || num == 0) {
+        PyErr_SetString(PyExc_ValueError, "starts and kernels must have the same, nonzero length");
+        goto done;
+    }
+    if (offsets_obj != Py_None) {
+        offsets = int_array(offsets_obj, "offsets");
+        if (offsets == NULL) {
+            goto done;
+        }
+        if (PyArray_DIM(offsets, 0) != num) {
+            PyErr_SetString(PyExc_ValueError, "offsets must have one entry per kernel");
+            goto done;
+        }
+    }
+    for (i = 1; i < num; ++i) {
+        if (((int*)PyArray_DATA(starts))[i] < ((int*)PyArray_DATA(starts))[i-1]) {
+            PyErr_SetString(PyExc_ValueError, "starts must be increasing");
+            goto done;
+        }
+    }
+    kernels = (PyArrayObject**)calloc(num, sizeof(PyArrayObject*));
+    lens = (int*)malloc(num*sizeof(int));
+    offs = (int*)malloc(num*sizeof(int));
+    if (kernels == NULL || lens == NULL || offs == NULL) {
+        PyErr_NoMemory();
+        goto done;
+    }
+    for (i = 0; i < num; ++i) {
+        kernels[i] = double_array(PySequence_Fast_GET_ITEM(seq, i), "kernel");
+        if (kernels[i] == NULL) {
+            goto done;
+        }
+        lens[i] = (int)PyArray_DIM(kernels[i], 0);
+        offs[i] = offsets != NULL ? ((int*)PyArray_DATA(offsets))[i] : (lens[i] - 1)/2;
+        total += lens[i];
+    }
+    data = (double*)malloc((total > 0 ? total : 1)*sizeof(double));
+    if (data == NULL) {
+        PyErr_NoMemory();
+        goto done;
+    }
+    total = 0;
+    for (i = 0; i < num; ++i) {
+        memcpy(data + total, PyArray_DATA(kernels[i]), lens[i]*sizeof(double));
+        total += lens[i];
+    }
+    context_acquire(self);
+    int status = context_set_lsf_segments(&self->ctx, (int*)PyArray_DATA(starts), data, lens, offs, (size_t)num);
+    PyThread_release_lock(self->lock);
+    if (status < 0) {
+        PyErr_NoMemory();
+        goto done;
+    }
+    Py_INCREF(Py_None);
+    result = Py_None;
+
+done:
+    if (kernels != NULL) {
+        for (i = 0; i < num; ++i) {
+            Py_XDECREF(kernels[i]);
+        }
+    }
+    free(kernels);
+    free(lens);
+    free(offs);
+    free(data);
+    Py_XDECREF(seq);
+    Py_XDECREF(starts);
+    Py_XDECREF(offsets);
+    return result;
+}
+
+static PyObject *SpectrumContext_set_background(SpectrumContextObject *self, PyObject *args, PyObject *kwds)
+{
+    if (!context_ready(self)) {
+        return NULL;
+    }
+    static char *kwlist[] = {"N", "b", "z", "rest", "gamma", "f", NULL};
+    PyObject *objs[6];
+    PyArrayObject *arrs[6] = {NULL};
+    absorber *lines = NULL;
+    PyObject *result = NULL;
+    int i;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OOOOOO", kwlist,
+                                     &objs[0], &objs[1], &objs[2], &objs[3], &objs[4], &objs[5])) {
+        return NULL;
+    }
+    for (i = 0; i < 6; ++i) {
+        arrs[i] = double_array(objs[i], kwlist[i]);
+        if (arrs[i] == NULL) {
+            goto done;
+        }
+    }
+    npy_intp len_lines = PyArray_DIM(arrs[0], 0);
+    for (i = 1; i < 6; ++i) {
+        if (PyArray_DIM(arrs[i], 0) != len_lines) {
+            PyErr_SetString(PyExc_ValueError, "N, b, z, rest, gamma and f must have the same length");
+            goto done;
+        }
+    }
+    lines = (absorber*)malloc((len_lines > 0 ? len_lines : 1)*sizeof(absorber));
+    if (lines == NULL) {
+        PyErr_NoMemory();
+        goto done;
+    }
+    {
+        double *data[6];
+        for (i = 0; i < 6; ++i) {
+            data[i] = (double*)PyArray_DATA(arrs[i]);
+        }
+        for (i = 0; i < len_lines; ++i) {
+            lines[i] = (absorber) { .N=data[0][i], .b=data[1][i], .z=data[2][i],
+                                    .rest=data[3][i], .gamma=data[4][i], .f=data[5][i]};
+        }
+    }
+    int status;
+    context_acquire(self);
+    Py_BEGIN_ALLOW_THREADS
+    status = context_set_background(&self->ctx, lines, (size_t)len_lines);
+    Py_END_ALLOW_THREADS
+    PyThread_release_lock(self->lock);
+    if (status < 0) {
+        PyErr_NoMemory();
+        goto done;
+    }
+    Py_INCREF(Py_None);
+    result = Py_None;
+
+done:
+    free(lines);
+    for (i = 0; i < 6; ++i) {
+        Py_XDECREF(arrs[i]);
+    }
+    return result;
+}
+
+static PyObject *SpectrumContext_set_restricted(SpectrumContextObject *self, PyObject *args, PyObject *kwds)
+{
+    if (!context_ready(self)) {
+        return NULL;
+    }
+    static char *kwlist[] = {"restricted", NULL};
+    int restricted = 1;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "|p", kwlist, &restricted)) {
+        return NULL;
+    }
+    context_acquire(self);
+    int status = context_set_restricted(&self->ctx, restricted ? true : false);
+    PyThread_release_lock(self->lock);
+    if (status < 0) {
+        return PyErr_NoMemory();
+    }
+    Py_RETURN_NONE;
+}
+
+static PyObject *SpectrumContext_convolved(SpectrumContextObject *self, PyObject *args, PyObject *kwds)
+{
+    if (!context_ready(self)) {
+        return NULL;
+    }
+    static char *kwlist[] = {"out", NULL};
+    PyObject *out_obj = Py_None;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "|O", kwlist, &out_obj)) {
+        return NULL;
+    }
+    PyArrayObject *out = output(out_obj, "out", (npy_intp)self->ctx.grid.size);
+    if (out == NULL) {
+        return NULL;
+    }
+    context_acquire(self);
+    Py_BEGIN_ALLOW_THREADS
+    context_convolved(&self->ctx, (double*)PyArray_DATA(out));
+    Py_END_ALLOW_THREADS
+    PyThread_release_lock(self->lock);
+    return (PyObject*)out;
+}
+
+static PyObject *SpectrumContext_reset(SpectrumContextObject *self, PyObject *Py_UNUSED(ignored))
+{
+    if (!context_ready(self)) {
+        return NULL;
+    }
+    context_acquire(self);
+    context_reset(&self->ctx);
+    PyThread_release_lock(self->lock);
+    Py_RETURN_NONE;
+}
+
+static PyObject *SpectrumContext_get_grid(SpectrumContextObject *self, void *closure)
+{
+    if (!context_ready(self)) {
+        return NULL;
+    }
+    Py_INCREF(self->grid);
+    return (PyObject*)self->grid;
+}
+
+static PyObject *SpectrumContext_get_regions(SpectrumContextObject *self, void *closure)
+{
+    if (!context_ready(self)) {
+        return NULL;
+    }
+    context_acquire(self);
+    npy_intp dims[2] = {(npy_intp)self->ctx.len_pairs, 2};
+    PyArrayObject *out = (PyArrayObject*)PyArray_SimpleNew(2, dims, NPY_INT);
+    if (out != NULL) {
+        int *data = (int*)PyArray_DATA(out);
+        size_t i;
+        for (i = 0; i < self->ctx.len_pairs; ++i) {
+            data[2*i] = self->ctx.pairs[i].start;
+            data[2*i+1] = self->ctx.pairs[i].end;
+        }
+    }
+    PyThread_release_lock(self->lock);
+    return (PyObject*)out;
+}
+
+static PyObject *SpectrumContext_get_active(SpectrumContextObject *self, void *closure)
+{
+    if (!context_ready(self)) {
+        return NULL;
+    }
+    context_acquire(self);
+    npy_intp dims[2] = {(npy_intp)self->ctx.len_active, 2};
+    PyArrayObject *out = (PyArrayObject*)PyArray_SimpleNew(2, dims, NPY_INT);
+    if (out != NULL) {
+        int *data = (int*)PyArray_DATA(out);
+        size_t i;
+        for (i = 0; i < self->ctx.len_active; ++i) {
+            data[2*i] = self->ctx.active[i].start;
+            data[2*i+1] = self->ctx.active[i].end;
+        }
+    }
+    PyThread_release_lock(self->lock);
+    return (PyObject*)out;
+}
+
+static PyObject *SpectrumContext_get_restricted(SpectrumContextObject *self, void *closure)
+{
+    if (!context_ready(self)) {
+        return NULL;
+    }
+    return PyBool_FromLong(self->ctx.restricted);
+}
+
+static PyObject *SpectrumContext_get_dirty(SpectrumContextObject *self, void *closure)
+{
+    if (!context_ready(self)) {
+        return NULL;
+    }
+    if (self->ctx.dirty_lpix > self->ctx.dirty_hpix) {
+        Py_RETURN_NONE;
+    }
+    return Py_BuildValue("ii", self->ctx.dirty_lpix, self->ctx.dirty_hpix + 1);
+}
+
+static PyMethodDef SpectrumContext_methods[] = {
+    {"set_regions", (PyCFunction)SpectrumContext_set_regions, METH_VARARGS | METH_KEYWORDS,
+     "set_regions(starts, ends): fit regions as [start, end) pixel pairs"},
+    {"evaluate", (PyCFunction)SpectrumContext_evaluate, METH_VARARGS | METH_KEYWORDS,
+     "evaluate(N, b, z, rest, gamma, f, x, y, arrays=True, *, out_cont=None, out_abs=None)\n"
+     "    -> (continuum, absorption, chi2)\n\n"
+     "one entry of N, b, z, rest, gamma, f per spectral line.  x, y are the\n"
+     "continuum points, sorted by x.  chi2 is over the fit regions, against\n"
+     "the absorption convolved with the line spread function (see set_lsf),\n"
+     "skipping pixels where it is nan or inf.  absorption is not convolved.\n"
+     "with arrays=False only chi2 is returned.  out_cont and out_abs are\n"
+     "optional float64 arrays to write continuum and absorption into.\n\n"
+     "only lines whose parameters differ from the previous call are\n"
+     "recomputed, and continuum points that only moved in y redraw just the\n"
+     "spline spans they enter.  see dirty for the pixels that changed."},
+    {"evaluate_many", (PyCFunction)SpectrumContext_evaluate_many, METH_VARARGS | METH_KEYWORDS,
+     "evaluate_many(N, b, z, rest, gamma, f, x, y, absorption=False) -> chi2\n\n"
+     "score many candidate models in one call.  each argument is either a\n"
+     "(K, n) array, one row per candidate, or a 1-d array shared by all K.\n"
+     "returns a length K chi2 array, or (chi2, absorption) with absorption\n"
+     "of shape (K, pixels) if absorption is True.  candidates are evaluated\n"
+     "in order, each one incrementally against the one before.  the GIL is\n"
+     "released while they run."},
+    {"jacobian", (PyCFunction)SpectrumContext_jacobian, METH_VARARGS | METH_KEYWORDS,
+     "jacobian(N, b, z, rest, gamma, f, x, y, columns, point_columns, lsf=True)\n"
+     "    -> (pixels, model, jacobian)\n\n"
+     "evaluate as evaluate() does, along with the analytic derivatives of the\n"
+     "absorbed flux over the fit region pixels.  columns is (lines, 3): the\n"
+     "jacobian column for each line's N, b and z, point_columns has the column\n"
+     "for each continuum point's y.  -1 leaves a parameter out and lines\n"
+     "sharing a column add up in it, so an absorber's transitions can share\n"
+     "one.  model and jacobian (pixels, columns) are convolved with the line\n"
+     "spread function unless lsf is False.  profile slopes come from the\n"
+     "Humlicek approximation whichever voigt method is set."},
+    {"set_lsf", (PyCFunction)SpectrumContext_set_lsf, METH_VARARGS | METH_KEYWORDS,
+     "set_lsf(kernel, offset=None): line spread function applied before chi2.\n\n"
+     "the model at pixel i is sum_k absorption[i + offset - k]*kernel[k];\n"
+     "the default offset centers the kernel.  only region pixels are convolved"},
+    {"set_lsf_segments", (PyCFunction)SpectrumContext_set_lsf_segments, METH_VARARGS | METH_KEYWORDS,
+     "set_lsf_segments(starts, kernels, offsets=None): a line spread function\n"
+     "that varies along the spectrum.  kernels[k] (with offsets[k], see\n"
+     "set_lsf) applies from pixel starts[k] up to starts[k+1]; starts are\n"
+     "increasing and the first kernel also covers pixels before starts[0]"},
+    {"convolved", (PyCFunction)SpectrumContext_convolved, METH_VARARGS | METH_KEYWORDS,
+     "convolved(out=None) -> the absorption of the last evaluation convolved\n"
+     "with the line spread function, over the whole spectrum (the region\n"
+     "pixels only if restricted).  written into out if it is given"},
+    {"set_background", (PyCFunction)SpectrumContext_set_background, METH_VARARGS | METH_KEYWORDS,
+     "set_background(N, b, z, rest, gamma, f): lines that stay fixed while\n"
+     "fitting, e.g. fully locked absorbers.  their summed optical depth is\n"
+     "computed once and added to every evaluation, so they should not be\n"
+     "passed to evaluate() as well.  setting the same lines again is free,\n"
+     "empty arrays remove the background"},
+    {"set_restricted", (PyCFunction)SpectrumContext_set_restricted, METH_VARARGS | METH_KEYWORDS,
+     "set_restricted(restricted=True): evaluate only the active pixels, the\n"
+     "regions padded by the width of the line spread function, which is all\n"
+     "chi2 needs.  continuum and absorption elsewhere are left at zero and\n"
+     "lines whose wings can't reach an active pixel are skipped.\n"
+     "set_restricted(False) goes back to evaluating the whole spectrum"},
+    {"reset", (PyCFunction)SpectrumContext_reset, METH_NOARGS,
+     "reset(): forget the cached line optical depths, so that the next\n"
+     "evaluate() recomputes every line"},
+    {NULL, NULL, 0, NULL}
+};
+
+static PyGetSetDef SpectrumContext_getset[] = {
+    {"grid", (getter)SpectrumContext_get_grid, NULL, "the WaveGrid of this spectrum", NULL},
+    {"regions", (getter)SpectrumContext_get_regions, NULL, "fit regions as an (n, 2) array of pixel pairs", NULL},
+    {"restricted", (getter)SpectrumContext_get_restricted, NULL, "whether only the active pixels are evaluated", NULL},
+    {"active", (getter)SpectrumContext_get_active, NULL,
+     "pixels that are evaluated as an (n, 2) array of [start, end) pairs, see set_restricted", NULL},
+    {"dirty", (getter)SpectrumContext_get_dirty, NULL,
+     "(start, end) pixel range rewritten by the last evaluate(), or None if nothing changed", NULL},
+    {NULL}
+};
+
+static PyTypeObject SpectrumContextType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name = "_spectrum.SpectrumContext",
+    .tp_doc = "SpectrumContext(waves, flux, error, starts=None, ends=None, grid=None)\n\n"
+              "holds a spectrum, its fit regions ([start, end) pixel pairs) and the\n"
+              "scratch buffers used to evaluate models against it.\n\n"
+              "evaluations release the GIL.  they are serialized per context, so\n"
+              "threads that fit concurrently should each have their own context;\n"
+              "contexts can share the spectrum arrays and grid.",
+    .tp_basicsize = sizeof(SpectrumContextObject),
+    .tp_itemsize = 0,
+    .tp_flags = Py_TPFLAGS_DEFAULT,
+    .tp_new = PyType_GenericNew,
+    .tp_init = (initproc)SpectrumContext_init,
+    .tp_dealloc = (destructor)SpectrumContext_dealloc,
+    .tp_methods = SpectrumContext_methods,
+    .tp_getset = SpectrumContext_getset,
+};
+
+/*************************************************************
+ * Workspace: output arrays and scratch space for spectrum(), so
+ * that repeated calls do not allocate
+ *************************************************************/
+
+typedef struct {
+    PyObject_HEAD
+    PyArrayObject *continuum;
+    PyArrayObject *absorption;
+    double *tau;            /* fill_absorption_into scratch, 2*size per thread */
+    int len_tau;            /* threads tau has room for */
+    PyThread_type_lock lock;
+} WorkspaceObject;
+
+static PyTypeObject WorkspaceType;
+
+static void Workspace_dealloc(WorkspaceObject *self)
+{
+    Py_XDECREF(self->continuum);
+    Py_XDECREF(self->absorption);
+    PyMem_Free(self->tau);
+    if (self->lock != NULL) {
+        PyThread_free_lock(self->lock);
+    }
+    Py_TYPE(self)->tp_free((PyObject*)self);
+}
+
+static int Workspace_init(WorkspaceObject *self, PyObject *args, PyObject *kwds)
+{
+    static char *kwlist[] = {"size", NULL};
+    Py_ssize_t size;
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "n", kwlist, &size)) {
+        return -1;
+    }
+    if (self->lock != NULL) {
+        PyErr_SetString(PyExc_RuntimeError, "Workspace is already initialized");
+        return -1;
+    }
+    if (size < 1) {
+        PyErr_SetString(PyExc_ValueError, "size must be positive");
+        return -1;
+    }
+    npy_intp dims[1] = {(npy_intp)size};
+    Py_CLEAR(self->continuum);  /* whatever a failed earlier __init__ left behind */
+    Py_CLEAR(self->absorption);
+    self->continuum = (PyArrayObject*)PyArray_ZEROS(1, dims, NPY_DOUBLE, 0);
+    self->absorption = (PyArrayObject*)PyArray_ZEROS(1, dims, NPY_DOUBLE, 0);
+    if (self->continuum == NULL || self->absorption == NULL) {
+        return -1;
+    }
+    self->lock = PyThread_allocate_lock();
+    if (self->lock == NULL) {
+        PyErr_NoMemory();
+        return -1;
+    }
+    return 0;
+}
+
+static int workspace_ready(WorkspaceObject *self)
+{
+    /* objects made with Workspace.__new__ have no buffers until __init__ has run */
+    if (self->lock == NULL) {
+        PyErr_SetString(PyExc_RuntimeError, "Workspace is not initialized");
+        return 0;
+    }
+    return 1;
+}
+
+static double *Workspace_scratch(WorkspaceObject *self, int nthreads)
+{
+    /* scratch for fill_absorption_into, grown the first time more threads are used */
+    if (nthreads > self->len_tau) {
+        size_t size = (size_t)PyArray_DIM(self->continuum, 0);
+        double *tau = (double*)PyMem_Realloc(self->tau, 2*(size_t)nthreads*size*sizeof(double));
+        if (tau == NULL) {
+            return NULL;
+        }
+        self->tau = tau;
+        self->len_tau = nthreads;
+    }
+    return self->tau;
+}
+
+static PyObject *Workspace_get_continuum(WorkspaceObject *self, void *closure)
+{
+    if (!workspace_ready(self)) {
+        return NULL;
+    }
+    Py_INCREF(self->continuum);
+    return (PyObject*)self->continuum;
+}
+
+static PyObject *Workspace_get_absorption(WorkspaceObject *self, void *closure)
+{
+    if (!workspace_ready(self)) {
+        return NULL;
+    }
+    Py_INCREF(self->absorption);
+    return (PyObject*)self->absorption;
+}
+
+static PyObject *Workspace_get_size(WorkspaceObject *self, void *closure)
+{
+    if (!workspace_ready(self)) {
+        return NULL;
+    }
+    return PyLong_FromSsize_t((Py_ssize_t)PyArray_DIM(self->continuum, 0));
+}
+
+static PyGetSetDef Workspace_getset[] = {
+    {"continuum", (getter)Workspace_get_continuum, NULL, "continuum written by the last spectrum() call", NULL},
+    {"absorption", (getter)Workspace_get_absorption, NULL, "absorption written by the last spectrum() call", NULL},
+    {"size", (getter)Workspace_get_size, NULL, "number of pixels", NULL},
+    {NULL}
+};
+
+static PyTypeObject WorkspaceType = {
+    PyVarObject_HEAD_INIT(NULL, 0)
+    .tp_name = "_spectrum.Workspace",
+    .tp_doc = "Workspace(size)\n\n"
+              "buffers for spectrum(..., workspace=ws) on a spectrum of size pixels.\n"
+              "the continuum and absorption it returns are ws.continuum and\n"
+              "ws.absorption, overwritten by the next call, and the scratch space\n"
+              "is kept between calls, so that repeated calls do not allocate.\n"
+              "calls sharing a workspace run one at a time.",
+    .tp_basicsize = sizeof(WorkspaceObject),
+    .tp_itemsize = 0,
+    .tp_flags = Py_TPFLAGS_DEFAULT,
+    .tp_new = PyType_GenericNew,
+    .tp_init = (initproc)Workspace_init,
+    .tp_dealloc = (destructor)Workspace_dealloc,
+    .tp_getset = Workspace_getset,
+};
+
+/*************************************************************/
+
 /* Available functions */
-static PyObject *spectrum_spectrum(PyObject *self, PyObject *args);
+static PyObject *spectrum_spectrum(PyObject *self, PyObject *args, PyObject *kwds);
+
+static PyObject *spectrum_set_num_threads(PyObject *self, PyObject *args)
+{
+    int n;
+    if (!PyArg_ParseTuple(args, "i", &n)) {
+        return NULL;
+    }
+    set_num_threads(n);
+    Py_RETURN_NONE;
+}
+
+static PyObject *spectrum_get_num_threads(PyObject *self, PyObject *Py_UNUSED(ignored))
+{
+    return PyLong_FromLong(get_num_threads());
+}
+
+static const char *voigt_names[] = {"table", "humlicek", "fast", NULL};
+
+static int voigt_from_name(const char *name, voigt_method *m)
+{
+    int i;
+    for (i = 0; voigt_names[i] != NULL; ++i) {
+        if (strcmp(name, voigt_names[i]) == 0) {
+            *m = (voigt_method)i;
+            return 0;
+        }
+    }
+    PyErr_Format(PyExc_ValueError, "unknown voigt method '%s', expected table, humlicek or fast", name);
+    return -1;
+}
+
+static PyObject *spectrum_set_voigt(PyObject *self, PyObject *args)
+{
+    const char *name;
+    voigt_method m;
+    if (!PyArg_ParseTuple(args, "s", &name) || voigt_from_name(name, &m) < 0) {
+        return NULL;
+    }
+    set_voigt_method(m);
+    Py_RETURN_NONE;
+}
+
+static PyObject *spectrum_get_voigt(PyObject *self, PyObject *Py_UNUSED(ignored))
+{
+    return PyUnicode_FromString(voigt_names[get_voigt_method()]);
+}
+
+static PyObject *spectrum_voigt(PyObject *self, PyObject *args, PyObject *kwds)
+{
+    static char *kwlist[] = {"v", "a", "method", NULL};
+    PyObject *v_obj;
+    double a;
+    const char *name = NULL;
+    voigt_method m = get_voigt_method();
+
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "Od|s", kwlist, &v_obj, &a, &name)) {
+        return NULL;
+    }
+    if (name != NULL && voigt_from_name(name, &m) < 0) {
+        return NULL;
+    }
+    PyArrayObject *v_arr = double_array(v_obj, "v");
+    if (v_arr == NULL) {
+        return NULL;
+    }
+    npy_intp n = PyArray_DIM(v_arr, 0);
+    PyArrayObject *out = (PyArrayObject*)PyArray_SimpleNew(1, &n, NPY_DOUBLE);
+    if (out != NULL) {
+        Py_BEGIN_ALLOW_THREADS
+        voigt_array((double*)PyArray_DATA(v_arr), (double*)PyArray_DATA(out), (size_t)n, a, m);
+        Py_END_ALLOW_THREADS
+    }
+    Py_DECREF(v_arr);
+    return (PyObject*)out;
+}
 
 /* Module specification */
 static PyMethodDef module_methods[] = {
-    {"spectrum", spectrum_spectrum, METH_VARARGS, NULL},
+    {"spectrum", (PyCFunction)spectrum_spectrum, METH_VARARGS | METH_KEYWORDS,
+     "spectrum(waves, flux, error, x, y, N, b, z, rest, gamma, f, starts, ends,\n"
+     "         grid=None, out_cont=None, out_abs=None, workspace=None)\n"
+     "    -> (continuum, absorption, chi2)\n\n"
+     "one shot evaluation, with starts and ends the regions in wavelength.\n"
+     "continuum and absorption are written into out_cont and out_abs when\n"
+     "given, otherwise into the workspace's arrays (see Workspace), otherwise\n"
+     "into new arrays"},
+    {"set_num_threads", (PyCFunction)spectrum_set_num_threads, METH_VARARGS,
+     "set_num_threads(n): threads used to compute line absorption.\n"
+     "0 goes back to the default, which follows OMP_NUM_THREADS"},
+    {"get_num_threads", (PyCFunction)spectrum_get_num_threads, METH_NOARGS,
+     "get_num_threads() -> number of threads used to compute line absorption"},
+    {"set_voigt", (PyCFunction)spectrum_set_voigt, METH_VARARGS,
+     "set_voigt(method): voigt profile used for every line from now on.\n\n"
+     "table     interpolated table, the default\n"
+     "humlicek  Humlicek (1982) W4 rational approximation to the Faddeeva function\n"
+     "fast      gaussian core alone for lines too weak for their damping wings\n"
+     "          to reach the optical depth cutoff, humlicek for the rest"},
+    {"get_voigt", (PyCFunction)spectrum_get_voigt, METH_NOARGS,
+     "get_voigt() -> name of the voigt method in use"},
+    {"voigt", (PyCFunction)spectrum_voigt, METH_VARARGS | METH_KEYWORDS,
+     "voigt(v, a, method=None) -> H(a, v) over an array of v.\n\n"
+     "method defaults to the one in use.  'fast' is the pure gaussian exp(-v**2)"},
     {NULL, NULL, 0, NULL}
 };
 
@@ -23,149 +1447,194 @@ static struct PyModuleDef _spectrum ={
 /* Initialize the module */
 PyMODINIT_FUNC PyInit__spectrum(void)
 {
-    import_array();
-    return PyModule_Create(&_spectrum);
+    PyObject *module;
 
-    
+    import_array();
+    if (PyType_Ready(&WaveGridType) < 0 || PyType_Ready(&SpectrumContextType) < 0 ||
+        PyType_Ready(&WorkspaceType) < 0) {
+        return NULL;
+    }
+    module = PyModule_Create(&_spectrum);
+    if (module == NULL) {
+        return NULL;
+    }
+    Py_INCREF(&WaveGridType);
+    if (PyModule_AddObject(module, "WaveGrid", (PyObject*)&WaveGridType) < 0) {
+        Py_DECREF(&WaveGridType);
+        Py_DECREF(module);
+        return NULL;
+    }
+    Py_INCREF(&SpectrumContextType);
+    if (PyModule_AddObject(module, "SpectrumContext", (PyObject*)&SpectrumContextType) < 0) {
+        Py_DECREF(&SpectrumContextType);
+        Py_DECREF(module);
+        return NULL;
+    }
+    Py_INCREF(&WorkspaceType);
+    if (PyModule_AddObject(module, "Workspace", (PyObject*)&WorkspaceType) < 0) {
+        Py_DECREF(&WorkspaceType);
+        Py_DECREF(module);
+        return NULL;
+    }
+    return module;
 }
 
-static PyObject *spectrum_spectrum(PyObject *self, PyObject *args)
+static PyObject *spectrum_spectrum(PyObject *self, PyObject *args, PyObject *kwds)
 {
-    PyObject *wave_obj, *flux_obj, *err_obj;
-    PyObject *x_obj, *y_obj;
-    PyObject *N_obj, *b_obj, *z_obj;
-    PyObject *rest_obj, *gamma_obj, *f_obj;
-    PyObject *starts_obj, *ends_obj;
+    static char *kwlist[] = {"waves", "flux", "error", "x", "y",
+                             "N", "b", "z", "rest", "gamma", "f",
+                             "starts", "ends", "grid", "out_cont", "out_abs", "workspace", NULL};
+    PyObject *objs[13];
+    PyArrayObject *arrs[13] = {NULL};
+    WaveGridObject *grid_obj = NULL;
+    WorkspaceObject *ws = NULL;
+    PyObject *out_cont_obj = Py_None, *out_abs_obj = Py_None;
+    PyArrayObject *cont_out = NULL, *abs_out = NULL;
+    PyObject *result = NULL;
+    double *tau = NULL;
+    absorber *lines = NULL;
+    continuum_point *cont_points = NULL;
+    int nthreads = get_num_threads();
+    int i;
 
-    /* Parse the input tuple */
-    if (!PyArg_ParseTuple(args, "OOOOOOOOOOOOO",&wave_obj, &flux_obj, &err_obj,
-                                                &x_obj, &y_obj, 
-                                                &N_obj, &b_obj,&z_obj,
-                                                &rest_obj,&gamma_obj,&f_obj,
-                                                &starts_obj, &ends_obj)){
-        return NULL;
-    }
-    /* Interpret the input objects as numpy arrays. */
-    PyObject *wave_arr = PyArray_FROM_OTF(wave_obj, NPY_DOUBLE, NPY_IN_ARRAY);
-    PyObject *flux_arr = PyArray_FROM_OTF(flux_obj, NPY_DOUBLE, NPY_IN_ARRAY);
-    PyObject *err_arr = PyArray_FROM_OTF(err_obj, NPY_DOUBLE, NPY_IN_ARRAY);
-    //PyObject *cont_arr = PyArray_FROM_OTF(cont_obj, NPY_DOUBLE, NPY_IN_ARRAY);
-    PyObject *x_arr    = PyArray_FROM_OTF(x_obj, NPY_DOUBLE, NPY_IN_ARRAY);
-    PyObject *y_arr    = PyArray_FROM_OTF(y_obj, NPY_DOUBLE, NPY_IN_ARRAY);
-    PyObject *N_arr    = PyArray_FROM_OTF(N_obj, NPY_DOUBLE, NPY_IN_ARRAY);
-    PyObject *b_arr    = PyArray_FROM_OTF(b_obj, NPY_DOUBLE, NPY_IN_ARRAY);
-    PyObject *z_arr    = PyArray_FROM_OTF(z_obj, NPY_DOUBLE, NPY_IN_ARRAY);
-    PyObject *rest_arr = PyArray_FROM_OTF(rest_obj, NPY_DOUBLE, NPY_IN_ARRAY);
-    PyObject *gamma_arr= PyArray_FROM_OTF(gamma_obj, NPY_DOUBLE, NPY_IN_ARRAY);
-    PyObject *f_arr    = PyArray_FROM_OTF(f_obj, NPY_DOUBLE, NPY_IN_ARRAY);
-    PyObject *starts_arr    = PyArray_FROM_OTF(starts_obj, NPY_DOUBLE, NPY_IN_ARRAY);
-    PyObject *ends_arr    = PyArray_FROM_OTF(ends_obj, NPY_DOUBLE, NPY_IN_ARRAY);
-
-
-    /* If that didn't work, throw an exception. */
-    if (wave_arr == NULL || flux_arr == NULL || x_arr == NULL|| 
-            y_arr == NULL|| N_arr == NULL|| b_arr == NULL|| z_arr == NULL|| 
-            rest_arr == NULL|| gamma_arr == NULL|| f_arr == NULL
-            || starts_arr == NULL|| ends_arr == NULL) {
-        Py_XDECREF(wave_arr);
-        Py_XDECREF(flux_arr);
-        Py_XDECREF(err_arr);
-        //Py_XDECREF(cont_arr);
-        Py_XDECREF(x_arr);
-        Py_XDECREF(y_arr);
-        Py_XDECREF(N_arr);
-        Py_XDECREF(b_arr);
-        Py_XDECREF(z_arr);
-        Py_XDECREF(rest_arr);
-        Py_XDECREF(gamma_arr);
-        Py_XDECREF(f_arr);
-        Py_XDECREF(starts_arr);
-        Py_XDECREF(ends_arr);
-        return NULL;
-    }
- /* How many data points are there? */
-    int len_cont_points = (int)PyArray_DIM(x_arr, 0);
-    int len_arr = (int)PyArray_DIM(wave_arr, 0);
-    int len_abs = (int)PyArray_DIM(N_arr, 0);
-    int len_pairs = (int)PyArray_DIM(starts_arr, 0);
-
-
-    /* Get pointers to the data as C-types. */
-    const double *wave   = (double*)PyArray_DATA(wave_arr);
-    const double *flux   = (double*)PyArray_DATA(flux_arr);
-    const double *err    = (double*)PyArray_DATA(err_arr);
-    //double *continuum = (double*)PyArray_DATA(cont_arr);
-    double *x       = (double*)PyArray_DATA(x_arr);
-    double *y       = (double*)PyArray_DATA(y_arr);
-    double *N       = (double*)PyArray_DATA(N_arr);
-    double *b       = (double*)PyArray_DATA(b_arr);
-    double *z       = (double*)PyArray_DATA(z_arr);
-    double *rest    = (double*)PyArray_DATA(rest_arr);
-    double *gamma   = (double*)PyArray_DATA(gamma_arr);
-    double *f       = (double*)PyArray_DATA(f_arr);
-    double *starts  = (double*)PyArray_DATA(starts_arr);
-    double *ends    = (double*)PyArray_DATA(ends_arr);
-
-    int dims[1],i;
-    dims[0]=len_arr;
-
-
-    PyArrayObject* contin_out=(PyArrayObject*) PyArray_FromDims(1,dims, NPY_DOUBLE);
-    PyArrayObject* abs_out=(PyArrayObject*) PyArray_FromDims(1,dims, NPY_DOUBLE);
-
-
-    double* cont_data=(double*)contin_out->data;
-    double* abs_data=(double*)abs_out->data;
-
-    /*double* value = (double*)spectrum(wave,flux, err,continuum,x, y,N,b,z,rest,gamma,f, starts, ends,len_cont_points,len_arr,len_abs,len_pairs)
-    for(i=0;i<len_arr;++i){
-        data[i]=value[i];
-    }*/
-
-    double* cont = (double*)return_continuum(x,y, wave, len_cont_points, len_arr);
-    for(i=0;i<len_arr;++i){
-        cont_data[i]=cont[i];
-    }
-
-    double* ab = (double*)return_absorption(cont, wave, N,b, z, rest, gamma, f,len_abs, len_arr);
-    for(i=0;i<len_arr;++i){
-        abs_data[i]=ab[i];
-    }
-
-
-    double chi2 = (double)get_chi2(ab, flux, err, wave, starts, ends, len_pairs, len_arr);
-
-    if (chi2 < 0.0) {
-        PyErr_SetString(PyExc_RuntimeError,
-                    "Chi-squared returned an impossible value.");
-        return NULL;
-    }
-    /* Build the output tuple */
+    if (!PyArg_ParseTupleAndKeywords(args, kwds, "OOOOOOOOOOOOO|O!OOO!", kwlist,
+                                     &objs[0], &objs[1], &objs[2], &objs[3], &objs[4],
+                                     &objs[5], &objs[6], &objs[7], &objs[8], &objs[9], &objs[10],
+                                     &objs[11], &objs[12],
+                                     &WaveGridType, &grid_obj, &out_cont_obj, &out_abs_obj,
+                                     &WorkspaceType, &ws)) {
+        return NULL;
+    }
+    if ((grid_obj != NULL && !grid_ready(grid_obj)) || (ws != NULL && !workspace_ready(ws))) {
+        return NULL;
+    }
+    /* arrays that already are contiguous doubles are used as they are */
+    for (i = 0; i < 13; ++i) {
+        arrs[i] = double_array(objs[i], kwlist[i]);
+        if (arrs[i] == NULL) {
+            goto done;
+        }
+    }
+    npy_intp len_arr = PyArray_DIM(arrs[0], 0);
+    npy_intp len_cont_points = PyArray_DIM(arrs[3], 0);
+    npy_intp len_abs = PyArray_DIM(arrs[5], 0);
+    npy_intp len_pairs = PyArray_DIM(arrs[11], 0);
+    if (PyArray_DIM(arrs[1], 0) != len_arr || PyArray_DIM(arrs[2], 0) != len_arr) {
+        PyErr_SetString(PyExc_ValueError, "waves, flux and error must have the same length");
+        goto done;
+    }
+    if (PyArray_DIM(arrs[4], 0) != len_cont_points) {
+        PyErr_SetString(PyExc_ValueError, "x and y must have the same length");
+        goto done;
+    }
+    for (i = 6; i < 11; ++i) {
+        if (PyArray_DIM(arrs[i], 0) != len_abs) {
+            PyErr_SetString(PyExc_ValueError, "N, b, z, rest, gamma and f must have the same length");
+            goto done;
+        }
+    }
+    if (PyArray_DIM(arrs[12], 0) != len_pairs) {
+        PyErr_SetString(PyExc_ValueError, "starts and ends must have the same length");
+        goto done;
+    }
 
+    /* on the heap: the line list can be arbitrarily long */
+    lines = (absorber*)PyMem_Malloc((len_abs > 0 ? len_abs : 1)*sizeof(absorber));
+    cont_points = (continuum_point*)PyMem_Malloc((len_cont_points > 0 ? len_cont_points : 1)*sizeof(continuum_point));
+    if (lines == NULL || cont_points == NULL) {
+        PyErr_NoMemory();
+        goto done;
+    }
 
-    /* Clean up. */
-    Py_DECREF(wave_arr);
-    Py_DECREF(flux_arr);
-    Py_DECREF(err_arr);
-    Py_DECREF(x_arr);
-    Py_DECREF(y_arr);
-    Py_DECREF(N_arr);
-    Py_DECREF(b_arr);
-    Py_DECREF(z_arr);
-    Py_DECREF(rest_arr);
-    Py_DECREF(gamma_arr);
-    Py_DECREF(f_arr);
-    Py_DECREF(starts_arr);
-    Py_DECREF(ends_arr);
+    /* outputs: the caller's arrays, else the workspace's, else new ones */
+    if (ws != NULL) {
+        if (PyArray_DIM(ws->continuum, 0) != len_arr) {
+            PyErr_Format(PyExc_ValueError, "workspace is for %ld pixels, spectrum has %ld",
+                         (long)PyArray_DIM(ws->continuum, 0), (long)len_arr);
+            goto done;
+        }
+        if (out_cont_obj == Py_None) out_cont_obj = (PyObject*)ws->continuum;
+        if (out_abs_obj == Py_None) out_abs_obj = (PyObject*)ws->absorption;
+    }
+    cont_out = output(out_cont_obj, "out_cont", len_arr);
+    abs_out = cont_out != NULL ? output(out_abs_obj, "out_abs", len_arr) : NULL;
+    if (abs_out == NULL) {
+        goto done;
+    }
+    if (cont_out == abs_out) {
+        PyErr_SetString(PyExc_ValueError, "out_cont and out_abs must be different arrays");
+        goto done;
+    }
 
-    free(ab);
-    ab=NULL;
+    if (ws != NULL) {
+        acquire_lock(ws->lock);
+        tau = Workspace_scratch(ws, nthreads);
+    } else {
+        tau = (double*)PyMem_Malloc(2*(size_t)nthreads*len_arr*sizeof(double));
+    }
+    if (tau == NULL) {
+        if (ws != NULL) PyThread_release_lock(ws->lock);
+        PyErr_NoMemory();
+        goto done;
+    }
 
-    free(cont);
-    cont=NULL;
+    {
+        const double *wave = (double*)PyArray_DATA(arrs[0]);
+        const double *flux = (double*)PyArray_DATA(arrs[1]), *err = (double*)PyArray_DATA(arrs[2]);
+        double *x = (double*)PyArray_DATA(arrs[3]), *y = (double*)PyArray_DATA(arrs[4]);
+        double *N = (double*)PyArray_DATA(arrs[5]), *b = (double*)PyArray_DATA(arrs[6]);
+        double *z = (double*)PyArray_DATA(arrs[7]), *rest = (double*)PyArray_DATA(arrs[8]);
+        double *gamma = (double*)PyArray_DATA(arrs[9]), *f = (double*)PyArray_DATA(arrs[10]);
+        double *starts = (double*)PyArray_DATA(arrs[11]), *ends = (double*)PyArray_DATA(arrs[12]);
+        double *cont = (double*)PyArray_DATA(cont_out), *ab = (double*)PyArray_DATA(abs_out);
+        double chi2;
 
-    return Py_BuildValue("OOd", contin_out, abs_out, chi2);
-}
+        /*
+        the grid attached to the spectrum saves re-deriving the wavelength
+        scale, as long as it was made for these wavelengths
+        */
+        wave_grid grid;
+        if (grid_obj != NULL && grid_obj->grid.size == (size_t)len_arr &&
+            (grid_obj->grid.waves == wave || memcmp(grid_obj->grid.waves, wave, len_arr*sizeof(double)) == 0)) {
+            grid = grid_obj->grid;
+            grid.waves = wave;
+        } else {
+            grid_init(&grid, wave, len_arr);
+        }
+        for (i = 0; i < len_abs; ++i) {
+            lines[i] = (absorber) { .N=N[i], .b=b[i], .z=z[i],
+                                    .rest=rest[i], .gamma=gamma[i], .f=f[i]};
+        }
+        for (i = 0; i < len_cont_points; ++i) {
+            cont_points[i] = (continuum_point){.x=x[i], .y=y[i]};
+        }
 
+        Py_BEGIN_ALLOW_THREADS
+        memset(cont, 0, len_arr*sizeof(double));
+        fill_continuum(cont_points, &grid, len_cont_points, cont);
+        fill_absorption_into(cont, &grid, lines, len_abs, ab, tau, nthreads);
+        chi2 = get_chi2(ab, flux, err, &grid, starts, ends, len_pairs);
+        Py_END_ALLOW_THREADS
 
+        if (ws != NULL) {
+            PyThread_release_lock(ws->lock);
+        } else {
+            PyMem_Free(tau);
+        }
+        if (chi2 < 0.0) {
+            PyErr_SetString(PyExc_RuntimeError, "Chi-squared returned an impossible value.");
+            goto done;
+        }
+        result = Py_BuildValue("OOd", cont_out, abs_out, chi2);
+    }
 
+done:
+    PyMem_Free(lines);
+    PyMem_Free(cont_points);
+    Py_XDECREF(cont_out);
+    Py_XDECREF(abs_out);
+    for (i = 0; i < 13; ++i) {
+        Py_XDECREF(arrs[i]);
+    }
+    return result;
+}
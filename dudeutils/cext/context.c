@@ -0,0 +1,842 @@
+
+#include<stdio.h>
+#include<stdlib.h>
+#include<math.h>
+#include<string.h>
+#include"spectrum.h"
+
+/*
+a spectrum context owns everything that stays fixed while a model is being
+fit: the wavelength grid, flux and error, the fit regions and the scratch
+buffers that continuum and absorption get written into.  the arrays
+themselves belong to the caller, who needs to keep them alive.
+
+it also remembers the optical depth of each line over its pixel window, so
+that a step which moves a few lines costs a few windows rather than a pass
+over every line.
+
+in restricted mode (context_set_restricted) only the active pixels are
+evaluated: the fit regions padded by the width of the line spread function,
+which are all the pixels chi2 depends on.  lines whose wings can't reach
+them are skipped, and the rest of continuum and absorption is left at zero.
+*/
+
+#define REBUILD_EVERY 4096  /*re-sum tau from the line windows this often, to stop rounding drift*/
+
+static bool same_line(const absorber *a, const absorber *b){
+    return a->N == b->N && a->b == b->b && a->z == b->z &&
+           a->rest == b->rest && a->gamma == b->gamma && a->f == b->f;
+}
+
+typedef enum { POINTS_SAME, POINTS_MOVED_Y, POINTS_CHANGED } points_change;
+
+static points_change compare_points(const spec_context *ctx, const continuum_point cont_points[], size_t len){
+    /*moving y alone leaves every span over the same pixels, anything else does not*/
+    size_t i;
+    points_change change = POINTS_SAME;
+    if (len != ctx->len_cont_points) return POINTS_CHANGED;
+    for(i=0;i<len;++i){
+        if (cont_points[i].x != ctx->cont_points[i].x){
+            return POINTS_CHANGED;
+        }
+        if (cont_points[i].y != ctx->cont_points[i].y){
+            change = POINTS_MOVED_Y;
+        }
+    }
+    return change;
+}
+
+static bool overlaps_active(const spec_context *ctx, int lpix, int hpix){
+    /*whether any pixel in lpix..hpix is active*/
+    size_t lo = 0, hi = ctx->len_active;
+    while (lo < hi){
+        /*first active range that ends after lpix*/
+        size_t mid = lo + (hi - lo)/2;
+        if (ctx->active[mid].end <= lpix) lo = mid + 1;
+        else                              hi = mid;
+    }
+    return lo < ctx->len_active && ctx->active[lo].start <= hpix && lpix <= hpix;
+}
+
+static int store_line(spec_context *ctx, line_state *st, const absorber *line, double scratch[]){
+    /*compute a line's optical depth and keep its window, empty if it can't reach an active pixel*/
+    int lpix, hpix;
+    line_reach(&ctx->grid, line, &lpix, &hpix);
+    if (!ctx->restricted || overlaps_active(ctx, lpix, hpix)){
+        line_tau(&ctx->grid, line, scratch, &lpix, &hpix);
+    }else{
+        lpix = 0;
+        hpix = -1;
+    }
+    size_t width = hpix >= lpix ? (size_t)(hpix - lpix + 1) : 0;
+    if (width > st->cap){
+        double *tau = (double*)realloc(st->tau, width*sizeof(double));
+        if (tau == NULL){
+            return -1;
+        }
+        st->tau = tau;
+        st->cap = width;
+    }
+    if (width > 0){
+        memcpy(st->tau, scratch + lpix, width*sizeof(double));
+    }
+    st->line = *line;
+    st->lpix = lpix;
+    st->hpix = hpix;
+    return 0;
+}
+
+static void add_line(spec_context *ctx, const line_state *st, double sign){
+    int i;
+    for(i=st->lpix;i<=st->hpix;++i){
+        ctx->tau[i] += sign*st->tau[i - st->lpix];
+    }
+}
+
+static void rebuild_tau(spec_context *ctx){
+    /*the fixed lines' optical depth, plus every other line's*/
+    size_t k;
+    if (ctx->background != NULL){
+        memcpy(ctx->tau, ctx->background, ctx->grid.size*sizeof(double));
+    }else{
+        memset(ctx->tau, 0, ctx->grid.size*sizeof(double));
+    }
+    for(k=0;k<ctx->len_lines;++k){
+        add_line(ctx, &ctx->lines[k], 1.0);
+    }
+    ctx->updates = 0;
+}
+
+static const lsf_segment *segment_at(const spec_context *ctx, int i){
+    /*the lsf segment covering pixel i: the last one starting at or before it*/
+    size_t lo = 0, hi = ctx->len_lsf;
+    while (hi - lo > 1){
+        size_t mid = lo + (hi - lo)/2;
+        if (ctx->lsf[mid].start <= i) lo = mid;
+        else                          hi = mid;
+    }
+    return &ctx->lsf[lo];
+}
+
+static double convolve_at(const spec_context *ctx, const double buf[], int i){
+    /*
+    buf at pixel i seen through the line spread function:
+    sum_k buf[i + offset - k]*kernel[k], zero outside the grid, with the
+    kernel and offset of the segment pixel i is in
+    */
+    int k, j;
+    int size = (int)ctx->grid.size;
+    const lsf_segment *seg = ctx->len_lsf == 1 ? ctx->lsf : segment_at(ctx, i);
+    int kbeg = i + seg->offset - (size - 1);
+    int kend = i + seg->offset;
+    double sum = 0.0;
+    if (kbeg < 0) kbeg = 0;
+    if (kend > seg->len_kernel - 1) kend = seg->len_kernel - 1;
+    for(k=kbeg, j=i+seg->offset-kbeg; k<=kend; ++k, --j){
+        sum += buf[j]*seg->kernel[k];
+    }
+    return sum;
+}
+
+static double lsf_value(const spec_context *ctx, int i){
+    /*absorbed flux at pixel i seen through the line spread function*/
+    return convolve_at(ctx, ctx->absorption, i);
+}
+
+static double pixel_resid(const spec_context *ctx, int i){
+    /*weighted chi2 term of pixel i, 0 outside the regions or if it isn't finite*/
+    double diff;
+    if (ctx->weight[i] == 0) return 0.0;
+    diff = (ctx->flux[i] - lsf_value(ctx, i))/ctx->err[i];
+    if (!isfinite(diff)) return 0.0;
+    return ctx->weight[i]*diff*diff;
+}
+
+static void refresh_resid(spec_context *ctx, int lpix, int hpix){
+    /*chi2 terms of pixels whose convolved flux depends on absorption[lpix..hpix]*/
+    int i;
+    int beg = lpix - ctx->lsf_hi;
+    int end = hpix - ctx->lsf_lo;
+    if (beg < 0) beg = 0;
+    if (end > (int)ctx->grid.size - 1) end = (int)ctx->grid.size - 1;
+    for(i=beg;i<=end;++i){
+        double r = pixel_resid(ctx, i);
+        ctx->chi2 += r - ctx->resid[i];
+        ctx->resid[i] = r;
+    }
+}
+
+static void refresh_resid_all(spec_context *ctx){
+    /*pixels outside the regions have no chi2 term, and the regions are active*/
+    size_t k;
+    int i;
+    ctx->chi2 = 0.0;
+    for(k=0;k<ctx->len_active;++k){
+        for(i=ctx->active[k].start;i<ctx->active[k].end;++i){
+            ctx->resid[i] = pixel_resid(ctx, i);
+            ctx->chi2 += ctx->resid[i];
+        }
+    }
+}
+
+static void mark_dirty(spec_context *ctx, int lpix, int hpix){
+    if (lpix > hpix) return;
+    if (ctx->dirty_lpix > ctx->dirty_hpix){
+        ctx->dirty_lpix = lpix;
+        ctx->dirty_hpix = hpix;
+        return;
+    }
+    if (lpix < ctx->dirty_lpix) ctx->dirty_lpix = lpix;
+    if (hpix > ctx->dirty_hpix) ctx->dirty_hpix = hpix;
+}
+
+static void refresh(spec_context *ctx, int lpix, int hpix){
+    /*redo absorbed flux and chi2 over the active pixels in lpix..hpix after tau or the continuum changed there*/
+    size_t k;
+    int i;
+    for(k=0;k<ctx->len_active;++k){
+        int beg = ctx->active[k].start > lpix ? ctx->active[k].start : lpix;
+        int end = ctx->active[k].end - 1 < hpix ? ctx->active[k].end - 1 : hpix;
+        if (beg > end) continue;
+        mark_dirty(ctx, beg, end);
+        for(i=beg;i<=end;++i){
+            ctx->absorption[i] = ctx->continuum[i]*exp(-ctx->tau[i]);
+        }
+        refresh_resid(ctx, beg, end);
+    }
+}
+
+static void refresh_all(spec_context *ctx){
+    size_t k;
+    int i;
+    for(k=0;k<ctx->len_active;++k){
+        mark_dirty(ctx, ctx->active[k].start, ctx->active[k].end - 1);
+        for(i=ctx->active[k].start;i<ctx->active[k].end;++i){
+            ctx->absorption[i] = ctx->continuum[i]*exp(-ctx->tau[i]);
+        }
+    }
+    refresh_resid_all(ctx);
+}
+
+static void free_lines(spec_context *ctx){
+    size_t k;
+    for(k=0;k<ctx->len_lines;++k){
+        free(ctx->lines[k].tau);
+    }
+    free(ctx->lines);
+    free(ctx->changed);
+    ctx->lines = NULL;
+    ctx->changed = NULL;
+    ctx->len_lines = 0;
+}
+
+static void move_points(spec_context *ctx, continuum_point cont_points[], size_t len){
+    /*
+    only y changed: redraw the spans each moved point influences, merging
+    overlapping runs, and redo absorbed flux and chi2 under them
+    */
+    int i, n = (int)len;
+    int fspan = 0, lspan = -1;
+    int lpix, hpix;
+
+    for(i=0;i<=n;++i){
+        bool moved = i < n && cont_points[i].y != ctx->cont_points[i].y;
+        if (moved){
+            ctx->cont_points[i].y = cont_points[i].y;
+            if (lspan >= fspan && i-2 <= lspan+1){
+                lspan = i+1;
+                continue;
+            }
+        }
+        if ((moved || i == n) && lspan >= fspan){
+            if (update_spans(fspan, lspan, ctx->cont_points, ctx->continuum, &ctx->grid, len, &lpix, &hpix) == 0){
+                refresh(ctx, lpix, hpix);
+            }
+            lspan = -1;
+        }
+        if (moved){
+            fspan = i-2;
+            lspan = i+1;
+        }
+    }
+}
+
+static int store_lines(spec_context *ctx, absorber lines[], const int which[], int num){
+    /*
+    store_line for lines[which[0..num-1]], split between threads.  each
+    thread walks its lines through its own slice of scratch
+    */
+    int nthreads = get_num_threads();
+    int failed = 0;
+    if (nthreads > num) nthreads = num > 0 ? num : 1;
+    if (nthreads > ctx->len_scratch){
+        double *scratch = (double*)realloc(ctx->scratch, nthreads*ctx->grid.size*sizeof(double));
+        if (scratch == NULL){
+            return -1;
+        }
+        ctx->scratch = scratch;
+        ctx->len_scratch = nthreads;
+    }
+
+    #pragma omp parallel num_threads(nthreads) if(nthreads > 1)
+    {
+        double *scratch = ctx->scratch + thread_id()*ctx->grid.size;
+        int j;
+        #pragma omp for schedule(dynamic, 4)
+        for(j=0;j<num;++j){
+            int k = which[j];
+            if (store_line(ctx, &ctx->lines[k], &lines[k], scratch) < 0){
+                #pragma omp atomic write
+                failed = 1;
+            }
+        }
+    }
+    return failed ? -1 : 0;
+}
+
+static int set_lines(spec_context *ctx, absorber lines[], size_t len_lines){
+    /*start over with a new set of lines*/
+    size_t k;
+    free_lines(ctx);
+    if (len_lines == 0){
+        return 0;
+    }
+    ctx->lines = (line_state*)calloc(len_lines, sizeof(line_state));
+    ctx->changed = (int*)malloc(len_lines*sizeof(int));
+    if (ctx->lines == NULL || ctx->changed == NULL){
+        return -1;
+    }
+    ctx->len_lines = len_lines;
+    for(k=0;k<len_lines;++k){
+        ctx->changed[k] = (int)k;
+    }
+    return store_lines(ctx, lines, ctx->changed, (int)len_lines);
+}
+
+static int set_points(spec_context *ctx, continuum_point cont_points[], size_t len){
+    int i;
+    continuum_point *pts = (continuum_point*)realloc(ctx->cont_points, (len > 0 ? len : 1)*sizeof(continuum_point));
+    if (pts == NULL){
+        return -1;
+    }
+    if (len > 0){
+        memcpy(pts, cont_points, len*sizeof(continuum_point));
+    }
+    ctx->cont_points = pts;
+    ctx->len_cont_points = len;
+    memset(ctx->continuum, 0, ctx->grid.size*sizeof(double));
+    if (!ctx->restricted){
+        fill_continuum(cont_points, &ctx->grid, len, ctx->continuum);
+        return 0;
+    }
+    /*only the spline spans over active pixels, see fill_continuum*/
+    for(i=1;i+3<=(int)len;++i){
+        double x0, x1;
+        effectRegion(i, cont_points, &x0, &x1);
+        if (overlaps_active(ctx, grid_index(&ctx->grid, x0) + 1, grid_index(&ctx->grid, x1))){
+            compute(i, i, cont_points, ctx->continuum, &ctx->grid);
+        }
+    }
+    return 0;
+}
+
+static int set_active(spec_context *ctx){
+    /*
+    work out the active pixels for the current regions, line spread function
+    and mode.  the model at pixel i sees absorption[i + lsf_lo .. i + lsf_hi],
+    so a region [start, end) needs those pixels of every one of its own.
+    anything evaluated before is thrown away
+    */
+    size_t num = 0;
+    int size = (int)ctx->grid.size;
+    index_pair *active = (index_pair*)malloc((ctx->len_pairs > 0 ? ctx->len_pairs : 1)*sizeof(index_pair));
+    if (active == NULL){
+        return -1;
+    }
+    if (!ctx->restricted){
+        active[num++] = (index_pair){.start=0, .end=size};
+    }else{
+        unsigned short *covered = ctx->weight;
+        int lo = ctx->lsf_lo;
+        int hi = ctx->lsf_hi;
+        int j = 0;
+        /*weight is nonzero exactly over the regions, walk its runs in order*/
+        while (j < size){
+            int beg, end;
+            if (covered[j] == 0){
+                ++j;
+                continue;
+            }
+            beg = j;
+            while (j < size && covered[j] > 0) ++j;
+            end = j;
+            beg = beg + lo < 0 ? 0 : beg + lo;
+            end = end + hi > size ? size : end + hi;
+            if (num > 0 && active[num-1].end >= beg){
+                active[num-1].end = end > active[num-1].end ? end : active[num-1].end;
+                continue;
+            }
+            active[num++] = (index_pair){.start=beg, .end=end};
+        }
+    }
+    free(ctx->active);
+    ctx->active = active;
+    ctx->len_active = num;
+    ctx->valid = false;
+    memset(ctx->absorption, 0, ctx->grid.size*sizeof(double));
+    memset(ctx->resid, 0, ctx->grid.size*sizeof(double));
+    return 0;
+}
+
+int context_set_restricted(spec_context *ctx, bool restricted){
+    /*
+    evaluate only the pixels chi2 depends on (true), or the whole spectrum
+    (false, the default).  returns -1 if out of memory
+    */
+    if (restricted == ctx->restricted){
+        return 0;
+    }
+    ctx->restricted = restricted;
+    return set_active(ctx);
+}
+
+int context_init(spec_context *ctx, const wave_grid *grid,
+                 const double flux[], const double err[]){
+    memset(ctx, 0, sizeof(spec_context));
+    ctx->grid = *grid;
+    ctx->flux = flux;
+    ctx->err = err;
+    ctx->weight = (unsigned short*)calloc(grid->size, sizeof(unsigned short));
+    ctx->continuum = (double*)calloc(grid->size, sizeof(double));
+    ctx->absorption = (double*)calloc(grid->size, sizeof(double));
+    ctx->tau = (double*)calloc(grid->size, sizeof(double));
+    ctx->resid = (double*)calloc(grid->size, sizeof(double));
+    ctx->scratch = (double*)calloc(grid->size, sizeof(double));
+    ctx->len_scratch = 1;
+    if (ctx->weight == NULL || ctx->continuum == NULL || ctx->absorption == NULL ||
+        ctx->tau == NULL || ctx->resid == NULL || ctx->scratch == NULL){
+        context_free(ctx);
+        return -1;
+    }
+    /*no line spread function until one is set*/
+    if (context_set_lsf(ctx, NULL, 0, 0) < 0 || set_active(ctx) < 0){
+        context_free(ctx);
+        return -1;
+    }
+    return 0;
+}
+
+int context_set_lsf(spec_context *ctx, const double kernel[], int len_kernel, int offset){
+    /*
+    the model is compared to the data after convolving with kernel, as
+    model[i] = sum_k absorption[i + offset - k]*kernel[k].  offset
+    (len_kernel-1)/2 centers an odd kernel.  an empty kernel turns the line
+    spread function off
+    */
+    int start = 0;
+    return context_set_lsf_segments(ctx, &start, kernel, &len_kernel, &offset, 1);
+}
+
+int context_set_lsf_segments(spec_context *ctx, const int starts[], const double kernels[],
+                             const int lens[], const int offsets[], size_t len_lsf){
+    /*
+    a line spread function that varies along the spectrum, e.g. for a coadd
+    of several settings.  segment k convolves with lens[k] values of kernels,
+    following the previous segment's, from pixel starts[k] up to the next
+    segment's start (see context_set_lsf).  starts are increasing, and the
+    first segment also covers any pixels before its start.  returns -1 if out
+    of memory
+    */
+    size_t k, total = 0;
+    lsf_segment *lsf;
+    double *copy;
+    for(k=0;k<len_lsf;++k){
+        total += lens[k] > 0 ? lens[k] : 1;
+    }
+    lsf = (lsf_segment*)malloc((len_lsf > 0 ? len_lsf : 1)*sizeof(lsf_segment));
+    copy = (double*)malloc((total > 0 ? total : 1)*sizeof(double));
+    if (lsf == NULL || copy == NULL){
+        free(lsf);
+        free(copy);
+        return -1;
+    }
+    if (len_lsf == 0){
+        copy[0] = 1.0;
+        lsf[0] = (lsf_segment){.start=0, .kernel=copy, .len_kernel=1, .offset=0};
+        len_lsf = 1;
+    }else{
+        double *pos = copy;
+        for(k=0;k<len_lsf;++k){
+            if (lens[k] > 0){
+                memcpy(pos, kernels, lens[k]*sizeof(double));
+                lsf[k] = (lsf_segment){.start=starts[k], .kernel=pos, .len_kernel=lens[k], .offset=offsets[k]};
+                kernels += lens[k];
+                pos += lens[k];
+            }else{
+                *pos = 1.0;
+                lsf[k] = (lsf_segment){.start=starts[k], .kernel=pos, .len_kernel=1, .offset=0};
+                ++pos;
+            }
+        }
+    }
+    free(ctx->lsf);
+    free(ctx->kernels);
+    ctx->lsf = lsf;
+    ctx->len_lsf = len_lsf;
+    ctx->kernels = copy;
+    ctx->lsf_lo = lsf[0].offset - lsf[0].len_kernel + 1;
+    ctx->lsf_hi = lsf[0].offset;
+    for(k=1;k<len_lsf;++k){
+        int lo = lsf[k].offset - lsf[k].len_kernel + 1;
+        if (lo < ctx->lsf_lo) ctx->lsf_lo = lo;
+        if (lsf[k].offset > ctx->lsf_hi) ctx->lsf_hi = lsf[k].offset;
+    }
+    if (ctx->restricted){
+        return set_active(ctx);
+    }
+    if (ctx->valid){
+        refresh_resid_all(ctx);
+    }
+    return 0;
+}
+
+int context_set_background(spec_context *ctx, const absorber lines[], size_t len_lines){
+    /*
+    lines that stay fixed while fitting, e.g. absorbers with every parameter
+    locked.  their summed optical depth is computed once, here, and each
+    evaluation starts from it instead of carrying them as lines.  setting
+    the same lines again does nothing.  returns -1 if out of memory
+    */
+    size_t k;
+    int i, lpix, hpix;
+    absorber *copy;
+
+    if (len_lines == ctx->len_bg_lines){
+        for(k=0;k<len_lines && same_line(&ctx->bg_lines[k], &lines[k]);++k);
+        if (k == len_lines){
+            return 0;
+        }
+    }
+    copy = (absorber*)malloc((len_lines > 0 ? len_lines : 1)*sizeof(absorber));
+    if (copy == NULL){
+        return -1;
+    }
+    if (ctx->background == NULL){
+        ctx->background = (double*)malloc(ctx->grid.size*sizeof(double));
+        if (ctx->background == NULL){
+            free(copy);
+            return -1;
+        }
+    }
+    if (len_lines > 0){
+        memcpy(copy, lines, len_lines*sizeof(absorber));
+    }
+    free(ctx->bg_lines);
+    ctx->bg_lines = copy;
+    ctx->len_bg_lines = len_lines;
+
+    memset(ctx->background, 0, ctx->grid.size*sizeof(double));
+    for(k=0;k<len_lines;++k){
+        line_tau(&ctx->grid, &lines[k], ctx->scratch, &lpix, &hpix);
+        for(i=lpix;i<=hpix;++i){
+            ctx->background[i] += ctx->scratch[i];
+        }
+    }
+    ctx->valid = false;
+    return 0;
+}
+
+void context_convolved(const spec_context *ctx, double out[]){
+    /*
+    the whole absorbed spectrum seen through the line spread function.  in
+    restricted mode only the region pixels are filled in, the rest are zero
+    */
+    size_t i;
+    for(i=0;i<ctx->grid.size;++i){
+        out[i] = !ctx->restricted || ctx->weight[i] > 0 ? lsf_value(ctx, (int)i) : 0.0;
+    }
+}
+
+int context_set_regions(spec_context *ctx, const int starts[], const int ends[], size_t len_pairs){
+    /*pixel pairs are clipped to the grid*/
+    size_t i;
+    int size = (int)ctx->grid.size;
+    index_pair *pairs = (index_pair*)malloc((len_pairs > 0 ? len_pairs : 1)*sizeof(index_pair));
+    if (pairs == NULL){
+        return -1;
+    }
+    for(i=0;i<len_pairs;++i){
+        int beg = starts[i] < 0 ? 0 : starts[i];
+        int end = ends[i] > size ? size : ends[i];
+        pairs[i] = (index_pair){.start=beg, .end=(end > beg ? end : beg)};
+    }
+    free(ctx->pairs);
+    ctx->pairs = pairs;
+    ctx->len_pairs = len_pairs;
+
+    memset(ctx->weight, 0, ctx->grid.size*sizeof(unsigned short));
+    for(i=0;i<len_pairs;++i){
+        int j;
+        for(j=pairs[i].start;j<pairs[i].end;++j){
+            ctx->weight[j] += 1;
+        }
+    }
+    if (ctx->restricted){
+        return set_active(ctx);
+    }
+    if (ctx->valid){
+        refresh_resid_all(ctx);
+    }
+    return 0;
+}
+
+double context_evaluate(spec_context *ctx, 
+                        continuum_point cont_points[], size_t len_cont_points,
+                        absorber lines[], size_t len_lines){
+    /*
+    fill the context's continuum and absorption buffers for the given
+    continuum points (sorted by x) and lines, return chi2 over the regions,
+    or -1 if out of memory.  chi2 compares the flux to the absorption
+    convolved with the line spread function, skipping pixels where that
+    isn't finite.
+
+    the optical depth of every line is kept from the previous call, so only
+    lines whose parameters changed are recomputed, and absorbed flux and chi2
+    are only redone over their pixel windows.  a different number of lines
+    or continuum points means starting over.
+    */
+    size_t k;
+    int num_changed;
+    points_change change = ctx->valid ? compare_points(ctx, cont_points, len_cont_points) : POINTS_CHANGED;
+    bool cont_changed = change == POINTS_CHANGED;
+
+    ctx->dirty_lpix = 0;
+    ctx->dirty_hpix = -1;
+    if (cont_changed && set_points(ctx, cont_points, len_cont_points) < 0){
+        ctx->valid = false;
+        return -1.0;
+    }
+
+    if (!ctx->valid || len_lines != ctx->len_lines){
+        if (set_lines(ctx, lines, len_lines) < 0){
+            ctx->valid = false;
+            return -1.0;
+        }
+        rebuild_tau(ctx);
+        refresh_all(ctx);
+        ctx->valid = true;
+        return ctx->chi2;
+    }
+
+    if (change == POINTS_MOVED_Y){
+        move_points(ctx, cont_points, len_cont_points);
+    }
+
+    /*take the changed lines out of tau, recompute them, and put them back*/
+    num_changed = 0;
+    for(k=0;k<len_lines;++k){
+        line_state *st = &ctx->lines[k];
+        if (same_line(&st->line, &lines[k])) continue;
+        ctx->changed[num_changed++] = (int)k;
+        st->prev_lpix = st->lpix;
+        st->prev_hpix = st->hpix;
+        add_line(ctx, st, -1.0);
+    }
+    if (store_lines(ctx, lines, ctx->changed, num_changed) < 0){
+        ctx->valid = false;
+        return -1.0;
+    }
+    for(k=0;k<(size_t)num_changed;++k){
+        line_state *st = &ctx->lines[ctx->changed[k]];
+        int lpix = st->prev_lpix, hpix = st->prev_hpix;
+        add_line(ctx, st, 1.0);
+        ctx->updates += 1;
+
+        if (!cont_changed){
+            /*union of the old and new windows*/
+            if (lpix > hpix){
+                lpix = st->lpix;
+                hpix = st->hpix;
+            }else if (st->lpix <= st->hpix){
+                lpix = st->lpix < lpix ? st->lpix : lpix;
+                hpix = st->hpix > hpix ? st->hpix : hpix;
+            }
+            refresh(ctx, lpix, hpix);
+        }
+    }
+
+    if (ctx->updates >= REBUILD_EVERY){
+        rebuild_tau(ctx);
+        cont_changed = true;
+    }
+    if (cont_changed){
+        refresh_all(ctx);
+    }
+    return ctx->chi2;
+}
+
+int context_region_pixels(const spec_context *ctx, int pixels[]){
+    /*pixels inside any fit region, in order, written to pixels unless it is NULL.  returns how many*/
+    size_t i;
+    int num = 0;
+    for(i=0;i<ctx->grid.size;++i){
+        if (ctx->weight[i] == 0) continue;
+        if (pixels != NULL) pixels[num] = (int)i;
+        ++num;
+    }
+    return num;
+}
+
+static void add_column(const spec_context *ctx, const double buf[], int lpix, int hpix,
+                       const int row_of[], int col, int len_columns, bool lsf, double jac[]){
+    /*
+    add the derivative of absorbed flux held in buf[lpix..hpix] (zero
+    elsewhere) to column col of jac, convolving it first if lsf is set
+    */
+    int i;
+    if (lsf){
+        int beg = lpix - ctx->lsf_hi;
+        int end = hpix - ctx->lsf_lo;
+        if (beg < 0) beg = 0;
+        if (end > (int)ctx->grid.size - 1) end = (int)ctx->grid.size - 1;
+        for(i=beg;i<=end;++i){
+            if (row_of[i] < 0) continue;
+            jac[(size_t)row_of[i]*len_columns + col] += convolve_at(ctx, buf, i);
+        }
+    }else{
+        for(i=lpix;i<=hpix;++i){
+            if (row_of[i] < 0) continue;
+            jac[(size_t)row_of[i]*len_columns + col] += buf[i];
+        }
+    }
+}
+
+double context_jacobian(spec_context *ctx,
+                     continuum_point cont_points[], size_t len_cont_points,
+                     absorber lines[], size_t len_lines,
+                     const int line_columns[], const int point_columns[], int len_columns,
+                     bool lsf, double model[], double jac[]){
+    /*
+    evaluate the model as context_evaluate does, and also its derivatives
+    over the region pixels (see context_region_pixels).  model gets the
+    absorbed flux there, row i of jac (len_columns wide, zeroed by the
+    caller) its derivatives.
+
+    line_columns holds three columns per line, for N, b and z, and
+    point_columns one per continuum point, for y.  -1 leaves a parameter
+    out, and lines sharing a column (the transitions of one absorber) add
+    up in it.  with lsf set, model and jac are convolved with the line
+    spread function, as chi2 is.  returns chi2, or -1 if out of memory.
+    */
+    size_t k;
+    int i, p;
+    int size = (int)ctx->grid.size;
+    double chi2 = context_evaluate(ctx, cont_points, len_cont_points, lines, len_lines);
+    int *row_of = (int*)malloc(size*sizeof(int));
+    double *buf = (double*)calloc(3*(size_t)size, sizeof(double));
+    continuum_point *unit = (continuum_point*)malloc((len_cont_points > 0 ? len_cont_points : 1)*sizeof(continuum_point));
+    double *dtau_db = buf + size, *dtau_dz = buf + 2*size;
+
+    if (chi2 < 0.0 || row_of == NULL || buf == NULL || unit == NULL){
+        free(row_of);
+        free(buf);
+        free(unit);
+        return -1.0;
+    }
+
+    p = 0;
+    for(i=0;i<size;++i){
+        row_of[i] = ctx->weight[i] > 0 ? p++ : -1;
+        if (row_of[i] >= 0){
+            model[row_of[i]] = lsf ? lsf_value(ctx, i) : ctx->absorption[i];
+        }
+    }
+
+    /*d(absorption)/d(param) = -absorption*d(tau)/d(param)*/
+    for(k=0;k<len_lines;++k){
+        const line_state *st = &ctx->lines[k];
+        const int *cols = line_columns + 3*k;
+        if (st->lpix > st->hpix) continue;
+        if (cols[1] >= 0 || cols[2] >= 0){
+            line_gradient(&ctx->grid, &st->line, st->lpix, st->hpix, st->tau, dtau_db, dtau_dz);
+        }
+        for(p=0;p<3;++p){
+            const double *dtau = p == 0 ? st->tau : (p == 1 ? dtau_db : dtau_dz);
+            double scale = p == 0 ? -log(10.0) : -1.0;
+            if (cols[p] < 0) continue;
+            for(i=st->lpix;i<=st->hpix;++i){
+                buf[i] = scale*ctx->absorption[i]*dtau[i - st->lpix];
+            }
+            add_column(ctx, buf, st->lpix, st->hpix, row_of, cols[p], len_columns, lsf, jac);
+            memset(buf + st->lpix, 0, (st->hpix - st->lpix + 1)*sizeof(double));
+        }
+    }
+
+    /*
+    the continuum is linear in the y's, so its derivative with respect to
+    one is the spline drawn through a unit y there and zero elsewhere
+    */
+    for(k=0;k<len_cont_points;++k){
+        unit[k] = (continuum_point){.x=cont_points[k].x, .y=0.0};
+    }
+    for(k=0;k<len_cont_points;++k){
+        int lpix, hpix;
+        if (point_columns[k] < 0) continue;
+        unit[k].y = 1.0;
+        if (update_spans((int)k-2, (int)k+1, unit, buf, &ctx->grid, len_cont_points, &lpix, &hpix) == 0
+            && lpix <= hpix){
+            for(i=lpix;i<=hpix;++i){
+                buf[i] *= exp(-ctx->tau[i]);
+            }
+            add_column(ctx, buf, lpix, hpix, row_of, point_columns[k], len_columns, lsf, jac);
+            memset(buf + lpix, 0, (hpix - lpix + 1)*sizeof(double));
+        }
+        unit[k].y = 0.0;
+    }
+
+    free(row_of);
+    free(buf);
+    free(unit);
+    return chi2;
+}
+
+void context_reset(spec_context *ctx){
+    /*forget the cached line windows, the next evaluation starts over*/
+    ctx->valid = false;
+}
+
+void context_free(spec_context *ctx){
+    free_lines(ctx);
+    free(ctx->cont_points);
+    free(ctx->weight);
+    free(ctx->continuum);
+    free(ctx->absorption);
+    free(ctx->tau);
+    free(ctx->background);
+    free(ctx->bg_lines);
+    free(ctx->resid);
+    free(ctx->scratch);
+    free(ctx->lsf);
+    free(ctx->kernels);
+    free(ctx->pairs);
+    free(ctx->active);
+    ctx->cont_points = NULL;
+    ctx->len_cont_points = 0;
+    ctx->weight = NULL;
+    ctx->continuum = NULL;
+    ctx->absorption = NULL;
+    ctx->tau = NULL;
+    ctx->background = NULL;
+    ctx->bg_lines = NULL;
+    ctx->len_bg_lines = 0;
+    ctx->resid = NULL;
+    ctx->scratch = NULL;
+    ctx->lsf = NULL;
+    ctx->len_lsf = 0;
+    ctx->kernels = NULL;
+    ctx->pairs = NULL;
+    ctx->len_pairs = 0;
+    ctx->active = NULL;
+    ctx->len_active = 0;
+    ctx->valid = false;
+}
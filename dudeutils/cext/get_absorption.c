@@ -1,134 +1,349 @@
 #include<stdio.h>
 #include<math.h>
 #include<stdlib.h>
+#include<string.h>
 #include"spectrum.h"
 
 const double c = 2.99792458E5;
 const double pi=3.14159265359;
-  
-int sub_absorber(   const double waves[], double cont[],
-                    double N, double b, double z, 
-                    double f, double Gamma, double restWave, 
-                    bool subFlag, size_t size){
+static const double tau_threshold = 0.001;  /*line windows end where tau drops below this*/
 
+static voigt_method line_method(double factor, double alpha){
     /*
-    subtract absorption from continuum level given some absorber
-    caller is responsible for initializing flux
+    the voigt method a line is evaluated with.  the damping wings,
+    factor*a/(sqrt(pi)*v^2), stay under the threshold everywhere outside the
+    core for weak lines.  those can use the gaussian alone with VOIGT_FAST,
+    anything stronger needs the full profile
+    */
+    voigt_method m = get_voigt_method();
+    if (m == VOIGT_FAST && factor*alpha/sqrt(pi) >= tau_threshold){
+        return VOIGT_HUMLICEK;
+    }
+    return m;
+}
+  
+int line_tau(const wave_grid *grid, const absorber *line, double tau[], int *lpix, int *hpix){
 
+    /*
+    optical depth of one line, written to tau[*lpix] .. tau[*hpix] (inclusive).
+    the window is empty (*lpix > *hpix) if the line center falls off the grid.
+    tau is scratch space: pixels just outside the window may be overwritten.
+
+    the window is where tau stays above tau_threshold walking out from the
+    center.  it is estimated from the gaussian core and the damping wings,
+    the profile is evaluated over all of it at once with the voigt method
+    chosen by set_voigt_method, and then trimmed (or widened and redone if
+    the estimate was short).
     */
 
-    double tau_threshold = 0.001;
+    double N = line->N, b = line->b, z = line->z;
+    double f = line->f, Gamma = line->gamma, restWave = line->rest;
 
     double cwave = (1.0+z)*restWave;
     double vdopp = b/cwave*1.0e13;
     double alpha = Gamma/(4.0*pi*vdopp)/(1.0+z);    
     double factor = pow(10.0, N) * 2.647E-2 * f/(sqrt(pi)*vdopp) * 1.0/(1.0+z);
-    int i=0;
-    int cpix = get_wave_index(waves, size, cwave);
+    const double *waves = grid->waves;
+    int size = (int)grid->size;
+    int i=0, j;
+    int cpix = grid_index(grid, cwave);
+    voigt_method m = line_method(factor, alpha);
+
+    *lpix = 0;
+    *hpix = -1;
 
     if (cpix >= size-3){
         fprintf(stderr,"cext/get_absorption.c: center pix too big: %d out of %d pixels for %5.1lf\n",(int)cpix,(int)size,cwave);
-        return 0;
+        return -1;
     }
     if (cpix < 1){
         fprintf(stderr,"cext/get_absorption.c: center pix too small: %d out of %d pixelsfor %5.1lf\n",(int)cpix,(int)size,cwave);
-        return 0;
+        return -1;
     }
 
-
-    double tau;
+    double t, h;
     double wave_high = (waves[cpix] + waves[cpix+1])/2.;
     double wave_low  = (waves[cpix] + waves[cpix-1])/2.;
 
-    int nsamp = 10;
+    enum { nsamp = 10 };
+    double samp[nsamp];
     double delta_wave = (wave_high - wave_low)/nsamp;
 
     double tau_sum = 0.0;
 
     for (i=0; i<nsamp;  ++i) {
         double wave_i = wave_low + i*delta_wave;
-        double vbar = c/b * (wave_i/cwave - 1.0);
-        tau_sum += factor*voigt(vbar, alpha);
+        samp[i] = c/b * (wave_i/cwave - 1.0);
     } 
+    voigt_array(samp, samp, nsamp, alpha, m);
+    for (i=0; i<nsamp;  ++i) {
+        tau_sum += factor*samp[i];
+    }
+    double tau_center = tau_sum / nsamp;
+
+    /*walking right starts from the profile at the center pixel itself*/
+    h = c/b * (waves[cpix]/cwave - 1.0);
+    voigt_array(&h, &h, 1, alpha, m);
+    double tau_start = factor*h;
+
+    double ratio = factor/tau_threshold;
+    double vcore = ratio > 1.0 ? sqrt(log(ratio)) : 0.0;
+    double vwing = sqrt(ratio*alpha/sqrt(pi));
+    double vmax = sqrt(vcore*vcore + vwing*vwing);
+
+    for (;;){
+        double dwave = cwave*vmax*b/c;
+        int L = grid_index(grid, cwave - dwave) - 2;
+        int R = grid_index(grid, cwave + dwave) + 2;
+        bool wide_enough = true;
+        if (L < 1) L = 1;
+        if (L > cpix) L = cpix;
+        if (R > size-3) R = size-3;
+        if (R < cpix) R = cpix;
+
+        /*
+        pixel j averages the profile at its two edges, (waves[j-1]+waves[j])/2
+        and (waves[j]+waves[j+1])/2.  tau[j] first holds the upper one
+        */
+        for (j=L; j<=R; ++j){
+            double wave_edge = (waves[j] + waves[j+1])/2;
+            tau[j] = c/b * (wave_edge/cwave - 1.0);
+        }
+        voigt_array(tau + L, tau + L, (size_t)(R - L + 1), alpha, m);
+        h = c/b * ((waves[L] + waves[L-1])/2/cwave - 1.0);
+        voigt_array(&h, &h, 1, alpha, m);
+        for (j=R; j>L; --j){
+            tau[j] = (factor*tau[j-1] + factor*tau[j])/2;
+        }
+        tau[L] = (factor*h + factor*tau[L])/2;
+        tau[cpix] = tau_center;
+
+        int lo = cpix;
+        t = tau_center;
+        while (t > tau_threshold && lo > 1) {
+            lo -= 1;
+            if (lo < L){
+                wide_enough = false;
+                break;
+            }
+            t = tau[lo];
+        }
+
+        //
+        // Now walk the other way ...
+        int hi = cpix;
+        t = tau_start;
+        while (wide_enough && t > tau_threshold && hi < size-3) {
+            hi += 1;
+            if (hi > R){
+                wide_enough = false;
+                break;
+            }
+            t = tau[hi];
+        }
+
+        if (wide_enough){
+            *lpix = lo;
+            *hpix = hi;
+            return 0;
+        }
+        vmax = 2.0*vmax + 1.0;
+    }
+}
 
-    tau = tau_sum / nsamp;
-
-    //if (subFlag) cont[cpix] -= tau;
-    //else         cont[cpix] += tau;
-    if (subFlag) cont[cpix] /= exp(tau);
-    else         cont[cpix] *= exp(tau);
-
+void line_reach(const wave_grid *grid, const absorber *line, int *lpix, int *hpix){
+    /*
+    pixels lpix..hpix that line_tau's window for this line can't extend
+    past, without evaluating the profile.  the profile is bounded by its
+    gaussian core and damping wings, factor*(exp(-v^2) + a/(sqrt(pi)*v^2)),
+    and the reach is taken well past where that bound drops under
+    tau_threshold
+    */
+    double N = line->N, b = line->b, z = line->z;
+    double f = line->f, Gamma = line->gamma, restWave = line->rest;
 
-    int lpix = cpix;
-    while (tau > tau_threshold && lpix > 1) {
-        lpix -= 1;
-        double wave_high = (waves[lpix] + waves[lpix+1])/2;
-        double wave_low  = (waves[lpix] + waves[lpix-1])/2;
+    double cwave = (1.0+z)*restWave;
+    double vdopp = b/cwave*1.0e13;
+    double alpha = Gamma/(4.0*pi*vdopp)/(1.0+z);
+    double factor = pow(10.0, N) * 2.647E-2 * f/(sqrt(pi)*vdopp) * 1.0/(1.0+z);
 
-        double vbar = c/b * (wave_low/cwave - 1.0);
-        double tau_low = factor*voigt(vbar, alpha);
+    double ratio = 4.0*factor/tau_threshold;
+    double vcore = ratio > 1.0 ? sqrt(log(ratio)) : 0.0;
+    double vwing = sqrt(ratio*alpha/sqrt(pi));
+    double vmax = 2.0*sqrt(vcore*vcore + vwing*vwing) + 1.0;
+    double dwave = cwave*vmax*b/c;
 
-        vbar = c/b * (wave_high/cwave - 1.0);
-        double tau_high = factor*voigt(vbar, alpha);
+    *lpix = grid_index(grid, cwave - dwave) - 2;
+    *hpix = grid_index(grid, cwave + dwave) + 2;
+    if (*lpix < 0) *lpix = 0;
+    if (*hpix > (int)grid->size - 1) *hpix = (int)grid->size - 1;
+}
 
-        tau = (tau_low + tau_high)/2;
+static void gradient_sample(double wave, double cwave, double b, double z, double alpha,
+                            double factor, voigt_method m, double *dtau_db, double *dtau_dz){
+    /*
+    parts of d(tau)/db and d(tau)/dz at one wavelength that come from the
+    profile's shape.  factor and alpha do not depend on z, and both go as
+    1/b, as does v = c/b*(wave/cwave - 1)
+    */
+    double v = c/b * (wave/cwave - 1.0);
+    double dh_dv, dh_da;
+    voigt_gradient(v, alpha, m, &dh_dv, &dh_da);
+    *dtau_db = -factor/b*(v*dh_dv + alpha*dh_da);
+    *dtau_dz = -factor*dh_dv*c/b*wave/(cwave*(1.0+z));
+}
 
-        //if (subFlag) cont[lpix] -= tau;
-        //else         cont[lpix] += tau;
+void line_gradient(const wave_grid *grid, const absorber *line, int lpix, int hpix,
+                   const double tau[], double dtau_db[], double dtau_dz[]){
+    /*
+    derivatives of one line's optical depth with respect to b and z over
+    the window lpix..hpix that line_tau found for it.  tau, dtau_db and
+    dtau_dz hold the window, i.e. index 0 is pixel lpix.  d(tau)/dN is just
+    ln(10)*tau.
+
+    pixels are averaged over the same samples as in line_tau, so these are
+    the derivatives of what it computes, with the profile's slope taken
+    from the same voigt method (see line_method).  the window itself is
+    held fixed.
+    */
+    double N = line->N, b = line->b, z = line->z;
+    double f = line->f, Gamma = line->gamma, restWave = line->rest;
 
-        if (subFlag) cont[lpix] /= exp(tau);
-        else         cont[lpix] *= exp(tau);
+    double cwave = (1.0+z)*restWave;
+    double vdopp = b/cwave*1.0e13;
+    double alpha = Gamma/(4.0*pi*vdopp)/(1.0+z);
+    double factor = pow(10.0, N) * 2.647E-2 * f/(sqrt(pi)*vdopp) * 1.0/(1.0+z);
+    const double *waves = grid->waves;
+    int cpix = grid_index(grid, cwave);
+    voigt_method m = line_method(factor, alpha);
+    int i, j;
+    double db_low, dz_low, db_high, dz_high;
+
+    if (lpix > hpix){
+        return;
+    }
+    gradient_sample((waves[lpix-1] + waves[lpix])/2, cwave, b, z, alpha, factor, m, &db_low, &dz_low);
+    for (j=lpix; j<=hpix; ++j){
+        gradient_sample((waves[j] + waves[j+1])/2, cwave, b, z, alpha, factor, m, &db_high, &dz_high);
+        dtau_db[j-lpix] = (db_low + db_high)/2;
+        dtau_dz[j-lpix] = (dz_low + dz_high)/2;
+        db_low = db_high;
+        dz_low = dz_high;
     }
 
-    //
-    // Now walk the other way ...
-    int hpix = cpix;
-
-    double vbar = c/b * (waves[hpix]/cwave - 1.0);
-    tau = factor*voigt(vbar, alpha);
+    if (cpix >= lpix && cpix <= hpix){
+        enum { nsamp = 10 };
+        double wave_high = (waves[cpix] + waves[cpix+1])/2.;
+        double wave_low  = (waves[cpix] + waves[cpix-1])/2.;
+        double delta_wave = (wave_high - wave_low)/nsamp;
+        dtau_db[cpix-lpix] = 0.0;
+        dtau_dz[cpix-lpix] = 0.0;
+        for (i=0; i<nsamp; ++i){
+            gradient_sample(wave_low + i*delta_wave, cwave, b, z, alpha, factor, m, &db_high, &dz_high);
+            dtau_db[cpix-lpix] += db_high/nsamp;
+            dtau_dz[cpix-lpix] += dz_high/nsamp;
+        }
+    }
 
-    while (tau > tau_threshold && hpix < size-3) {
-        hpix += 1;
+    /*and the profile's overall scale, which goes as 1/b*/
+    for (j=lpix; j<=hpix; ++j){
+        dtau_db[j-lpix] -= tau[j-lpix]/b;
+    }
+}
 
-        double wave_high = (waves[hpix] + waves[hpix+1])/2;
-        double wave_low  = (waves[hpix] + waves[hpix-1])/2;
+int sub_absorber(   const wave_grid *grid, double cont[], double tau[],
+                    const absorber *line, bool subFlag){
 
-        double vbar = c/b * (wave_low/cwave - 1.0);
-        double tau_low = factor*voigt(vbar, alpha);
+    /*
+    subtract absorption from continuum level given some absorber
+    caller is responsible for initializing flux.  tau is grid->size long
+    scratch space
+    */
 
-        vbar = c/b * (wave_high/cwave - 1.0);
-        double tau_high = factor*voigt(vbar, alpha);
+    int i, lpix, hpix;
+    int status = line_tau(grid, line, tau, &lpix, &hpix);
 
-        tau = (tau_low + tau_high)/2;
+    for (i=lpix; i<=hpix; ++i){
+        if (subFlag) cont[i] /= exp(tau[i]);
+        else         cont[i] *= exp(tau[i]);
+    }
+    return status;
+}
 
+double* get_absorption(double cont[], const wave_grid *grid, absorber abs[], 
+                        size_t num_absorbers){
+    /*inputs are arrays of various absorber attributes*/
 
-        //if (subFlag) cont[hpix] -= tau;
-        //else         cont[hpix] += tau;
+    double* absorption = (double*)malloc(grid->size*sizeof(double));
+    fill_absorption(cont, grid, abs, num_absorbers, absorption);
+    return absorption;
+}
 
-        if (subFlag) cont[hpix] /= exp(tau);
-        else         cont[hpix] *= exp(tau);
+void fill_absorption(const double cont[], const wave_grid *grid, absorber abs[], 
+                     size_t num_absorbers, double absorption[]){
+    /*
+    same as get_absorption, but into a caller-owned buffer.  scratch space
+    is allocated for the call, see fill_absorption_into to supply it
+    */
+    int nthreads = get_num_threads();
+    double *tau = (double*)malloc(2*(size_t)nthreads*grid->size*sizeof(double));
+
+    if (tau == NULL){
+        size_t i;
+        for(i=0;i<grid->size;++i){
+            absorption[i]=cont[i];
+        }
+        return;
     }
-    return 0;
+    fill_absorption_into(cont, grid, abs, num_absorbers, absorption, tau, nthreads);
+    free(tau);
 }
 
-double* get_absorption(double cont[], const double waves[], absorber abs[], 
-                        size_t num_absorbers, size_t len_arr){
-    /*inputs are arrays of various absorber attributes*/
+void fill_absorption_into(const double cont[], const wave_grid *grid, absorber abs[], 
+                          size_t num_absorbers, double absorption[],
+                          double tau[], int nthreads){
+    /*
+    absorbed flux into absorption, using tau (2*nthreads*grid->size long,
+    contents ignored) as scratch.  lines are split between at most nthreads
+    threads, each summing optical depth into its own buffer, and the
+    buffers are added up at the end
+    */
 
     int i;
+    size_t len_arr = grid->size;
+    if (nthreads > get_num_threads()) nthreads = get_num_threads();
+    if (nthreads > (int)num_absorbers) nthreads = num_absorbers > 0 ? (int)num_absorbers : 1;
 
-    double* absorption = (double*)malloc(len_arr*sizeof(double));
     for(i=0;i<len_arr;++i){
         absorption[i]=cont[i]; /*initialie absorber flux as continuum level*/
     }
+    for(i=0;i<nthreads;++i){
+        memset(tau + 2*i*len_arr, 0, len_arr*sizeof(double));
+    }
 
-    
+    #pragma omp parallel num_threads(nthreads) if(nthreads > 1)
+    {
+        double *sum = tau + 2*thread_id()*len_arr;
+        double *scratch = sum + len_arr;
+        int k, j, lpix, hpix;
+
+        #pragma omp for schedule(dynamic, 4)
+        for (k=0;k<(int)num_absorbers;k++){ // subtract absorption
+            line_tau(grid, &abs[k], scratch, &lpix, &hpix);
+            for (j=lpix;j<=hpix;++j){
+                sum[j] += scratch[j];
+            }
+        }
+    }
 
-    for (i=0;i<num_absorbers;i++){ // subtract absorption
-        sub_absorber(  waves, absorption, 
-                            abs[i].N,abs[i].b, abs[i].z, 
-                            abs[i].f, abs[i].gamma, abs[i].rest, 
-                            true, len_arr);
+    for (i=1;i<nthreads;++i){
+        double *sum = tau + 2*i*len_arr;
+        size_t j;
+        for (j=0;j<len_arr;++j){
+            tau[j] += sum[j];
+        }
+    }
+    for(i=0;i<len_arr;++i){
+        absorption[i] *= exp(-tau[i]);
     }
-    return absorption;
 }
@@ -4,20 +4,29 @@
 #include<stdlib.h>
 
 double* get_continuum(  continuum_point cont_points[], 
-                    const double waves[], 
-                    size_t pts_size, size_t arr_size){
+                    const wave_grid *grid, 
+                    size_t pts_size){
     /* continuum points must be pre-sorted by x*/
 
-    double* continuum=(double*)malloc(arr_size*sizeof(double));
+    double* continuum=(double*)calloc(grid->size, sizeof(double));
     //memcpy(continuum, waves);
 
-    compute(1, pts_size-3, cont_points, continuum, waves, arr_size);
+    fill_continuum(cont_points, grid, pts_size, continuum);
     return continuum;
 }
 
+void fill_continuum(continuum_point cont_points[], const wave_grid *grid,
+                    size_t pts_size, double continuum[]){
+    /* same as get_continuum, but into a caller-owned buffer.  pixels 
+       outside of the spline are left untouched*/
+    if (pts_size < 4){
+        return;
+    }
+    compute(1, pts_size-3, cont_points, continuum, grid);
+}
+
 void compute(int fpoint, int lpoint, continuum_point cont_points[], 
-            double continuum[], const double waves[], 
-            size_t arr_size){
+            double continuum[], const wave_grid *grid){
     /*calculate continuum for given start and end point*/
 
     int bSplineNDiv, i,j,k;
@@ -41,38 +50,60 @@ void compute(int fpoint, int lpoint, continuum_point cont_points[],
                       y0 += splineBasis(k, t0) * point.y;
                       y1 += splineBasis(k, t1) * point.y;
                 }
-                setContinLine(x0, x1, y0, y1, waves, continuum, arr_size);
+                setContinLine(x0, x1, y0, y1, grid, continuum);
           }
     }
 }
 
-void effectRegion(int i, continuum_point cont_points[]) {
+void effectRegion(int i, continuum_point cont_points[], double *x0, double *x1) {
+    /*wavelength extent of spline span i, i.e. what compute(i, i, ...) covers*/
     double t0 = 0;
     double t1 = 1;
     int k;
-    double x0 = 0.0;
-    double y0 = 0.0;
-    double x1 = 0.0;
-    double y1 = 0.0;
+    *x0 = 0.0;
+    *x1 = 0.0;
     for (k = -1; k <= 2; ++k) {
           continuum_point point = cont_points[i + k];
-          x0 += splineBasis(k, t0) * point.x;
-          x1 += splineBasis(k, t1) * point.x;
-          y0 += splineBasis(k, t0) * point.y;
-          y1 += splineBasis(k, t1) * point.y;
+          *x0 += splineBasis(k, t0) * point.x;
+          *x1 += splineBasis(k, t1) * point.x;
     }  
  
     return;
 }
 
-void update_region(int index, continuum_point cont_points[], 
-            double continuum[], const double waves[], 
-            size_t arr_size, size_t conts_pts_sz){
-    
-    if (index>((int)conts_pts_sz -4) || index<2){
-        return;
+int update_spans(int fspan, int lspan, continuum_point cont_points[], 
+            double continuum[], const wave_grid *grid, 
+            size_t conts_pts_sz, int *lpix, int *hpix){
+    /*
+    recompute spans fspan..lspan (clipped to the ones fill_continuum draws)
+    and report the pixels that were rewritten as lpix..hpix.  returns -1 if
+    there was nothing to do.
+    */
+    double x0, x1;
+
+    if (fspan < 1) fspan = 1;
+    if (lspan > (int)conts_pts_sz - 3) lspan = (int)conts_pts_sz - 3;
+    if (fspan > lspan){
+        return -1;
     }
-    compute(index-2, index+1, cont_points,continuum,waves,arr_size);
+    compute(fspan, lspan, cont_points, continuum, grid);
+
+    effectRegion(fspan, cont_points, &x0, &x1);
+    *lpix = grid_index(grid, x0) + 1;
+    effectRegion(lspan, cont_points, &x0, &x1);
+    *hpix = grid_index(grid, x1);
+    return 0;
+}
+
+int update_region(int index, continuum_point cont_points[], 
+            double continuum[], const wave_grid *grid, 
+            size_t conts_pts_sz, int *lpix, int *hpix){
+    /*
+    a point only enters the four spans index-2 .. index+1, so after moving
+    its y those are all that need redrawing.  moving x can change which
+    pixels a span covers, so recompute the whole continuum for that.
+    */
+    return update_spans(index-2, index+1, cont_points, continuum, grid, conts_pts_sz, lpix, hpix);
 }
 
 double splineBasis(int i, double t) {
@@ -94,12 +125,13 @@ double splineBasis(int i, double t) {
 } 
 
 void setContinLine(double x1, double x2, double y1, double y2, 
-        const double waves[], double cont[], size_t wave_sz) {     
+        const wave_grid *grid, double cont[]) {     
 
-    /*set the continuum line*/
+    /*set the continuum line over the pixels in (x1, x2]*/
 
-    int spix = get_wave_index(waves, wave_sz, x1)+1;
-    int epix = get_wave_index(waves, wave_sz, x2);
+    const double *waves = grid->waves;
+    int spix = grid_index(grid, x1)+1;
+    int epix = grid_index(grid, x2);
     int j;
     double slope = (y2 - y1)/(x2 - x1);
     double intercept = y1 - x1*slope;
@@ -44,10 +44,10 @@ double* spectrum(   const double waves[], const double flux[], const double err[
     return continuum;
 }
 */
-double* return_absorption(double continuum[], const double waves[], 
+double* return_absorption(double continuum[], const wave_grid *grid, 
                           double Nval[], double bval[], double redshift[], 
                           double restwv[], double gmma[], double osc_strn[], 
-                          size_t len_abs, size_t len_arr){
+                          size_t len_abs){
     int i;
     absorber absorbers[len_abs];
 
@@ -56,36 +56,36 @@ double* return_absorption(double continuum[], const double waves[],
                                     .rest=restwv[i], .gamma=gmma[i], .f=osc_strn[i]};
     }
 
-    double* absorption =(double*)get_absorption(continuum, waves, absorbers,len_abs,len_arr);
+    double* absorption =(double*)get_absorption(continuum, grid, absorbers,len_abs);
     //memcpy(absorption, continuum, sizeof(continuum));
 
 
     return absorption;
 }
 
-double* return_continuum(double xs[], double ys[], const double waves[], 
-                        size_t len_cont_points, size_t len_arr){
+double* return_continuum(double xs[], double ys[], const wave_grid *grid, 
+                        size_t len_cont_points){
 
     continuum_point cont_points[len_cont_points];
     int i;
     for(i=0;i<len_cont_points;++i){
         cont_points[i]=(continuum_point){.x=xs[i], .y=ys[i]};
     }
-    double* cont =(double*)get_continuum(cont_points, waves, len_cont_points, len_arr);
+    double* cont =(double*)get_continuum(cont_points, grid, len_cont_points);
     return cont;
 }
 
 double get_chi2(double absorption[], const double flux[], const double err[], 
-                const double waves[], double starts[], double ends[], 
-                size_t len_pairs, size_t len_arr){
+                const wave_grid *grid, double starts[], double ends[], 
+                size_t len_pairs){
     int i;
     int beg, end;
 
     index_pair pairs[len_pairs];
 
     for(i=0;i<len_pairs;++i){
-        beg = get_wave_index(waves, len_arr, starts[i]);
-        end = get_wave_index(waves, len_arr, ends[i]);
+        beg = grid_index(grid, starts[i]);
+        end = grid_index(grid, ends[i]);
         pairs[i]=(index_pair){.start=beg, .end=end};
     }
     return chi2(absorption, flux, err, pairs, len_pairs);
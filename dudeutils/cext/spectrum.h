@@ -31,6 +31,71 @@ typedef struct IndexPair{
     int end;
 } index_pair;
 
+typedef struct LsfSegment{
+    int start;              /*first pixel this kernel applies to, it runs up to the next segment*/
+    const double *kernel;   /*points into the context's kernels*/
+    int len_kernel;
+    int offset;
+} lsf_segment;
+
+typedef enum { GRID_ARBITRARY, GRID_LINEAR, GRID_LOGLIN } grid_kind;
+
+typedef struct WaveGrid{
+    const double *waves;
+    size_t size;
+    grid_kind kind;
+    double start;   /*wavelength (log10 wavelength if loglin) of the first pixel*/
+    double step;    /*pixel size, in the same units as start*/
+} wave_grid;
+
+typedef struct LineState{
+    absorber line;          /*parameters the window was computed for*/
+    int lpix;               /*window is lpix..hpix inclusive, empty if lpix > hpix*/
+    int hpix;
+    double *tau;            /*this line's optical depth over the window*/
+    size_t cap;
+    int prev_lpix;          /*window before the current update*/
+    int prev_hpix;
+} line_state;
+
+typedef struct SpectrumContext{
+    wave_grid grid;
+    const double *flux;
+    const double *err;
+    index_pair *pairs;      /*fit regions, as [start, end) pixel pairs*/
+    size_t len_pairs;
+    bool restricted;        /*only evaluate the pixels the regions see through the lsf*/
+    index_pair *active;     /*pixels that are evaluated, sorted and disjoint.  the whole grid unless restricted*/
+    size_t len_active;
+    unsigned short *weight; /*number of regions covering each pixel*/
+    double *continuum;      /*scratch buffers, grid.size long*/
+    double *absorption;
+    double *tau;            /*summed optical depth of all lines*/
+    double *background;     /*summed optical depth of the fixed lines, NULL until some are set*/
+    absorber *bg_lines;     /*the fixed lines, see context_set_background*/
+    size_t len_bg_lines;
+    double *resid;          /*per pixel chi2 term, weighted*/
+    lsf_segment *lsf;       /*line spread function by pixel range, see context_set_lsf_segments*/
+    size_t len_lsf;
+    double *kernels;        /*the segments' kernels, back to back*/
+    int lsf_lo;             /*the model at pixel i sees absorption[i + lsf_lo .. i + lsf_hi]*/
+    int lsf_hi;
+    double *scratch;        /*grid.size per thread*/
+    int len_scratch;        /*number of threads scratch has room for*/
+    double chi2;
+
+    /*what the buffers currently hold, so the next evaluation only redoes what changed*/
+    bool valid;
+    line_state *lines;
+    int *changed;           /*indices of the lines being updated, len_lines long*/
+    size_t len_lines;
+    continuum_point *cont_points;
+    size_t len_cont_points;
+    size_t updates;         /*incremental line updates since tau was last rebuilt*/
+    int dirty_lpix;         /*pixels rewritten by the last evaluation, empty if lpix > hpix*/
+    int dirty_hpix;
+} spec_context;
+
 /*spec get_spectrum(double waves[], double flux[], 
         continuum_point cont_points[], absorber absorbers[], 
         size_t num_abs, size_t size, size_t pts_size);*/
@@ -42,55 +107,130 @@ double* spectrum(   const double waves[], const double flux[], const double err[
                     int starts[], int ends[],
                     int len_cont_points, int len_arr, int len_abs, int len_pairs);
 
-double* return_absorption(double continuum[], const double waves[], double Nval[], double bval[], double redshift[], 
-                    double restwv[], double gmma[], double osc_strn[], size_t len_abs, size_t len_arr);
+double* return_absorption(double continuum[], const wave_grid *grid, double Nval[], double bval[], double redshift[], 
+                    double restwv[], double gmma[], double osc_strn[], size_t len_abs);
 
-double* return_continuum(double xs[], double ys[], const double waves[], size_t len_cont_points, size_t len_arr);
+double* return_continuum(double xs[], double ys[], const wave_grid *grid, size_t len_cont_points);
 
-double get_chi2(double absorption[], const double flux[], const double err[], const double waves[],double starts[], double ends[], size_t len_pairs, size_t len_arr);
+double get_chi2(double absorption[], const double flux[], const double err[], const wave_grid *grid, double starts[], double ends[], size_t len_pairs);
 /************************************************************/
 
+int context_init(spec_context *ctx, const wave_grid *grid,
+                 const double flux[], const double err[]);
+
+int context_set_regions(spec_context *ctx, const int starts[], const int ends[], size_t len_pairs);
+
+double context_evaluate(spec_context *ctx, 
+                        continuum_point cont_points[], size_t len_cont_points,
+                        absorber lines[], size_t len_lines);
+
+int context_set_lsf(spec_context *ctx, const double kernel[], int len_kernel, int offset);
+
+int context_set_lsf_segments(spec_context *ctx, const int starts[], const double kernels[],
+                             const int lens[], const int offsets[], size_t len_lsf);
+
+int context_set_restricted(spec_context *ctx, bool restricted);
+
+int context_set_background(spec_context *ctx, const absorber lines[], size_t len_lines);
+
+void context_convolved(const spec_context *ctx, double out[]);
+
+int context_region_pixels(const spec_context *ctx, int pixels[]);
+
+double context_jacobian(spec_context *ctx,
+                     continuum_point cont_points[], size_t len_cont_points,
+                     absorber lines[], size_t len_lines,
+                     const int line_columns[], const int point_columns[], int len_columns,
+                     bool lsf, double model[], double jac[]);
+
+void context_reset(spec_context *ctx);
+
+void context_free(spec_context *ctx);
+
+/************************************************************/
+
+typedef enum { VOIGT_TABLE, VOIGT_HUMLICEK, VOIGT_FAST } voigt_method;
+
 double voigt(double v, double a);
 
+double voigt_humlicek(double v, double a);
+
+void voigt_array(const double v[], double out[], size_t n, double a, voigt_method m);
+
+void voigt_gradient(double v, double a, voigt_method m, double *dh_dv, double *dh_da);
+
+void set_voigt_method(voigt_method m);
+
+voigt_method get_voigt_method(void);
+
 /*************************************************************/
 
 double pix_to_wave(double crval, double cdelt, double crpix, double pix, bool loglin);
 
-int get_wave_index(const double wave_arr[], size_t size, double wave);
+void set_num_threads(int n);
+
+int get_num_threads(void);
+
+int thread_id(void);
+
+void grid_init(wave_grid *grid, const double waves[], size_t size);
+
+void grid_init_wcs(wave_grid *grid, const double waves[], size_t size,
+                   double crval, double cdelt, double crpix, bool loglin);
+
+int grid_index(const wave_grid *grid, double wave);
 
 double chi2(double mod[], const double obs[], const double err[], index_pair pairs[], size_t len_pairs);
 
 /**************************************************************/
 
-int sub_absorber(   const double waves[], double cont[],
-                    double N, double b, double z, 
-                    double f, double Gamma, double restWave, 
-                    bool subFlag, size_t size);
+int line_tau(const wave_grid *grid, const absorber *line, double tau[], int *lpix, int *hpix);
+
+void line_reach(const wave_grid *grid, const absorber *line, int *lpix, int *hpix);
+
+void line_gradient(const wave_grid *grid, const absorber *line, int lpix, int hpix,
+                   const double tau[], double dtau_db[], double dtau_dz[]);
+
+int sub_absorber(   const wave_grid *grid, double cont[], double tau[],
+                    const absorber *line, bool subFlag);
 
-double* get_absorption(double cont[], const double waves[], absorber abs[], 
-                        size_t num_absorbers, size_t len_arr);
+double* get_absorption(double cont[], const wave_grid *grid, absorber abs[], 
+                        size_t num_absorbers);
+
+void fill_absorption(const double cont[], const wave_grid *grid, absorber abs[], 
+                     size_t num_absorbers, double absorption[]);
+
+void fill_absorption_into(const double cont[], const wave_grid *grid, absorber abs[], 
+                          size_t num_absorbers, double absorption[],
+                          double tau[], int nthreads);
 
 
 /************************************************************/
 
 double* get_continuum(  continuum_point cont_points[], 
-                    const double waves[], 
-                    size_t pts_size, size_t arr_size);
+                    const wave_grid *grid, 
+                    size_t pts_size);
+
+void fill_continuum(continuum_point cont_points[], const wave_grid *grid,
+                    size_t pts_size, double continuum[]);
 
 void compute(int fpoint, int lpoint, continuum_point cont_points[], 
-            double continuum[], const double waves[], 
-            size_t arr_size);
+            double continuum[], const wave_grid *grid);
+
+void effectRegion(int i, continuum_point cont_points[], double *x0, double *x1);
 
-void effectRegion(int i, continuum_point cont_points[]);
+int update_spans(int fspan, int lspan, continuum_point cont_points[], 
+            double continuum[], const wave_grid *grid, 
+            size_t conts_pts_sz, int *lpix, int *hpix);
 
-void update_region(int index, continuum_point cont_points[], 
-            double continuum[], const double waves[], 
-            size_t arr_size, size_t conts_pts_sz);
+int update_region(int index, continuum_point cont_points[], 
+            double continuum[], const wave_grid *grid, 
+            size_t conts_pts_sz, int *lpix, int *hpix);
 
 double splineBasis(int i, double t);
 
 void setContinLine(double x1, double x2, double y1, double y2, 
-        const double waves[], double cont[], size_t wave_sz);
+        const wave_grid *grid, double cont[]);
 
 #endif
 
@@ -1,6 +1,12 @@
+
 #include<stdio.h>
 #include<math.h>
 #include"spectrum.h"
+#ifdef _OPENMP
+#include<omp.h>
+#endif
+
+static int num_threads = 0;     /*0 means as many as openmp would use*/
 
 double pix_to_wave(double crval, double cdelt, double crpix, double pix, bool loglin){
     if(loglin){
@@ -10,22 +16,138 @@ double pix_to_wave(double crval, double cdelt, double crpix, double pix, bool lo
     }
 }
 
-int get_wave_index(const double wave_arr[], size_t size, double wave){
-    /*assumes that double[] waves is sorted alread*/
-    int i=0;  
-    double vdisp=2.14;  //velocity dispersion for HIRES in kms
-    double c=2.99792458E5; //c in km/s
-    //double tol=0.02;
+void set_num_threads(int n){
+    /*threads used to compute lines.  0 (the default) follows OMP_NUM_THREADS*/
+    num_threads = n < 0 ? 0 : n;
+}
+
+int get_num_threads(void){
+#ifdef _OPENMP
+    return num_threads > 0 ? num_threads : omp_get_max_threads();
+#else
+    return 1;
+#endif
+}
+
+int thread_id(void){
+#ifdef _OPENMP
+    return omp_get_thread_num();
+#else
+    return 0;
+#endif
+}
+
+static bool is_uniform(const double vals[], size_t size, double start, double step, bool loglin){
+    /*checks that every pixel sits on start+i*step to within a small fraction of a pixel*/
+    size_t i;
+    double tol = 1.0E-4*fabs(step);
+    for(i=0;i<size;++i){
+        double val = loglin ? log10(vals[i]) : vals[i];
+        if (fabs(val - (start + step*i)) > tol){
+            return false;
+        }
+    }
+    return true;
+}
+
+void grid_init(wave_grid *grid, const double waves[], size_t size){
+    /*
+    build a grid descriptor from the wavelength array alone.  linear and
+    log-linear scales are detected so that lookups can be inverted
+    analytically, anything else falls back to binary search.
+    */
+    grid->waves = waves;
+    grid->size = size;
+    grid->kind = GRID_ARBITRARY;
+    grid->start = 0.0;
+    grid->step = 0.0;
+
+    if (size < 2 || waves[0] <= 0.0 || waves[size-1] <= waves[0]){
+        return;
+    }
+
+    grid->start = waves[0];
+    grid->step = (waves[size-1] - waves[0])/(size-1);
+    if (is_uniform(waves, size, grid->start, grid->step, false)){
+        grid->kind = GRID_LINEAR;
+        return;
+    }
+
+    grid->start = log10(waves[0]);
+    grid->step = (log10(waves[size-1]) - grid->start)/(size-1);
+    if (is_uniform(waves, size, grid->start, grid->step, true)){
+        grid->kind = GRID_LOGLIN;
+        return;
+    }
+    grid->start = 0.0;
+    grid->step = 0.0;
+}
+
+void grid_init_wcs(wave_grid *grid, const double waves[], size_t size,
+                   double crval, double cdelt, double crpix, bool loglin){
+    /*
+    build a grid descriptor from CRVAL1/CDELT1/CRPIX1 (see wavelength.WaveUtils1D).
+    fits pixels are 1-indexed, so pixel 1 is waves[0]
+    */
+    grid->waves = waves;
+    grid->size = size;
+    if (cdelt <= 0.0 || size < 2){
+        grid_init(grid, waves, size);
+        return;
+    }
+    grid->kind = loglin ? GRID_LOGLIN : GRID_LINEAR;
+    grid->start = crval + cdelt*(1.0 - crpix);
+    grid->step = cdelt;
+}
 
-    //with a loglin scale:
-    double tol=wave*vdisp/c;   //one pixel in wavlength
+static int grid_bsearch(const double waves[], size_t size, double wave){
+    /*last pixel with waves[i] <= wave.  caller has checked the bounds*/
+    size_t lo = 0, hi = size-1;
+    while (hi - lo > 1){
+        size_t mid = lo + (hi - lo)/2;
+        if (waves[mid] <= wave) lo = mid;
+        else                    hi = mid;
+    }
+    return (int)lo;
+}
+
+int grid_index(const wave_grid *grid, double wave){
+    /*
+    returns the last pixel whose wavelength is <= wave, so that pixel i
+    covers [waves[i], waves[i+1]).  -1 if wave is blueward of the grid,
+    size-1 if it is redward.
+    */
+    const double *waves = grid->waves;
+    size_t size = grid->size;
+    double pos;
+    long i;
 
-    while ( i < size && fabs(wave_arr[i]-wave)>tol ){
-        //printf("diff=%lf \n",fabs(wave_arr[i]-wave));
-        ++i;
+    if (size == 0 || wave < waves[0]) return -1;
+    if (wave >= waves[size-1]) return (int)size-1;
+
+    switch (grid->kind){
+    case GRID_LINEAR:
+        pos = (wave - grid->start)/grid->step;
+        break;
+    case GRID_LOGLIN:
+        pos = (log10(wave) - grid->start)/grid->step;
+        break;
+    default:
+        return grid_bsearch(waves, size, wave);
     }
 
-    return ( i == size ? -1 : i );
+    i = (long)floor(pos);
+    if (i < 0) i = 0;
+    if (i > (long)size-2) i = (long)size-2;
+
+    /*analytic guess can be off by one right at a pixel edge*/
+    if (waves[i] > wave) --i;
+    else if (waves[i+1] <= wave) ++i;
+
+    if (i < 0 || i > (long)size-2 || waves[i] > wave || waves[i+1] <= wave){
+        return grid_bsearch(waves, size, wave);
+    }
+    return (int)i;
 }
 
 double chi2(double mod[], const double obs[], const double err[], index_pair pairs[], size_t len_pairs) {
@@ -33,7 +155,7 @@ double chi2(double mod[], const double obs[], const double err[], index_pair pai
     double result = 0.0;
     double diff=0.0;
     for (k=0;k<len_pairs;++k){
-        
+
         for (i = pairs[k].start; i < pairs[k].end; ++i) {
             diff = (obs[i] - mod[i])/err[i];
             result += diff*diff;
@@ -1,44 +1,50 @@
 #include<stdio.h>
 #include<math.h>
+#include<complex.h>
 #include"spectrum.h"
 
-double voigt(double v, double a){
+/*
+tabulated H(a, v) = h0 + a*h1 + a^2*h2 for voigt(): h0 and h2 every 0.1 up
+to v = 4, h1 on to v = 12, every 0.2 past v = 4
+*/
+static const double h0[] = {
+    1.0000000, 0.9900500, 0.9607890, 0.9139310, 0.8521440, 0.7788010,
+    0.6976760, 0.6126260, 0.5272920, 0.4448580, 0.3678790, 0.2984970,
+    0.2369280, 0.1845200, 0.1408580, 0.1053990, 0.0773050, 0.0555760,
+    0.0391640, 0.0270520, 0.0183156, 0.0121552, 0.0079071, 0.0050418,
+    0.0031511, 0.0019305, 0.0011592, 0.0006823, 0.0003937, 0.0002226,
+    0.0001234, 0.0000671, 0.0000357, 0.0000186, 0.0000095, 0.0000048,
+    0.0000024, 0.0000011, 0.0000005, 0.0000002, 0.0000001 };
+
+
+static const double h1[] = {
+    -1.1283800,-1.1059600,-1.0404800,-0.9370300,-0.8034600,-0.6494500,
+    -0.4855200,-0.3219200,-0.1677200,-0.0301200, 0.0859400, 0.1778900,
+    0.2453700, 0.2898100, 0.3139400, 0.3213000, 0.3157300, 0.3009400,
+    0.2802700, 0.2564800, 0.2317260, 0.2075280, 0.1848820, 0.1643410,
+    0.1461280, 0.1302360, 0.1165150, 0.1047390, 0.0946530, 0.0860050,
+    0.0785650, 0.0721290, 0.0665260, 0.0616150, 0.0572810, 0.0534300,
+    0.0499880, 0.0468940, 0.0440980, 0.0415610, 0.0392500, 0.0351950,
+    0.0317620, 0.0288240, 0.0262880, 0.0240810, 0.0221460, 0.0204410,
+    0.0189290, 0.0175820, 0.0163750, 0.0152910, 0.0143120, 0.0134260,
+    0.0126200, 0.0118860, 0.0112145, 0.0105990, 0.0100332, 0.0095119,
+    0.0090306, 0.0085852, 0.0081722, 0.0077885, 0.0074314, 0.0070985,
+    0.0067875, 0.0064967, 0.0062243, 0.0059688, 0.0057287, 0.0055030,
+    0.0052903, 0.0050898, 0.0049006, 0.0047217, 0.0045526, 0.0043924,
+    0.0042405, 0.0040964, 0.0039595 };
+
+
+static const double h2[] = {
+    1.0000000, 0.9702000, 0.8839000, 0.7494000, 0.5795000, 0.3894000,
+    0.1953000, 0.0123000,-0.1476000,-0.2758000,-0.3679000,-0.4234000,
+    -0.4454000,-0.4392000,-0.4113000,-0.3689000,-0.3185000,-0.2657000,
+    -0.2146000,-0.1683000,-0.1282100,-0.0950500,-0.0686300,-0.0483000,
+    -0.0331500,-0.0222000,-0.0145100,-0.0092700,-0.0057800,-0.0035200,
+    -0.0021000,-0.0012200,-0.0007000,-0.0003900,-0.0002100,-0.0001100,
+    -0.0000600,-0.0000300,-0.0000100,-0.0000100, 0.0000000 };
 
-    static const double h0[] = {
-        1.0000000, 0.9900500, 0.9607890, 0.9139310, 0.8521440, 0.7788010,
-        0.6976760, 0.6126260, 0.5272920, 0.4448580, 0.3678790, 0.2984970,
-        0.2369280, 0.1845200, 0.1408580, 0.1053990, 0.0773050, 0.0555760,
-        0.0391640, 0.0270520, 0.0183156, 0.0121552, 0.0079071, 0.0050418,
-        0.0031511, 0.0019305, 0.0011592, 0.0006823, 0.0003937, 0.0002226,
-        0.0001234, 0.0000671, 0.0000357, 0.0000186, 0.0000095, 0.0000048,
-        0.0000024, 0.0000011, 0.0000005, 0.0000002, 0.0000001 };
-
-
-    static const double h1[] = { 
-        -1.1283800,-1.1059600,-1.0404800,-0.9370300,-0.8034600,-0.6494500,
-        -0.4855200,-0.3219200,-0.1677200,-0.0301200, 0.0859400, 0.1778900,
-        0.2453700, 0.2898100, 0.3139400, 0.3213000, 0.3157300, 0.3009400,
-        0.2802700, 0.2564800, 0.2317260, 0.2075280, 0.1848820, 0.1643410,
-        0.1461280, 0.1302360, 0.1165150, 0.1047390, 0.0946530, 0.0860050,
-        0.0785650, 0.0721290, 0.0665260, 0.0616150, 0.0572810, 0.0534300,
-        0.0499880, 0.0468940, 0.0440980, 0.0415610, 0.0392500, 0.0351950,
-        0.0317620, 0.0288240, 0.0262880, 0.0240810, 0.0221460, 0.0204410,
-        0.0189290, 0.0175820, 0.0163750, 0.0152910, 0.0143120, 0.0134260,
-        0.0126200, 0.0118860, 0.0112145, 0.0105990, 0.0100332, 0.0095119,
-        0.0090306, 0.0085852, 0.0081722, 0.0077885, 0.0074314, 0.0070985,
-        0.0067875, 0.0064967, 0.0062243, 0.0059688, 0.0057287, 0.0055030,
-        0.0052903, 0.0050898, 0.0049006, 0.0047217, 0.0045526, 0.0043924,
-        0.0042405, 0.0040964, 0.0039595 };
-
-
-    static const double h2[] = {
-        1.0000000, 0.9702000, 0.8839000, 0.7494000, 0.5795000, 0.3894000,
-        0.1953000, 0.0123000,-0.1476000,-0.2758000,-0.3679000,-0.4234000,
-        -0.4454000,-0.4392000,-0.4113000,-0.3689000,-0.3185000,-0.2657000,
-        -0.2146000,-0.1683000,-0.1282100,-0.0950500,-0.0686300,-0.0483000,
-        -0.0331500,-0.0222000,-0.0145100,-0.0092700,-0.0057800,-0.0035200,
-        -0.0021000,-0.0012200,-0.0007000,-0.0003900,-0.0002100,-0.0001100,
-        -0.0000600,-0.0000300,-0.0000100,-0.0000100, 0.0000000 };
+
+double voigt(double v, double a){
 
     double v0, v1, v2;
     int   n, n1;
@@ -66,5 +72,215 @@ double voigt(double v, double a){
       return (0.56419 + 0.846/(v*v))/(v*v)*a;
     }
   }
-  
-  
+
+
+/*
+alternatives to the table above, picked once per run with set_voigt_method.
+all of them return H(a, v), normalized so that H(0, 0) = 1, and are meant to
+be run over a whole window of v at a time through voigt_array.
+*/
+
+static voigt_method method = VOIGT_TABLE;
+
+void set_voigt_method(voigt_method m){
+    method = m;
+}
+
+voigt_method get_voigt_method(void){
+    return method;
+}
+
+/*
+the Faddeeva function w(v + ia), from the four region rational approximation
+of Humlicek (1982, JQSRT 27, 437), "W4".  relative error is around 1e-4
+everywhere.  each region is written out in real arithmetic on t = a - iv, so
+that voigt_array can run a region over many points in a loop without calls
+or branches
+*/
+
+#define CMUL(r, i, xr, xi) do { double _r = (r)*(xr) - (i)*(xi); (i) = (r)*(xi) + (i)*(xr); (r) = _r; } while (0)
+
+static inline int w4_region(double v, double a){
+    /*0 to 3 for the regions below, without branching*/
+    double s = fabs(v) + a;
+    return (s < 15.0) + (s < 5.5) + ((s < 5.5) & (a < 0.195*fabs(v) - 0.176));
+}
+
+static inline void w4_div(double nr, double ni, double dr, double di, double *re, double *im){
+    double d = 1.0/(dr*dr + di*di);
+    *re = (nr*dr + ni*di)*d;
+    *im = (ni*dr - nr*di)*d;
+}
+
+static inline void w4_far(double v, double a, double *re, double *im){
+    /*|v| + a >= 15:  t/sqrt(pi)/(0.5 + t^2)*/
+    double ur = a*a - v*v, ui = -2.0*a*v;
+    w4_div(0.5641896*a, -0.5641896*v, 0.5 + ur, ui, re, im);
+}
+
+static inline void w4_wing(double v, double a, double *re, double *im){
+    /*5.5 <= |v| + a < 15*/
+    double ur = a*a - v*v, ui = -2.0*a*v;
+    double nr = 1.410474 + 0.5641896*ur, ni = 0.5641896*ui;
+    double dr = 3.0 + ur, di = ui;
+    CMUL(nr, ni, a, -v);
+    CMUL(dr, di, ur, ui);
+    w4_div(nr, ni, 0.75 + dr, di, re, im);
+}
+
+static inline void w4_core(double v, double a, double *re, double *im){
+    /*|v| + a < 5.5, a >= 0.195|v| - 0.176*/
+    double nr = 0.5642236, ni = 0.0, dr = 1.0, di = 0.0;
+    CMUL(nr, ni, a, -v); nr += 3.778987;
+    CMUL(nr, ni, a, -v); nr += 11.96482;
+    CMUL(nr, ni, a, -v); nr += 20.20933;
+    CMUL(nr, ni, a, -v); nr += 16.4955;
+    CMUL(dr, di, a, -v); dr += 6.699398;
+    CMUL(dr, di, a, -v); dr += 21.69274;
+    CMUL(dr, di, a, -v); dr += 39.27121;
+    CMUL(dr, di, a, -v); dr += 38.82363;
+    CMUL(dr, di, a, -v); dr += 16.4955;
+    w4_div(nr, ni, dr, di, re, im);
+}
+
+static inline void w4_center(double v, double a, double *re, double *im){
+    /*|v| + a < 5.5, a < 0.195|v| - 0.176:  exp(t^2) - t p(t^2)/q(t^2).  im may be NULL*/
+    double ur = a*a - v*v, ui = -2.0*a*v;
+    double nr = 0.56419, ni = 0.0, dr = -1.0, di = 0.0, e;
+    CMUL(nr, ni, ur, ui); nr -= 1.320522;
+    CMUL(nr, ni, ur, ui); nr += 35.76683;
+    CMUL(nr, ni, ur, ui); nr -= 219.0313;
+    CMUL(nr, ni, ur, ui); nr += 1540.787;
+    CMUL(nr, ni, ur, ui); nr -= 3321.9905;
+    CMUL(nr, ni, ur, ui); nr += 36183.31;
+    CMUL(nr, ni, a, -v);
+    CMUL(dr, di, ur, ui); dr += 1.841439;
+    CMUL(dr, di, ur, ui); dr -= 61.57037;
+    CMUL(dr, di, ur, ui); dr += 364.2191;
+    CMUL(dr, di, ur, ui); dr -= 2186.181;
+    CMUL(dr, di, ur, ui); dr += 9022.228;
+    CMUL(dr, di, ur, ui); dr -= 24322.84;
+    CMUL(dr, di, ur, ui); dr += 32066.6;
+    w4_div(nr, ni, dr, di, re, &ni);
+    e = exp(ur);
+    *re = e*cos(ui) - *re;
+    if (im)
+        *im = e*sin(ui) - ni;
+}
+
+static double complex faddeeva(double v, double a){
+    double re, im;
+    switch (w4_region(v, a)){
+    case 0: w4_far(v, a, &re, &im); break;
+    case 1: w4_wing(v, a, &re, &im); break;
+    case 2: w4_core(v, a, &re, &im); break;
+    default: w4_center(v, a, &re, &im);
+    }
+    return re + I*im;
+}
+
+static void humlicek_array(const double v[], double out[], size_t n, double a){
+    /*
+    H(a, v) over a window.  a is the same for the whole window, so the
+    region of each point only depends on |v|.  the points are sorted into
+    regions in blocks, then each region is run as a loop of its own
+    */
+    enum { BLOCK = 256 };
+    size_t idx[4][BLOCK], cnt[4], i, j, k, len, start;
+    double re, im;
+    int r;
+
+    for(start=0;start<n;start+=BLOCK){
+        len = n - start < BLOCK ? n - start : BLOCK;
+        cnt[0] = cnt[1] = cnt[2] = cnt[3] = 0;
+        for(i=start;i<start+len;++i){
+            r = w4_region(v[i], a);
+            idx[r][cnt[r]++] = i;
+        }
+        for(k=0;k<cnt[0];++k){ j = idx[0][k]; w4_far(v[j], a, &re, &im); out[j] = re; }
+        for(k=0;k<cnt[1];++k){ j = idx[1][k]; w4_wing(v[j], a, &re, &im); out[j] = re; }
+        for(k=0;k<cnt[2];++k){ j = idx[2][k]; w4_core(v[j], a, &re, &im); out[j] = re; }
+        for(k=0;k<cnt[3];++k){ j = idx[3][k]; w4_center(v[j], a, &re, NULL); out[j] = re; }
+    }
+}
+
+double voigt_humlicek(double v, double a){
+    /*real part of the Faddeeva function w(v + ia)*/
+    return creal(faddeeva(v, a));
+}
+
+static void voigt_table_gradient(double v, double a, double *dh_dv, double *dh_da){
+    /*
+    partial derivatives of the table interpolation in voigt(), piece by
+    piece.  the interpolation is linear in v between table entries, so
+    dH/dv steps at each entry
+    */
+    double sign = v < 0.0 ? -1.0 : 1.0;
+    double v0, v2;
+    int n, n1;
+
+    v = fabs(v);
+    v0 = v*10.0;
+    n = v0;
+    if (n < 40){
+        n1 = n+1;
+        v2 = v0 - (double)n;
+        *dh_dv = sign*10.0*(h0[n1]-h0[n] + a*(h1[n1]-h1[n] + a*(h2[n1]-h2[n])));
+        *dh_da = v2*(h1[n1]-h1[n] + 2.0*a*(h2[n1]-h2[n])) + h1[n] + 2.0*a*h2[n];
+    }
+    else if (n < 120){
+        n = n/2 + 20;
+        n1 = n+1;
+        v2 = (v0 - ((double)n-20.)*2.)/2.0;
+        *dh_dv = sign*5.0*a*(h1[n1]-h1[n]);
+        *dh_da = (h1[n1]-h1[n])*v2 + h1[n];
+    }
+    else {
+        *dh_dv = -sign*a*(2.0*0.56419 + 4.0*0.846/(v*v))/(v*v*v);
+        *dh_da = (0.56419 + 0.846/(v*v))/(v*v);
+    }
+}
+
+void voigt_gradient(double v, double a, voigt_method m, double *dh_dv, double *dh_da){
+    /*
+    partial derivatives of H(a, v) as voigt_array computes it with method m.
+    for humlicek, dw/dz = -2 z w + 2i/sqrt(pi) with z = v + ia.  H is the
+    real part of w, so dH/dv = Re(dw/dz) and dH/da = Re(i dw/dz) = -Im(dw/dz)
+    */
+    double complex dw;
+    switch (m){
+    case VOIGT_HUMLICEK:
+        dw = -2.0*(v + I*a)*faddeeva(v, a) + 2.0*I*0.5641895835477563;  /*1/sqrt(pi)*/
+        *dh_dv = creal(dw);
+        *dh_da = -cimag(dw);
+        break;
+    case VOIGT_FAST:
+        *dh_dv = -2.0*v*exp(-v*v);
+        *dh_da = 0.0;
+        break;
+    default:
+        voigt_table_gradient(v, a, dh_dv, dh_da);
+    }
+}
+
+void voigt_array(const double v[], double out[], size_t n, double a, voigt_method m){
+    /*
+    out[i] = H(a, v[i]) for a window of n points.  out may be v.  with
+    VOIGT_FAST this is the pure gaussian core exp(-v^2), i.e. the a -> 0 limit
+    */
+    size_t i;
+    switch (m){
+    case VOIGT_HUMLICEK:
+        humlicek_array(v, out, n, a);
+        break;
+    case VOIGT_FAST:
+        for(i=0;i<n;++i){
+            out[i] = exp(-v[i]*v[i]);
+        }
+        break;
+    default:
+        for(i=0;i<n;++i){
+            out[i] = voigt(v[i], a);
+        }
+    }
+}
@@ -23,6 +23,7 @@ def _set_values(dct):
     Config.glob = Config.ab_cfg.pop('config', {})
     Config.vdisp = float(Config.glob.get('vdisp', 2.14))
     Config.vsig = float(Config.glob.get('vsig', 3.4))
+    Config.voigt = str(Config.glob.get('voigt', 'table'))
 
 
 class Config(object):
@@ -31,6 +32,7 @@ class Config(object):
     glob = None
     vdisp = 2.14
     vsig = 3.4
+    voigt = 'table'  # table, humlicek or fast.  applied in Spectrum.get_context
     config_file = None
 
     @staticmethod
@@ -1,3 +1,6 @@
+import bisect
+import itertools
+import sys
 import xml.etree.ElementTree as et
 
 import numpy as np
@@ -8,11 +11,18 @@ from dudeutils.atomic import *
 
 tf = {"true": True, "false": False}
 c = constants.c / 1000.  # speed of light in km/s
+_versions = itertools.count(1)  # stamps absorber edits, see LineTable
+_node_keys = {}  # one shared tuple for each set of xml attribute names, see Data.node
 
 
 class ObjList(list):
     """
     A container class inheriting from list.
+
+    lookups by id (get_item, positions) go through a dict of id to the
+    positions of the items with it.  it is kept up to date by the methods
+    here, and rebuilt if a lookup finds it stale, e.g. after an id was set
+    directly or objlist was appended to.
     """
 
     def __init__(self, objlist, *args, **kwargs):
@@ -45,6 +55,40 @@ class ObjList(list):
         self.objlist = self.objlist + rhs.objlist
         return self
 
+    @property
+    def objlist(self):
+        return self._objlist
+
+    @objlist.setter
+    def objlist(self, val):
+        self._objlist = val
+        self._ids = None
+
+    def __setstate__(self, state):
+        state = dict(state)
+        if 'objlist' in state:  # pickled before objlist was a property
+            state['_objlist'] = state.pop('objlist')
+        state['_ids'] = None
+        self.__dict__.update(state)
+
+    def _index(self):
+        ids = {}
+        for i, item in enumerate(self._objlist):
+            ids.setdefault(getattr(item, 'id', None), []).append(i)
+        self._ids = ids
+        return ids
+
+    def positions(self, iden):
+        """positions in objlist of the items whose id is iden, in order"""
+        if self._ids is None:
+            return self._index().get(iden, [])
+        found = self._ids.get(iden)
+        n = len(self._objlist)
+        if not found or any(i >= n or getattr(self._objlist[i], 'id', None) != iden for i in found):
+            # a miss, or stale: only a fresh index can tell
+            found = self._index().get(iden)
+        return found or []
+
     def __iter__(self):
         for i in range(len(self.objlist)):
             yield self.objlist[i]
@@ -54,12 +98,26 @@ class ObjList(list):
 
     def __delitem__(self, i):
         del self.objlist[i]
+        self._ids = None  # positions after i have moved
 
     def __contains__(self, item):
         return item in self.objlist
 
     def __setitem__(self, i, value):
+        if isinstance(i, slice):
+            self.objlist[i] = value
+            self._ids = None
+            return
+        i = range(len(self.objlist))[i]
+        old = self.objlist[i]
         self.objlist[i] = value
+        if self._ids is not None and getattr(old, 'id', None) != getattr(value, 'id', None):
+            found = self._ids.get(getattr(old, 'id', None))
+            if found is None or i not in found:
+                self._ids = None  # stale, e.g. the old item's id was set directly
+                return
+            found.remove(i)
+            bisect.insort(self._ids.setdefault(getattr(value, 'id', None), []), i)
 
     def __len__(self):
         return len(self.objlist)
@@ -95,9 +153,9 @@ class ObjList(list):
         -------
         none
         """
-        for item in self.objlist:
-            if iden == item.id:
-                return item
+        found = self.positions(iden)
+        if found:
+            return self.objlist[found[0]]
 
     @staticmethod
     def factory(objlist=None, **kwargs):
@@ -212,7 +270,10 @@ class ObjList(list):
 
     def append_datum(self, tag, **kwargs):
         node = et.Element(tag, **kwargs)
-        self.objlist.append(Data.factory(node=node))
+        item = Data.factory(node=node)
+        self.objlist.append(item)
+        if self._ids is not None:
+            self._ids.setdefault(getattr(item, 'id', None), []).append(len(self.objlist) - 1)
 
     def refresh_list(xmlfile):
         tree = et.parse(xmlfile)
@@ -252,9 +313,145 @@ class AbsorberList(ObjList):
             new_val = lst.pop(0)
             if not new_val.id:
                 continue
-            for i in range(len(self.objlist)):
-                if self.objlist[i].id == new_val.id:
-                    self.objlist[i] = new_val
+            for i in self.positions(new_val.id):
+                self.objlist[i] = new_val  # same id, so the index holds
+
+
+class LineTable(object):
+    """
+    every transition of every absorber in a list, as contiguous arrays (one
+    entry per line) of N, b, z, rest, gamma and f, along with absorber, the
+    index of the absorber each line belongs to.  the lines of absorber i are
+    rows start[i]:start[i+1].
+
+    absorbers stamp themselves whenever N, b, z, ionName or a lock is set
+    (see Absorber.__setattr__), so update() only rewrites the rows of the
+    ones that changed since, and only rebuilds if the list itself changed.
+    revision changes whenever the table does.  locks holds whether each
+    absorber's N, b and z are locked, and free how many of them aren't.
+    """
+
+    def __init__(self, absorbers):
+        self.build(absorbers)
+
+    def build(self, absorbers):
+        """rebuild from absorbers, reading the atomic data of each transition"""
+        self.absorbers = list(absorbers)
+        self.versions = [getattr(ab, '_version', 0) for ab in self.absorbers]
+        self.ions = [ab.ionName for ab in self.absorbers]
+        rest, gamma, f, index, start = [], [], [], [], [0]
+        for i, ab in enumerate(self.absorbers):
+            if not ab.ionName in atomic_data.keys():
+                print(ab.ionName + ": not in keys")
+                print("available keys are: \n" + str(atomic_data.keys()))
+                raise KeyError()
+            for item in atomic_data[ab.ionName]:
+                rest.append(float(item.wave))
+                gamma.append(float(item.gamma))
+                f.append(float(item.f))
+                index.append(i)
+            start.append(len(rest))
+        self.rest = np.array(rest, dtype=float)
+        self.gamma = np.array(gamma, dtype=float)
+        self.f = np.array(f, dtype=float)
+        self.absorber = np.array(index, dtype=int)
+        self.start = np.array(start, dtype=int)
+        self.locks = np.zeros((len(self.absorbers), 3), dtype=bool)
+        self.free = np.zeros(len(self.absorbers), dtype=int)
+        self.N = np.zeros(self.rest.shape[0])
+        self.b = np.zeros(self.rest.shape[0])
+        self.z = np.zeros(self.rest.shape[0])
+        for i in range(len(self.absorbers)):
+            self._set_row(i)
+
+        # equivalent width in pixels is ew_coeff * 10**N / (1+z) / vdisp,
+        # see SpectralLine.get_equiv_width
+        const = alpha * h / (2. * m_e * constants.c)
+        lam = self.rest * 10 ** -10
+        self.ew_coeff = 10. ** 10 * const * lam ** 2. * self.f * 100. ** 2. / self.rest * 0.001 * constants.c
+        self.revision = next(_versions)
+        return self
+
+    def _set_row(self, i):
+        ab = self.absorbers[i]
+        rows = slice(self.start[i], self.start[i + 1])
+        self.N[rows] = float(ab.N)
+        self.b[rows] = float(ab.b)
+        self.z[rows] = float(ab.z)
+        self.locks[i] = bool(ab.NLocked), bool(ab.bLocked), bool(ab.zLocked)
+        self.free[i] = 3 - self.locks[i].sum()
+
+    def params(self):
+        """(n, 3) array of N, b and z of each absorber"""
+        first = self.start[:-1]
+        return np.column_stack((self.N[first], self.b[first], self.z[first]))
+
+    def set_params(self, values):
+        """
+        overwrite N, b and z of every line from values, an (n, 3) array as
+        returned by params.  the absorbers themselves aren't touched, see
+        Model.set_param_vector
+        """
+        self.N[:] = values[self.absorber, 0]
+        self.b[:] = values[self.absorber, 1]
+        self.z[:] = values[self.absorber, 2]
+        self.revision = next(_versions)
+
+    def update(self, absorbers):
+        """
+        bring the table in line with absorbers.  returns the indices of the
+        absorbers whose rows were rewritten, or None if it was rebuilt
+        """
+        if len(absorbers) != len(self.absorbers):
+            self.build(absorbers)
+            return None
+        changed = []
+        for i, ab in enumerate(absorbers):
+            version = getattr(ab, '_version', 0)
+            if ab is not self.absorbers[i] or (version != self.versions[i] and ab.ionName != self.ions[i]):
+                self.build(absorbers)
+                return None
+            if version != self.versions[i]:
+                self._set_row(i)
+                self.versions[i] = version
+                changed.append(i)
+        if changed:
+            self.revision = next(_versions)
+        return changed
+
+    def __len__(self):
+        return self.rest.shape[0]
+
+    @property
+    def obs(self):
+        """observed wavelength of each line"""
+        return (1. + self.z) * self.rest
+
+    def equiv_width(self, vdisp=None):
+        """equivalent width of each line in pixels of vdisp km/s (Config.vdisp by default)"""
+        vdisp = Config.vdisp if vdisp is None else vdisp
+        return self.ew_coeff * 10. ** self.N / (1. + self.z) / vdisp
+
+    def mask(self, waves=None, min_width=0.29):
+        """
+        lines that fall on waves (clear of the 4 pixels at either end) and
+        are wider than min_width pixels, the limit dude uses.  either test
+        is skipped if its argument is None
+        """
+        if min_width is None:
+            keep = np.ones(len(self), dtype=bool)
+        else:
+            keep = self.equiv_width() > min_width
+        if waves is not None:
+            obs = self.obs
+            keep &= (waves[4] < obs) & (obs < waves[-4])
+        return keep
+
+    def arrays(self, mask=None):
+        """copies of N, b, z, rest, gamma, f, restricted to mask"""
+        if mask is None:
+            mask = np.ones(len(self), dtype=bool)
+        return self.N[mask], self.b[mask], self.z[mask], self.rest[mask], self.gamma[mask], self.f[mask]
 
 
 class ContinuumPointList(ObjList):
@@ -284,6 +481,14 @@ class RegionList(ObjList):
                 return True
         return False
 
+    def contains(self, vals):
+        """boolean array, whether each of vals is in a region (bounds included), see in_regions"""
+        vals = np.asarray(vals, dtype=float)
+        starts = np.sort([float(reg.start) for reg in self.objlist])
+        ends = np.sort([float(reg.end) for reg in self.objlist])
+        # regions that have started at val less those that ended before it
+        return np.searchsorted(starts, vals, 'right') - np.searchsorted(ends, vals, 'left') > 0
+
     @classmethod
     def registrar_for(cls, tag):
         return tag == "Region"
@@ -366,15 +571,33 @@ class VelocityViewList(ObjList):
         return tag == "VelocityView"
 
 
+def _node_str(val):
+    """an attribute as written to xml"""
+    if isinstance(val, (bool, np.bool_)):
+        return "true" if val else "false"
+    return str(val)
+
+
 class Data(object):
+    """
+    one datum of a fit.  its attributes are the source of truth, and its xml
+    node is only built from them when something serializes it (see node)
+
+    Absorber, ContinuumPoint and Region keep their node_attrib in
+    __slots__, as a ModelDB can hold millions of them.  any other attribute
+    (e.g. an unexpected one in the xml) goes to a dict made on first use,
+    and id and ionName are interned
+    """
+    __slots__ = ('tag', '_node', '_node_keys', '_dirty', '_extra')
     node_attrib = []
 
     def __init__(self, *args, **kwargs):
         tag = kwargs.get('tag', False)
         if not tag:
             self.tag = self.__class__.__name__
-        self.node = kwargs.pop('node', None)
-        if self.node:
+        node = kwargs.pop('node', None)
+        self.node = node
+        if node:
             self.parse_node()
         else:
             for key, val in kwargs.items():
@@ -387,6 +610,73 @@ class Data(object):
 
                     # self.get_mock_node()
 
+    def __setattr__(self, name, value):
+        if name in ('id', 'ionName') and type(value) is str:
+            value = sys.intern(value)
+        try:
+            object.__setattr__(self, name, value)
+        except AttributeError:  # not a slot
+            try:
+                extra = object.__getattribute__(self, '_extra')
+            except AttributeError:
+                extra = {}
+                object.__setattr__(self, '_extra', extra)
+            extra[name] = value
+        if not name.startswith('_'):
+            object.__setattr__(self, '_dirty', True)  # see node
+
+    def __getattr__(self, name):
+        # only called when name isn't a set slot or in __dict__
+        try:
+            return object.__getattribute__(self, '_extra')[name]
+        except (AttributeError, KeyError):
+            raise AttributeError("%s has no attribute %s" % (type(self).__name__, name))
+
+    def __getstate__(self):
+        # the node is rebuilt on demand, so copies and pickles leave it out
+        state = {}
+        for cls in type(self).__mro__:
+            for name in cls.__dict__.get('__slots__', ()):
+                if name not in ('_node', '_extra') and hasattr(self, name):
+                    state[name] = object.__getattribute__(self, name)
+        state.update(getattr(self, '_extra', {}))
+        state.update(getattr(self, '__dict__', {}))
+        state['_dirty'] = True
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            Data.__setattr__(self, name, value)
+
+    def __deepcopy__(self, memo):
+        # attributes are all numbers, strings or bools, so a shallow copy will do
+        new = object.__new__(type(self))
+        new.__setstate__(self.__getstate__())
+        memo[id(self)] = new
+        return new
+
+    @property
+    def node(self):
+        """
+        xml node of this datum.  built from the attributes the first time
+        it's asked for, then reused until one of them is set again.  a
+        datum read from xml keeps the attributes of its original node
+        """
+        if getattr(self, '_dirty', True) or getattr(self, '_node', None) is None:
+            keys = list(getattr(self, '_node_keys', ()))
+            keys += [key for key in self.node_attrib if key not in keys]
+            attrib = {key: _node_str(getattr(self, key)) for key in keys if hasattr(self, key)}
+            object.__setattr__(self, '_node', et.Element(self.tag, attrib))
+            object.__setattr__(self, '_dirty', False)
+        return self._node
+
+    @node.setter
+    def node(self, node):
+        keys = tuple(node.attrib.keys()) if node is not None else ()
+        object.__setattr__(self, '_node', node)
+        object.__setattr__(self, '_node_keys', _node_keys.setdefault(keys, keys))
+        object.__setattr__(self, '_dirty', node is None)
+
     def get_mock_node(self):
         attrs = [attr for attr in dir(self) if not attr.startswith('__') and attr not in ['tag', 'node']]
         attrib = {str(k): str(getattr(self, k)) for k in attrs}
@@ -452,6 +742,8 @@ class Data(object):
         inst = cls(**kwargs)
         inst.parse_node()
         inst.validate_init()
+        # everything is in the attributes now, and the node can be rebuilt from them
+        object.__setattr__(inst, '_node', None)
 
         return inst
 
@@ -518,7 +810,8 @@ class Data(object):
     def parse_node(self, node=None):
         """read from node, set attribs to self"""
         if node == None:
-            node = self.node
+            # the node given on construction, not one rebuilt from the defaults set since
+            node = self._node if getattr(self, '_node', None) is not None else self.node
 
         data = node.attrib
         for key, val in data.items():
@@ -531,6 +824,8 @@ class Data(object):
                     setattr(self, str(key), float(val))
                 except:
                     setattr(self, str(key), str(val))
+        if node is getattr(self, '_node', None):
+            object.__setattr__(self, '_dirty', False)  # the node already says all this
 
     def set_node(self, **kwargs):
         """set values from self to node"""
@@ -538,15 +833,14 @@ class Data(object):
             self.node.set(key, str(val))
 
     def set_data(self, **kwargs):
-        """set kwargs to self and apply to node"""
+        """set kwargs to self.  the node follows the next time it's asked for"""
         for key, val in list(kwargs.items()):
             if "Locked" in key:
                 if not type(val) is bool:
                     assert isinstance(val, str)
                     assert val in tf.keys()
-                self.node.set(key, str(val).lower())
+                    val = tf[val]
             setattr(self, key, val)
-            self.node.set(key, str(val))
 
 
 class Absorber(Data):
@@ -554,6 +848,7 @@ class Absorber(Data):
                    "N", "NLocked", "NError",
                    "b", "bLocked", "bError",
                    "z", "zLocked", "zError"]
+    __slots__ = tuple(node_attrib + ['_version'])
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -592,6 +887,12 @@ class Absorber(Data):
                 elif attr in "NError bError zError":
                     setattr(self, attr, 0.0)
 
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        if name in ('N', 'b', 'z', 'ionName', 'NLocked', 'bLocked', 'zLocked'):
+            # lets a LineTable tell which absorbers changed
+            super().__setattr__('_version', next(_versions))
+
     @classmethod
     def registrar_for(cls, tag):
         return tag == "Absorber"
@@ -682,6 +983,7 @@ class Absorber(Data):
 
 class ContinuumPoint(Data):
     node_attrib = ["id", "x", "xLocked", "xError", "y", "yLocked", "yError"]
+    __slots__ = tuple(node_attrib)
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -736,6 +1038,7 @@ class ContinuumPoint(Data):
 
 class Region(Data):
     node_attrib = ["start", "end"]
+    __slots__ = tuple(node_attrib)
 
     def __init__(self, *args, **kwargs):
         self.start = kwargs.get('start')
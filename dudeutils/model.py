@@ -1,15 +1,17 @@
 import copy
 import os.path
 import pickle
+import threading
 import warnings
 import xml.etree.ElementTree as et
+from collections import OrderedDict, namedtuple
 
 import numpy as np
 from numpy.random import random_sample, randn
 
 import dudeutils.data_types as data_types
+import dudeutils.spectrum_store as spectrum_store
 from dudeutils.constraints import Constraint
-from dudeutils.wavelength import get_waves
 
 c = 299792.458  # speed of light in km/s
 
@@ -18,6 +20,57 @@ def tf(val):
     return "true" if val in [True, "true"] else "false"
 
 
+# pixel indices of a region list on a spectrum, along with the same pixels
+# as contiguous [start, end) runs.  the arrays are read-only, since they are
+# shared by every model fitting the same regions
+RegionIndex = namedtuple('RegionIndex', ['indices', 'starts', 'ends'])
+
+_cache_size = 16
+_cache_lock = threading.Lock()
+_region_cache = OrderedDict()
+
+
+def _cached(cache, key, make):
+    """least recently used lookup, make() fills in a miss"""
+    with _cache_lock:
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+    val = make()
+    with _cache_lock:
+        cache[key] = val
+        while len(cache) > _cache_size:
+            cache.popitem(last=False)
+    return val
+
+
+def _read_only(arr):
+    arr.flags.writeable = False
+    return arr
+
+
+def region_index(path, regions):
+    """
+    RegionIndex of regions on the spectrum in path: pixels strictly between
+    the start and end of some region.  cached on the spectrum file's
+    spectrum_key and the regions' bounds, so it is only worked out again
+    when one of them changes
+    """
+    bounds = tuple((float(reg.start), float(reg.end)) for reg in regions)
+
+    def make():
+        waves = spectrum_store.store.waves(path)
+        inside = np.zeros(waves.shape[0], dtype=bool)
+        for start, end in bounds:
+            inside |= (waves > start) & (waves < end)
+        indices = np.flatnonzero(inside)
+        edges = np.diff(np.concatenate(([False], inside, [False])).astype(np.int8))
+        starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+        return RegionIndex(*map(_read_only, (indices, starts, ends)))
+
+    return _cached(_region_cache, (spectrum_store.spectrum_key(path), bounds), make)
+
+
 class Model(object):
     # this dict maps ObjList subclasses to their associated data type
     model_classes = {"AbsorberList": "Absorber",
@@ -25,6 +78,9 @@ class Model(object):
                      "RegionList": "Region",
                      "SingleViewList": "SingleView",
                      "VelocityViewList": "VelocityView"}
+    # the parameters of each data type in param_vector, in order
+    param_attrs = {"Absorber": ("N", "b", "z"),
+                   "ContinuumPoint": ("x", "y")}
 
     def __init__(self, **kwargs):
         self.pixels = 0
@@ -35,6 +91,7 @@ class Model(object):
         self.xmlfile = kwargs.pop("xmlfile", None)
         self.get_all = kwargs.pop("get_all", True)
         self.abs_ids = kwargs.pop("abs_ids", None)
+        self.tied = set(kwargs.pop("tied", ()))  # ids of absorbers whose params are tied to another's
 
         if self.xmlfile:
             self.read()
@@ -96,39 +153,44 @@ class Model(object):
         return string
 
     def get_indices(self):
-        waves = self.get_waves()
-        self.indices = self.region_list.get_indices(waves)
+        self.indices = self.region_index().indices
         return self.indices
 
-    def get_waves(self):
-        if self.flux.endswith('.fits'):
-            waves = get_waves(self.flux)
-        else:
-            col1, col2, *cols = np.loadtxt(self.flux, unpack=True)
-            waves = col2 if np.all(col1) == 0 else col1
-        return waves
+    def region_index(self):
+        """RegionIndex of this model's regions on its spectrum, see model.region_index"""
+        return region_index(self.flux, self.region_list)
 
-    def _update_pixels(self):
+    def get_waves(self):
+        return spectrum_store.store.waves(self.flux)
 
-        waves = self.get_waves()
-        self.indices = self.region_list.get_indices(waves)
+    def _update_pixels(self, region=None):
+        region = self.region_index() if region is None else region
+        self.indices = region.indices
         self.pixels = len(self.indices)
 
     def _update_params(self):
-        self.params = 0
-        for ab in self.absorber_list:
-            if ab.NLocked and ab.bLocked and ab.zLocked:
-                continue
-            for line in ab.get_lines():
-                if self.region_list.in_regions(line.get_obs(ab.z)):
-                    # this seems to be the limit that dude uses
-                    if line.get_equiv_width(ab.N, ab.z, pixels=True) > 0.29:
-                        self.params += [ab.NLocked, ab.bLocked, ab.zLocked].count(False)
-                        break  # to prevent multi-counting of same absorber
+        table = self.line_table
+        # this seems to be the limit that dude uses
+        fit = self.region_list.contains(table.obs) & table.mask()
+        # counted once, however many of its lines are fit
+        self.fitted = np.bincount(table.absorber[fit], minlength=len(table.absorbers)) > 0
+        self.params = int(table.free[self.fitted].sum())
 
     def update_dof(self):
+        """
+        count pixels and params.  they are only recounted when the regions,
+        the spectrum, the absorbers (N, b, z, ion or locks) or Config.vdisp
+        have changed since the last count
+        """
+        table = self.line_table
+        region = self.region_index()
+        key = (table.revision, region, data_types.Config.vdisp)
+        cached = self.__dict__.get('_dof_key')
+        if cached is not None and cached[0] == key[0] and cached[1] is region and cached[2] == key[2]:
+            return
         self._update_params()
-        self._update_pixels()
+        self._update_pixels(region)
+        self._dof_key = key
 
     @property
     def reduced_chi2(self):
@@ -230,25 +292,28 @@ class Model(object):
                     abs_ids=copy.copy(self.abs_ids),
                     AbsorberList=copy.deepcopy(self.absorber_list),
                     ContinuumPointList=copy.deepcopy(self.cont_point_list),
-                    RegionList=copy.deepcopy(self.region_list))
+                    RegionList=copy.deepcopy(self.region_list),
+                    tied=self.tied)
 
         mod.xmlfile = copy.copy(self.xmlfile)  # this needs to be done outside of instantiation.
 
         return mod
 
+    def get_lst(self, tag):
+        """the ObjList named tag, e.g. 'AbsorberList'"""
+        return getattr(self, tag)
+
     def set_absorbers(self, ab_lst):
         for ab in ab_lst:
-            for i, ab_ in enumerate(self.absorber_list):
-                if ab_.id == ab.id:
-                    self.absorber_list[i] = ab
-                    break
+            found = Model._positions(ab.id, self.absorber_list)
+            if found:
+                self.absorber_list[found[0]] = ab
 
     def set_cont_points(self, cont_lst):
         for cnt in cont_lst:
-            for i, cnt_ in enumerate(self.cont_point_list):
-                if cnt_.id == cnt.id:
-                    self.cont_point_list[i] = cnt
-                    break
+            found = Model._positions(cnt.id, self.cont_point_list)
+            if found:
+                self.cont_point_list[found[0]] = cnt
 
     def build_xml(self, raw_data='', spname='', sptype=''):
         """build a dude-style xml for this model"""
@@ -292,18 +357,18 @@ class Model(object):
         tst = self.get_lst(tag)
         assert tst
 
-        for item in self.get_lst(tag):
-            if iden == item.id:
-                if param:
-                    if "Locked" in param:
-                        return bool(getattr(item, param))
-                    try:
-                        return float(getattr(item, param))
-                    except:
-                        return getattr(item, param)
-                else:
-                    return item
-        raise Exception("item not found: %s" % (iden))
+        try:
+            item = tst[Model._get_item(iden, tst)]
+        except Exception:
+            raise Exception("item not found: %s" % (iden))
+        if param:
+            if "Locked" in param:
+                return bool(getattr(item, param))
+            try:
+                return float(getattr(item, param))
+            except:
+                return getattr(item, param)
+        return item
 
     def check_vals(self):
         unphysical = {"b": [0.1, 120.], "N": [8.00, 25.00]}
@@ -437,9 +502,8 @@ class Model(object):
             # get the model's absorber list
             ab_lst = getattr(self, tag)
 
-            for item in ab_lst:  # for item in abslist
-                if item.id == iden:  # if the id of the absorber matches
-                    item.set_data(**kwargs)
+            for i in Model._positions(iden, ab_lst):  # every item with a matching id
+                ab_lst[i].set_data(**kwargs)
 
         else:
             tag = iden.__class__.__name__.split('.')[-1]
@@ -522,6 +586,158 @@ class Model(object):
         except AttributeError:
             raise Exception('can\'t set empty object list')
 
+    @property
+    def line_table(self):
+        """
+        data_types.LineTable of the absorber list, built on first use and
+        then kept up to date with edits to the absorbers
+        """
+        table = self.__dict__.get('_line_table')
+        if table is None:
+            table = self._line_table = data_types.LineTable(self.absorber_list)
+        else:
+            table.update(self.absorber_list)
+        return table
+
+    def static_lines(self):
+        """
+        boolean mask over line_table of the lines of absorbers with N, b and z
+        all locked that aren't in self.tied.  these don't change during a fit,
+        so their optical depth can be computed once (see
+        SpectrumContext.set_background).  read from line_table.locks, and kept
+        until the table's revision or self.tied changes
+        """
+        table = self.line_table
+        key = table.revision, frozenset(self.tied)
+        cached = self.__dict__.get('_static')
+        if cached is None or cached[0] != key:
+            static = table.locks.all(axis=1)
+            if self.tied:
+                static &= np.array([ab.id not in self.tied for ab in table.absorbers], dtype=bool)
+            cached = self._static = (key, static[table.absorber])
+        return cached[1]
+
+    def param_names(self):
+        """
+        name of each entry of param_vector: id_N, id_b, id_z of each absorber
+        then id_x, id_y of each continuum point, as in tie=('H_z', 'D_z')
+        """
+        names = ['%s_%s' % (ab.id, attr) for ab in self.absorber_list for attr in Model.param_attrs['Absorber']]
+        return names + ['%s_%s' % (pt.id, attr) for pt in self._cont_points()
+                        for attr in Model.param_attrs['ContinuumPoint']]
+
+    def param_index(self):
+        """dict of param_names to their index in param_vector.  if a name repeats, the first one"""
+        index = {}
+        for k, name in enumerate(self.param_names()):
+            index.setdefault(name, k)
+        return index
+
+    def _cont_points(self):
+        return self.cont_point_list if self.cont_point_list else []
+
+    def param_vector(self):
+        """
+        every fittable parameter as one array: N, b, z of each absorber
+        (read from line_table) followed by x, y of each continuum point.
+        see param_names, param_locks and param_bounds for the matching
+        names, locks and bounds
+        """
+        cont = [(float(pt.x), float(pt.y)) for pt in self._cont_points()]
+        return np.concatenate((self.line_table.params().ravel(), np.array(cont, dtype=float).ravel()))
+
+    def set_param_vector(self, vec, indices=None):
+        """
+        write parameters back.  the absorber rows of line_table are
+        rewritten as a whole, and only the values that changed are stored on
+        the absorbers and continuum points, without stamping the absorbers
+
+        Input:
+        ------
+        vec : values laid out as param_vector, or if indices is given, the
+              values of just those entries
+        indices : indices into param_vector of the values in vec
+
+        Output:
+        -------
+        indices of the entries that changed
+        """
+        table = self.line_table
+        current = self.param_vector()
+        vec = np.asarray(vec, dtype=float)
+        if indices is None:
+            if vec.shape != current.shape:
+                raise ValueError("expected %d parameters, got %d" % (current.shape[0], vec.shape[0]))
+            new = vec
+        else:
+            new = current.copy()
+            new[np.asarray(indices, dtype=int)] = vec
+        changed = np.flatnonzero(new != current)
+        if not changed.shape[0]:
+            return changed
+
+        num = 3 * len(table.absorbers)
+        if changed[0] < num:
+            table.set_params(new[:num].reshape(-1, 3))
+        cont_points = self._cont_points()
+        for k in changed:
+            if k < num:
+                obj, attr = table.absorbers[k // 3], Model.param_attrs['Absorber'][k % 3]
+                # stamped, so other tables over these absorbers (e.g. the member
+                # views of a CompositeSpectrum) pick up the change.  line_table
+                # already has it, so it only takes the new stamp
+                setattr(obj, attr, float(new[k]))
+                table.versions[k // 3] = obj._version
+            else:
+                obj, attr = cont_points[(k - num) // 2], Model.param_attrs['ContinuumPoint'][(k - num) % 2]
+                setattr(obj, attr, float(new[k]))
+        return changed
+
+    def param_locks(self):
+        """boolean mask over param_vector, True where the parameter is locked"""
+        cont = [(bool(pt.xLocked), bool(pt.yLocked)) for pt in self._cont_points()]
+        return np.concatenate((self.line_table.locks.ravel(), np.array(cont, dtype=bool).ravel()))
+
+    def param_bounds(self, rng=None):
+        """
+        lower and upper bound of each entry of param_vector.  absorbers with
+        an entry in Config.ab_cfg take its range, continuum points with one
+        in Config.cont_cfg are held to y * (1 -/+ ylim / 2).  everything else
+        is its current value -/+ rng[attr] (a fraction of y for continuum
+        points), or unbounded if attr isn't in rng
+
+        Input:
+        ------
+        rng : dict of attr ('N', 'b', 'z', 'x', 'y') to default half width,
+              e.g. from simulated_annealing.OptConst
+
+        Output:
+        -------
+        lo, hi : arrays the shape of param_vector
+        """
+        rng = rng or {}
+        vec = self.param_vector()
+        num = 3 * len(self.absorber_list)
+        width = np.array([rng.get(attr, np.inf) for attr in Model.param_attrs['Absorber']] * len(self.absorber_list) +
+                         [rng.get(attr, np.inf) for attr in Model.param_attrs['ContinuumPoint']] *
+                         len(self._cont_points()), dtype=float)
+        width[num + 1::2] *= np.fabs(vec[num + 1::2])
+        lo, hi = vec - width, vec + width
+
+        ab_cfg, cont_cfg = data_types.Config.ab_cfg, data_types.Config.cont_cfg
+        for i, ab in enumerate(self.absorber_list):
+            for j, attr in enumerate(Model.param_attrs['Absorber']):
+                try:
+                    lo[3 * i + j], hi[3 * i + j] = map(float, ab_cfg[ab.id][attr])
+                except KeyError:
+                    pass
+        for i, pt in enumerate(self._cont_points()):
+            if pt.id in cont_cfg:
+                half = float(cont_cfg[pt.id]['ylim']) / 2.
+                k = num + 2 * i + 1
+                lo[k], hi[k] = sorted(((1. - half) * vec[k], (1. + half) * vec[k]))
+        return lo, hi
+
     def get_spectral_line(self, iden, transition):
         if type(iden) is int:  # gave an index instead of id
             ab = self.absorber_list[iden]
@@ -534,12 +750,19 @@ class Model(object):
         except KeyError:
             raise KeyError("absorber %s has no transition %d" % (str(iden), transition))
 
+    @staticmethod
+    def _positions(_id, lst):
+        """positions of the items of lst with id _id, from the ObjList's index if it is one"""
+        if isinstance(lst, data_types.ObjList):
+            return lst.positions(_id)
+        return [i for i, it in enumerate(lst) if it.id == _id]
+
     @staticmethod
     def _get_item(_id, lst):
-        for i, it in enumerate(lst):
-            if it.id == _id:
-                return i
-        raise Exception(_id, ' not in list ', [str(it) for it in lst])
+        found = Model._positions(_id, lst)
+        if not found:
+            raise Exception(_id, ' not in list ', [str(it) for it in lst])
+        return found[0]
 
     def get_ab_index(self, _id):
         return Model._get_item(_id, self.absorber_list)
@@ -1,7 +1,7 @@
 import numpy as np
 from scipy.optimize import curve_fit
-import _spectrum
-from dudeutils.spec_parser import Spectrum
+import dudeutils.timing as timing
+from dudeutils.spec_parser import Spectrum, lsf_registry
 from dudeutils.data_types import *
 from dudeutils.model import *
 
@@ -41,6 +41,7 @@ def is_locked(param, ab, starts, ends):
     ------
     param : Param instance
     ab: an absorber.  data_types.Absorber type
+    starts, ends: wavelength bounds of the optimization regions
 
     Ouput:
     ------
@@ -57,166 +58,130 @@ def is_locked(param, ab, starts, ends):
     return True
 
 
-def optimize(spec, model):
+@timing.timed('optimize')
+def optimize(spec, model, vsig=None, vdisp=None, fit_cont=True, lsf=None):
     """
     calculate best fit parameters using scipy.optimize.curve_fit
 
+    the model and its derivatives with respect to every free parameter come
+    from one call to the c extension (SpectrumContext.jacobian), so each
+    levenberg-marquardt step costs about one model evaluation instead of
+    one per parameter.
+
     Input:
     ------
-    spec : observed_data.observedData instance
+    spec : spec_parser.Spectrum instance
+    model : model.Model instance
+    vsig, vdisp : line spread function and pixel width, in km/s.
+                  Config.vsig and Config.vdisp by default
+    fit_cont : also fit the y of unlocked continuum points that fall in
+               a region
+    lsf : line spread function in place of vsig and vdisp, see
+          spec_parser.LSFRegistry.get
 
     Output:
     -------
-    results from scipy.optimize.curve_fit.  uses levenberg marquardt optimization
+    unlocked, popt, pcov : the free parameters (Param instances) and the
+    results from scipy.optimize.curve_fit.  best fit values and their errors
+    are written back to the model
 
     Raises:
     -------
     AssertionError
     """
 
-    cont_points = model.get_lst("ContinuumPointList")
-    cont_points = sorted(cont_points, key=lambda pt: pt.x)
-    x = np.array([float(item.x) for item in cont_points])
-    y = np.array([float(item.y) for item in cont_points])
-
-    absorbers = []
-    for item in model.get_lst("AbsorberList"):
-        absorbers += item.get_lines()
-
-    absorbers = list(filter(
-        lambda x:
-        spec.waves[4] < x.get_obs(x.z) < spec.waves[-4],
-        absorbers))
-    regions = Model.get(model.RegionList)
-    starts = np.array([item.start for item in regions], dtype=np.float)
-    ends = np.array([item.end for item in regions], dtype=np.float)
-
-    # convert into numpy array for c extension use
-
-
-    N = np.array([i.N for i in absorbers], dtype=np.float)
-    b = np.array([i.N for i in absorbers], dtype=np.float)
-    z = np.array([i.N for i in absorbers], dtype=np.float)
-    wave = np.array([i.wave for i in absorbers], dtype=np.float)
-    gamma = np.array([i.gamma for i in absorbers], dtype=np.float)
-    f = np.array([i.f for i in absorbers], dtype=np.float)
-
-    # get indices relevant for optimization
-    indices = []
-    for r in range(starts.shape[0]):
-        indices += Spectrum.get_indices(spec.waves, [starts[r], ends[r]])
-
-    assert (len(indices) < spec.waves.shape[0])
-
-    abs_lst = list(model.get_lst('AbsorberList'))
+    regions = model.region_list
+    starts = np.array([item.start for item in regions], dtype=float)
+    ends = np.array([item.end for item in regions], dtype=float)
 
+    abs_lst = list(model.absorber_list)
     param_lst = []
-    for i in range(len(abs_lst)):
-        a = abs_lst[i]
+    for i, a in enumerate(abs_lst):
         # param_name,value, locked, error, parent_id,index=None)
-        Nargs = ["N", a.N, a.NLocked, a.NError, a, i]
-        bargs = ["b", a.b, a.bLocked, a.bError, a, i]
-        zargs = ["z", a.z, a.zLocked, a.zError, a, i]
-
-        param_lst += [Param(*Nargs), Param(*bargs), Param(*zargs)]
-
-    locked, unlocked = [], []
-    for item in param_lst:
-        if is_locked(item, abs_lst[i], starts, ends):
-            locked.append(item)
-        else:
-            unlocked.append(item)
+        for name in ["N", "b", "z"]:
+            param_lst.append(Param(name, getattr(a, name), a.locked(name), getattr(a, name + "Error"), a, i))
+    unlocked = [item for item in param_lst if not is_locked(item, item.absorber, starts, ends)]
 
-    all_params = list(unlocked) + list(locked)
-    # values of the params to vary this gets passed as an argument to the
-    # function to optimize
-    params = [item.value for item in unlocked]
-    # unlocked_indices = [item.index for item in unlocked] #index mapping to all_params
-
-    absorbers = list(set([item.absorber for item in all_params]))
-
-    assert (spec.waves[indices].shape[0] < spec.waves.shape[0])
-
-    def absorption(waves, *params):
-
-        """
-        this is our function to pass into scipy.optimize
-
-        calculate the best fit for given list of *params.  Needs to be in scope 
-        of optimize so that it can inherit some of its objects, while keeping 
-        inputs consistent with scipy.optimize.curve_fit
-
-        Input:
-        ------
-        waves : 1d numpy array of wavelengths 
-        *params : parameters to be optimized.  determined in the parent function
-
-        Output:
-        -------
-        chi2 : chi-square calculated from regions specified in model.RegionList
-
-        Raises:
-        -------
-        AssertionError
-        """
-
-        # update params to locked
-        for i in range(len(unlocked)):
-            unlocked[i].value = params[i]  # set param value
-            all_params[unlocked[i].index] = unlocked[i]  # write back to all_params
-        # now consolidate locked and unlocked parameters into lists for N,b,z
-
-        _N, _b, _z = [], [], []
-        rest, gamma, f = [], [], []
-        for ab in absorbers:
-            lines = ab.get_lines()
-            for line in lines:
-                if waves[4] < line.get_obs() < waves[-4]:
-                    _N.append(line.N)
-                    _b.append(line.b)
-                    _z.append(line.z)
-                    rest.append(float(line.wave))
-                    gamma.append(float(line.gamma))
-                    f.append(float(line.f))
-        N, b, z, rest, gamma, f = tuple(map(np.array, (_N, _b, _z, rest, gamma, f)))
-        # there is an entry of N, b, z for each individual absorption line
-        # so if an absorber has multiple lines in atom.dat, the number will
-        # appear multiple times
-
-        cont, absorption_sp, chi2 = _spectrum.spectrum(spec.waves,
-                                                       spec.flux,
-                                                       spec.error,
-                                                       x, y,
-                                                       N, b, z, rest, gamma, f,
-                                                       starts, ends)
-
-        assert (absorption_sp[indices].shape[0] == waves.shape[0])
-        return absorption_sp[indices]
+    cont_points = sorted(model.cont_point_list, key=lambda pt: pt.x)
+    x = np.array([float(item.x) for item in cont_points])
+    y = np.array([float(item.y) for item in cont_points])
+    if fit_cont:
+        for k, pt in enumerate(cont_points):
+            if not pt.yLocked and regions.in_regions(pt.x):
+                unlocked.append(Param("y", pt.y, False, pt.yError, pt, k))
+
+    # jacobian column of each free parameter, -1 for everything held fixed
+    column = {(item.name, item.index): j for j, item in enumerate(unlocked)}
+    point_columns = np.array([column.get(("y", k), -1) for k in range(len(cont_points))], dtype=int)
+
+    # there is an entry of N, b, z for each individual absorption line, so
+    # if an absorber has multiple lines in atom.dat its parameters appear
+    # multiple times.  line_ab maps each line back to its absorber
+    table = model.line_table
+    on_spec = table.mask(spec.waves, min_width=None)
+    line_ab = table.absorber[on_spec]
+    columns = np.array([[column.get((name, i), -1) for name in ["N", "b", "z"]] for i in line_ab],
+                       dtype=int).reshape(-1, 3)
+    N, b, z, rest, gamma, f = table.arrays(on_spec)
+    values = model.param_vector()[:3 * len(abs_lst)].reshape(-1, 3)
+
+    # lines with no free parameters are computed once, as the context's background
+    fixed = np.all(columns < 0, axis=1)
+    background = [arr[fixed] for arr in (N, b, z, rest, gamma, f)]
+    line_ab, columns, rest, gamma, f = line_ab[~fixed], columns[~fixed], rest[~fixed], gamma[~fixed], f[~fixed]
+
+    region = model.region_index()
+    context = Spectrum.get_context(spec, region.indices, lsf=lsf_registry.get(lsf, vsig, vdisp), pairs=(region.starts, region.ends),
+                                   full=False, background=background)
+    last = {}
+
+    def evaluate(params):
+        """model flux and jacobian over the region pixels, for one set of params"""
+        params = tuple(params)
+        if last.get("params") != params:
+            vals = values.copy()
+            _y = y.copy()
+            for item, val in zip(unlocked, params):
+                if item.name == "y":
+                    _y[item.index] = val
+                else:
+                    vals[item.index, "Nbz".index(item.name)] = val
+            with timing.stage('optimize.jacobian'):
+                pixels, flux, jac = context.jacobian(vals[line_ab, 0], vals[line_ab, 1], vals[line_ab, 2],
+                                                     rest, gamma, f, x, _y, columns, point_columns)
+            last.update(params=params, pixels=pixels, flux=flux, jac=jac)
+        return last["pixels"], last["flux"], last["jac"]
 
     p0 = [item.guess for item in unlocked]
+    pixels = evaluate(p0)[0]
+    good = np.isfinite(spec.flux[pixels]) & np.isfinite(spec.error[pixels]) & (spec.error[pixels] > 0.)
+    assert np.any(good), "no usable pixels in the regions"
 
-    popt, pcov = curve_fit(absorption,
-                           spec.waves[indices],
-                           spec.flux[indices],
-                           p0=p0,
-                           sigma=spec.error[indices])
+    # curve_fit calls these one after the other with the same params, so
+    # evaluate only goes to the c extension once per step
+    def absorption(waves, *params):
+        return evaluate(params)[1][good]
+
+    def jacobian(waves, *params):
+        return evaluate(params)[2][good]
+
+    with timing.stage('optimize.curve_fit'):
+        popt, pcov = curve_fit(absorption,
+                               spec.waves[pixels][good],
+                               spec.flux[pixels][good],
+                               p0=p0,
+                               sigma=spec.error[pixels][good],
+                               jac=jacobian)
     assert (len(popt) == len(unlocked))
 
-    j = 0
-    for i in [item.index for item in unlocked]:
-        all_params[i].value = popt[j]
-        all_params[i].error = np.sqrt(pcov[j][j])  # one stdev
-        j += 1
-
-    # changes should also propagate to unlocked, bc all_params inlcudes unlocked
-
-    for item in all_params:
+    # rewrite new values to model
+    for j, item in enumerate(unlocked):
+        item.value = popt[j]
+        item.error = np.sqrt(pcov[j][j])  # one stdev
         model.set_val(item.absorber, **{item.name: item.value, item.name + "Error": item.error})
 
     return unlocked, popt, pcov
 
-    # rewrite new values to model
-
 
 if __name__ == "__main__":
     import dudeutils
@@ -196,6 +196,29 @@ def prep_data(spec, model, ref=None, wave_r=None, vel_r=None, **kwargs):
     return wave_r, ind, ref
 
 
+def fit_full(spec, model, absorbers=None, ind=None):
+    """
+    fits the model over the whole spectrum, for plotting
+
+    Input:
+    ------
+    spec : specParser.Spectrum instance
+    model : model.Model instance
+    absorbers : SpectralLine, or list of them, to include.  all by default
+    ind : indices of the pixels to return.  all by default
+
+    Output:
+    -------
+    waves, flux, error, ab, cont : arrays over the selected pixels
+    """
+    if type(absorbers) is SpectralLine:
+        absorbers = [absorbers]
+    ab, cont, chi2 = Spectrum.fit_absorption(spec, model, ab_to_fit=absorbers, full=True)
+    if ind is None:
+        ind = slice(None)
+    return spec.waves[ind], spec.flux[ind], spec.error[ind], ab[ind], cont[ind]
+
+
 def get_ab(spec, model, ref, ind, absorbers, vel_r=True, return_ab=True, all_ab=False):
     if all_ab:
         absorbers = None
@@ -203,19 +226,10 @@ def get_ab(spec, model, ref, ind, absorbers, vel_r=True, return_ab=True, all_ab=
         if type(absorbers) is list:
             return [get_ab(spec, model, ref, ind, ab, vel_r, return_ab) for ab in absorbers]
         absorbers = prep_absorbers(spec, model, absorbers)
-    if type(spec) is TextSpectrum:
+    if type(spec) is TextSpectrum and all_ab:
         waves, flux, error, ab, cont = spec.waves[ind], spec.flux[ind], spec.error[ind], spec.abs[ind], spec.cont[ind]
-        if not all_ab:
-            waves, flux, error, ab, cont, chi2 = Spectrum.fit_absorption(spec,
-                                                                         model,
-                                                                         ab_to_plot=absorbers,
-                                                                         indices=ind)
-
     else:
-        waves, flux, error, ab, cont, chi2 = Spectrum.fit_absorption(spec,
-                                                                     model,
-                                                                     ab_to_plot=absorbers,
-                                                                     indices=ind)
+        waves, flux, error, ab, cont = fit_full(spec, model, absorbers, ind)
 
     if vel_r:
         waves = Spectrum.convert_to_vel(waves, ref)
@@ -236,8 +250,7 @@ def label_lines(ax, x, y, label):
 
 def plot_no_lines(center_wave, wave_range, exponent=14):
     model, spec = parse_spectrum(Model(xmlfile="/home/scott/research/J0744+2059/DH_1comp.copy.xml"))
-    waves, flux, error, ab, cont, chi2 = Spectrum.fit_absorption(spec,
-                                                                 model)
+    waves, flux, error, ab, cont = fit_full(spec, model)
     flux *= 10 ** float(exponent)
     x, y = [], []
     for i in range(0, waves.shape[0]):
@@ -255,7 +268,7 @@ def plot_continua(spec, db, fact=13, xlims=[4842, 4860.], wavelength=4847.25):
 
     count, ind = 0, 0
     for mod in db:
-        waves, flux, error, ab, cont, chi2 = Spectrum.fit_absorption(spec, mod, indices=indices)
+        waves, flux, error, ab, cont = fit_full(spec, mod, ind=indices)
         if count == 0:
             plt.plot(waves, flux * 10. ** fact, color='k', linestyle='steps')
             ind = np.argmin(np.fabs(waves - wavelength))
@@ -5,6 +5,7 @@ from random import shuffle
 
 import matplotlib.pyplot as plt
 
+import dudeutils.timing as timing
 from dudeutils.config import Config
 from dudeutils.model import *
 from dudeutils.model_csv_io import ModelIO
@@ -76,10 +77,7 @@ def get_nsigma(db, n=1):
 
 
 def _get_item(_id, lst):
-    for i, it in enumerate(lst):
-        if it.id == _id:
-            return i
-    raise Exception(_id, ' not in list ', [str(it) for it in lst])
+    return Model._get_item(_id, lst)
 
 
 class RandomSample(object):
@@ -91,6 +89,9 @@ class RandomSample(object):
 
     def __call__(self):
         simulated_annealing(self.spec, self.model, self.writr, **self.kwargs)
+        if timing.is_enabled() and self.kwargs.get('model_outputs'):
+            # for random_sampling_multiproc to collect, next to the outputs
+            timing.worker_dump(os.path.split(self.kwargs['model_outputs'])[0])
 
 
 def random_sampling_multiproc(model, ab_cfg, cont_cfg, **kwargs):
@@ -116,6 +117,9 @@ def random_sampling_multiproc(model, ab_cfg, cont_cfg, **kwargs):
     for prefix in generate_prefixes(ab_cfg, cont_cfg):
         ModelIO(path=path, output_name=prefix + '.csv', overwrite=True).join_csv(prefix=prefix)
 
+    if timing.collect(path) is not None:
+        print(timing.report())
+
 
 # def random_sampling_pool(model, ab_cfg, cont_cfg, **kwargs):
 #     """
@@ -191,7 +195,8 @@ def random_sampling_multiproc(model, ab_cfg, cont_cfg, **kwargs):
 def assemble_jobs(model, ab_cfg, cont_cfg, **kwargs):
     tasks = []
     # ab_lst, cnt_lst = get_region_objects(model)  # returns a copy of the lists
-    sp = Spectrum.sniffer(model)
+    # spectrum= may be a spec_parser.CompositeSpectrum, to fit several spectra jointly
+    sp = kwargs.get('spectrum') or Spectrum.sniffer(model)
     path, _ = os.path.split(kwargs.get('source'))
     ctr = 0
     num_it = int(kwargs.get('num_iterations', default_iterations))
@@ -255,7 +260,8 @@ def get_region_objects(model):
 
 def plot_spec(model):
     spec = Spectrum.sniffer(model)
-    ab, cont, chi2 = Spectrum.fit_absorption(spec, model, vdisp=Config.vdisp, vsig=Config.vsig, get_all=True)
+    ab, cont, chi2 = Spectrum.fit_absorption(spec, model, vdisp=Config.vdisp, vsig=Config.vsig, get_all=True,
+                                             full=True)
     waves, flux, error = spec.waves, spec.flux, spec.error
     plt.plot(waves, flux, linestyle='steps', color='k')
     plt.plot(waves, ab, linestyle='steps', color='r')
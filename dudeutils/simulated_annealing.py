@@ -1,9 +1,9 @@
-import copy
-
 import numpy as np
 from scipy.stats import chi2 as sp_chi2
 
+import dudeutils.timing as timing
 from dudeutils.config import Config
+from dudeutils.data_types import ObjList
 from dudeutils.spec_parser import Spectrum
 
 
@@ -12,6 +12,7 @@ class OptConst(object):
     N_epsilon, b_epsilon, z_epsilon = 0.00001, 0.0001, 10e-8
     x_epsilon, y_epsilon = 0.015, 10e-18  # abt half a pixel at 5000 Angstrom
     Nrng, brng, zrng = 0.7, 2.0, 10e-5
+    yrng = 0.05  # as a fraction of y
     alpha = 0.7
     max_steps = 50
     chi2_pad = 16.
@@ -30,19 +31,6 @@ class OptConst(object):
                 pass
 
 
-def attr_vary(ab, attr, rng, step):
-    if bool(getattr(ab, attr + 'Locked')):
-        return
-    _rng = step * float(rng[1] - rng[0]) / 2.
-    current = getattr(ab, attr)
-    setattr(ab, attr, np.fabs(np.random.normal(loc=current, scale=np.fabs(_rng))))
-    if ab.id in dict(Config.ab_cfg, **Config.cont_cfg).keys():  # to prevent drift away from desired models
-        if getattr(ab, attr) < rng[0]:
-            setattr(ab, attr, current + np.fabs(np.random.normal(loc=0., scale=np.fabs(_rng))))
-        elif getattr(ab, attr) > rng[-1]:
-            setattr(ab, attr, current - np.fabs(np.random.normal(loc=0., scale=np.fabs(_rng))))
-
-
 def ab_in_regions(ab, regions):
     for line in ab.get_lines():
         if regions.in_regions(line.get_obs(ab.z)):
@@ -58,25 +46,6 @@ def accept_prob(old_chi2, new_chi2, T):
         return min(np.exp(-delta / T), 1.0)
 
 
-def set_ab_rng(ab, attr):
-    try:
-        rng = tuple(map(float, Config.ab_cfg[ab.id][attr]))
-    except KeyError:
-        rng = (getattr(ab, attr) - getattr(OptConst, attr + 'rng'),
-               getattr(ab, attr) + getattr(OptConst, attr + 'rng'))
-    return rng
-
-
-def set_cnt_rng(cnt, attr):
-    if cnt.id in Config.cont_cfg.keys():
-        _rng = float(Config.cont_cfg[cnt.id]['ylim']) / 2.
-        rng = ((1. - _rng) * getattr(cnt, attr), (1. + _rng) * getattr(cnt, attr))
-    else:  # offset percentage
-        rng = (1. - getattr(OptConst, attr + 'rng') * getattr(cnt, attr),
-               1. + getattr(OptConst, attr + 'rng') * getattr(cnt, attr))
-    return rng
-
-
 def write_model(model):
     return [x for x in model.absorber_list if x.id not in ['null', '']], \
            [x for x in model.cont_point_list if x.id != 'null'], \
@@ -84,12 +53,25 @@ def write_model(model):
 
 
 class Anneal(object):
+    """
+    simulated annealing of one model.  the annealer works on the model in
+    place: a proposal rewrites only the parameters it changes and logs their
+    old values, so going back to the best model undoes just those.  the best
+    model is kept as a flat vector of parameters (see Model.param_vector),
+    and only turned into a Model when best_model is asked for, e.g. to write
+    results.
+    """
+
     def __init__(self, spec, model, writr=None, **kwargs):
         OptConst.set_optimization_constants(kwargs)
         if kwargs:
             for k, v in kwargs.items():
                 setattr(self, k, v)
         self.spec, self.model = spec, model
+        self.tie = kwargs.get('tie', None)
+        # tied absorbers change even when locked, so they can't be static.
+        # they're only added to model.tied while chi2 is computed
+        self.tied = {item.split('_')[0] for item in self.tie} if self.tie else set()
         self.chi2crit = sp_chi2.ppf(0.99, int(model.dof))
         self.ab_lst, self.cnt_lst = self.model.absorber_list, self.model.cont_point_list
 
@@ -99,38 +81,47 @@ class Anneal(object):
         self.annealing_temp = sp_chi2.ppf(0.99, int(self.model.dof)) + OptConst.chi2_pad
 
         self.model.chi2 = self.get_chi2()
-        self.best_model = self.model.copy()
         self.ctr = 0
-        self.tie = kwargs.get('tie', None)
+        self.reset_best()
 
     def reset_model(self):
-        self.model = None
-        self.model = self.best_model.copy()
+        """go back to the best model, undoing the proposals made since"""
+        model = self.model
+        if model.AbsorberList is not self._lists[0] or model.ContinuumPointList is not self._lists[1]:
+            model.AbsorberList, model.ContinuumPointList = self._lists
+            model.set_param_vector(self._best)
+        else:
+            for indices, vals in reversed(self._undo):
+                model.set_param_vector(vals, indices)
+        self._undo = []
+        model.chi2 = self.best_chi2
+        model.pixels, model.params = self._best_counts
 
     def reset_best(self):
-        self.best_model = None
-        self.best_model = self.model.copy()
-
-    def guess_ab(self, ab):
-        if not ab_in_regions(ab, self.regions):
-            return ab
-        Nrng = set_ab_rng(ab, 'N')
-        brng = set_ab_rng(ab, 'b')
-        zrng = set_ab_rng(ab, 'z')
-
-        attr_vary(ab, 'N', Nrng, self.step)  # start param range abt a factor of 2 (in log)
-        attr_vary(ab, 'b', brng, self.step)
-        attr_vary(ab, 'z', zrng, self.step)
-
-        return ab
-
-    def guess_cont(self, cont_point):
-        if not bool(getattr(cont_point, 'yLocked')):
-            if self.regions.in_regions(cont_point.x):
-                y_rng = set_cnt_rng(cont_point, 'y')
-                attr_vary(cont_point, 'y', y_rng, self.step)
-        return cont_point
-
+        """the current model becomes the best one"""
+        model = self.model
+        self._lists = model.AbsorberList, model.ContinuumPointList
+        if getattr(self, '_template', None) is None or self._template[0] is not self._lists:
+            # a structural copy to write best parameters into, only redone if the lists change
+            self._template = (self._lists, model.copy())
+        self._best = model.param_vector()
+        self.best_chi2 = float(model.chi2)
+        self._best_counts = model.pixels, model.params
+        self._best_model = None
+        self._undo = []
+
+    @property
+    def best_model(self):
+        """the best model so far, as a Model of its own"""
+        if self._best_model is None:
+            mod = self._template[1].copy()
+            mod.set_param_vector(self._best)
+            mod.chi2 = self.best_chi2
+            mod.pixels, mod.params = self._best_counts
+            self._best_model = mod
+        return self._best_model
+
+    @timing.timed('anneal.randomize')
     def randomize_parameters(self):
         """
         
@@ -145,28 +136,64 @@ class Anneal(object):
         -------
 
         """
-        self.model.set_absorbers([self.guess_ab(copy.copy(ab)) for ab in self.model.absorber_list])
-        self.model.set_cont_points([self.guess_cont(copy.copy(cnt)) for cnt in self.model.cont_point_list])
+        model = self.model
+        table = model.line_table
+        cont_points = model._cont_points()
+        current = model.param_vector()
+        num = 3 * len(table.absorbers)
+
+        # absorbers with a line in the regions vary, as do the y of continuum points in them
+        regions = self.regions if hasattr(self.regions, 'contains') else ObjList.factory(list(self.regions))
+        in_regions = np.bincount(table.absorber[regions.contains(table.obs)], minlength=len(table.absorbers)) > 0
+        vary = ~model.param_locks()
+        vary[:num] &= np.repeat(in_regions, 3)
+        vary[num::2] = False
+        vary[num + 1::2] &= regions.contains([float(pt.x) for pt in cont_points])
+
+        # the range each parameter is drawn from.  those of absorbers and
+        # continuum points in Config are also kept in their range
+        lo, hi = model.param_bounds({attr: getattr(OptConst, attr + 'rng') for attr in 'Nbzy'})
+        configured = dict(Config.ab_cfg, **Config.cont_cfg).keys()
+        ids = [ab.id for ab in table.absorbers] + [pt.id for pt in cont_points]
+        owner = np.concatenate((np.repeat(np.arange(len(table.absorbers)), 3),
+                                len(table.absorbers) + np.repeat(np.arange(len(cont_points)), 2))).astype(int)
+        clamp = np.array([ids[i] in configured for i in owner], dtype=bool)
+
+        # a normal step about the current value, scaled by the range
+        scale = np.fabs(self.step * (hi - lo) / 2.)[vary]
+        now = current[vary]
+        new = np.fabs(np.random.normal(loc=now, scale=scale))
+        back = np.fabs(np.random.normal(loc=0., scale=scale))
+        new = np.where(clamp[vary] & (new < lo[vary]), now + back, new)
+        new = np.where(clamp[vary] & (new > hi[vary]), now - back, new)
+        proposed = current.copy()
+        proposed[vary] = new
 
         if self.tie:
-            ab1_id, ab2_id = self.tie[0].split('_')[0], self.tie[1].split('_')[0]
-            param = self.tie[0].split('_')[1]
-            i1 = self.model.get_ab_index(ab1_id)
-            i2 = self.model.get_ab_index(ab2_id)
-            if getattr(self.model.absorber_list[i1], param + 'Locked'):
-                set_to = float(getattr(self.model.absorber_list[i1], param))
-                setattr(self.model.absorber_list[i2], param, set_to)
+            index = model.param_index()
+            k1, k2 = index[self.tie[0]], index[self.tie[1]]
+            if model.param_locks()[k1]:
+                proposed[k2] = proposed[k1]
             else:
-                set_to = float(getattr(self.model.absorber_list[i2], param))
-                setattr(self.model.absorber_list[i1], param, set_to)
+                proposed[k1] = proposed[k2]
+
+        changed = np.flatnonzero(proposed != current)
+        self._undo.append((changed, current[changed]))
+        model.set_param_vector(proposed[changed], changed)
 
+    @timing.timed('anneal.get_chi2')
     def get_chi2(self):
-        return Spectrum.fit_absorption(self.spec, self.model,
-                                       vdisp=Config.vdisp, vsig=Config.vsig,
-                                       ab_to_fit=self.model.absorber_list, cont_to_fit=self.model.cont_point_list)[-1]
+        added = self.tied - self.model.tied
+        self.model.tied |= added
+        try:
+            return Spectrum.fit_absorption(self.spec, self.model,
+                                           vdisp=Config.vdisp, vsig=Config.vsig,
+                                           arrays=False)[-1]
+        finally:
+            self.model.tied -= added
 
     def is_bad_model(self, chi2):
-        return chi2 > max([self.best_model.chi2 + OptConst.chi2_pad, self.chi2crit])
+        return chi2 > max([self.best_chi2 + OptConst.chi2_pad, self.chi2crit])
 
 
 def simulated_annealing(spec, model, writr=None, **kwargs):
@@ -196,7 +223,7 @@ def simulated_annealing(spec, model, writr=None, **kwargs):
             annealr.randomize_parameters()
             annealr.model.chi2 = annealr.get_chi2()
             if accept_prob(old_chi2, annealr.model.chi2, annealr.annealing_temp) > np.random.uniform():
-                if annealr.model.chi2 < annealr.best_model.chi2:
+                if annealr.model.chi2 < annealr.best_chi2:
                     i -= OptConst.max_steps  # you get more iterations!!
                     annealr.reset_best()
                 if annealr.step < OptConst.min_step:
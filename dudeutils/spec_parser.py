@@ -1,14 +1,281 @@
-import gc
+import threading
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 import _spectrum
 from scipy.signal import convolve
 
-import dudeutils.wavelength as wavelength
+import dudeutils.timing as timing
+from dudeutils.config import Config
 from dudeutils.data_types import *
 from dudeutils.model import Model
+from dudeutils.spectrum_store import store
+
+
+def gaussian_kernel(vsig, vdisp):
+    """
+    gaussian line spread function of width vsig on pixels of vdisp (both
+    km/s), sampled out to 3 sigma either side and normalized.
+
+    Output:
+    -------
+    (kernel, offset) : a symmetric kernel with an odd number of taps, and
+        the offset of its central tap, for _spectrum.SpectrumContext.set_lsf:
+        model[i] = sum_k absorption[i + offset - k] * kernel[k]
+    """
+    if vsig <= 0 or vdisp <= 0:
+        raise ValueError('vsig and vdisp must be positive, got %s and %s' % (vsig, vdisp))
+    half = int(np.ceil(3.0 * vsig / vdisp))
+    kernel = np.exp(-0.5 * ((np.arange(-half, half + 1) * vdisp) / vsig) ** 2.)
+    kernel /= np.sum(kernel)
+    kernel.flags.writeable = False
+    return kernel, half
+
+
+class LSF(object):
+    """
+    line spread function of a spectrum, a gaussian in velocity whose width
+    can change from one wavelength segment to the next, e.g. for a coadd of
+    several instrument settings.  get these from lsf_registry, which builds
+    each kernel only once.
+
+    Parameters
+    ----------
+    segments : tuple of (wave, vsig, vdisp)
+        resolution redward of wave, in increasing wave.  the first segment
+        also covers everything blueward of its wave
+    kernels : tuple of (kernel, offset)
+        kernel of each segment, see gaussian_kernel
+    """
+
+    def __init__(self, segments, kernels):
+        self.segments = segments
+        self.kernels = kernels
+
+    def __repr__(self):
+        return 'LSF(%s)' % (self.segments,)
+
+    def pixel_starts(self, waves):
+        """first pixel of each segment on waves"""
+        starts = np.searchsorted(waves, [wave for wave, _, _ in self.segments])
+        starts[0] = 0
+        return starts
+
+    def attach(self, ctx, waves):
+        """set this line spread function on a _spectrum.SpectrumContext over waves"""
+        if len(self.kernels) == 1:
+            ctx.set_lsf(*self.kernels[0])
+        else:
+            kernels, offsets = zip(*self.kernels)
+            ctx.set_lsf_segments(self.pixel_starts(waves), kernels, offsets)
+
+    def convolve(self, absorption, waves=None):
+        """
+        convolve absorption with the line spread function.  the kernels are
+        centered, so nothing is shifted.  each segment is convolved with its
+        own kernel, reading its neighbours' pixels at the edges, and scipy
+        picks direct or fft convolution from the kernel and segment sizes
+
+        Input:
+        ------
+        absorption : array
+        waves : wavelengths of absorption.  only needed with several segments
+
+        Output:
+        -------
+        array the same size as absorption
+        """
+        absorption = np.asarray(absorption, dtype=float)
+        if len(self.kernels) == 1:
+            return convolve(absorption, self.kernels[0][0], mode='same')
+        if waves is None:
+            raise ValueError('waves are needed to convolve with %r' % self)
+        size = absorption.shape[0]
+        ends = list(self.pixel_starts(waves)[1:]) + [size]
+        out = np.zeros(size)
+        for start, end, (kernel, half) in zip(self.pixel_starts(waves), ends, self.kernels):
+            if end <= start:
+                continue
+            lo, hi = max(start - half, 0), min(end + half, size)
+            out[start:end] = convolve(absorption[lo:hi], kernel, mode='same')[start - lo:end - lo]
+        return out
+
+
+class LSFRegistry(object):
+    """
+    precomputed line spread functions, one kernel per (vsig, vdisp) and one
+    LSF per set of segments.  these are shared across spectra, fits and
+    threads, and an unchanged LSF is recognised by identity (see
+    Spectrum.get_context)
+    """
+
+    def __init__(self):
+        self._kernels = {}
+        self._lsfs = {}
+
+    def kernel(self, vsig, vdisp):
+        """(kernel, offset) for a gaussian of width vsig on pixels of vdisp, see gaussian_kernel"""
+        key = (float(vsig), float(vdisp))
+        kernel = self._kernels.get(key)
+        if kernel is None:
+            kernel = self._kernels.setdefault(key, gaussian_kernel(*key))
+        return kernel
+
+    def get(self, lsf=None, vsig=None, vdisp=None):
+        """
+        Input:
+        ------
+        lsf : one of
+            None : a gaussian of vsig and vdisp, which default to
+                Config.vsig and Config.vdisp
+            (vsig, vdisp) : a single resolution over the whole spectrum
+            [(wave, vsig, vdisp), ...] : resolution by wavelength segment,
+                see LSF
+            an LSF, returned as it is
+
+        Output:
+        -------
+        LSF
+        """
+        if isinstance(lsf, LSF):
+            return lsf
+        if lsf is None:
+            lsf = (Config.vsig if vsig is None else vsig, Config.vdisp if vdisp is None else vdisp)
+        lsf = tuple(lsf)
+        if len(lsf) == 2 and np.isscalar(lsf[0]):
+            segments = ((0.0, float(lsf[0]), float(lsf[1])),)
+        else:
+            segments = tuple(sorted((float(w), float(vsig), float(vdisp)) for w, vsig, vdisp in lsf))
+            if not segments:
+                raise ValueError('an LSF needs at least one segment')
+            segments = ((0.0,) + segments[0][1:],) + segments[1:]
+        out = self._lsfs.get(segments)
+        if out is None:
+            kernels = tuple(self.kernel(vsig, vdisp) for _, vsig, vdisp in segments)
+            out = self._lsfs.setdefault(segments, LSF(segments, kernels))
+        return out
+
+
+lsf_registry = LSFRegistry()
 
 
 class Spectrum(object):
+    def attach_grid(self, wcs=None):
+        """
+        build the C extension's wavelength grid descriptor for self.waves.
+        this only needs doing once per spectrum; the grid is then shared by
+        every call into _spectrum.
+
+        Parameters
+        ----------
+        wcs : wavelength.WaveUtils1D (optional)
+            wavelength solution of a fits file.  if None, the scale is
+            detected from self.waves
+
+        Returns
+        -------
+        _spectrum.WaveGrid
+        """
+        if wcs is None:
+            self.grid = _spectrum.WaveGrid(self.waves)
+        else:
+            self.grid = _spectrum.WaveGrid(self.waves, crval=wcs.crval, cdelt=wcs.cdelt,
+                                           crpix=wcs.crpix, loglin=wcs.loglin)
+        return self.grid
+
+    def get_context(self, indices=None, lsf=None, pairs=None, full=None, background=None):
+        """
+        persistent _spectrum.SpectrumContext for this spectrum.  it is built on
+        first use and holds onto the spectrum arrays, fit regions and scratch
+        buffers, so every later evaluation in this process reuses it.
+
+        each thread gets its own context, so fits running concurrently in a
+        thread pool don't wait on each other.  the contexts share the spectrum
+        arrays and grid rather than copying them.
+
+        Parameters
+        ----------
+        indices : list of int (optional)
+            pixel indices of the fit regions.  the context's regions are only
+            reset when these change
+        lsf : LSF, or anything LSFRegistry.get takes (optional)
+            line spread function to convolve with before computing chi2.
+            likewise only reset when it changes
+        pairs : (starts, ends) (optional)
+            indices as contiguous [start, end) runs, if already known (see
+            model.RegionIndex)
+        full : bool (optional)
+            evaluate the whole spectrum (True) or only the pixels chi2
+            depends on (False), see SpectrumContext.set_restricted.  left as
+            it is if None
+        background : (N, b, z, rest, gamma, f) (optional)
+            lines held fixed, see SpectrumContext.set_background.  only
+            recomputed when they change
+
+        Returns
+        -------
+        _spectrum.SpectrumContext
+        """
+        if _spectrum.get_voigt() != Config.voigt:
+            # the profile is process-wide in the c extension
+            _spectrum.set_voigt(Config.voigt)
+        local = self.__dict__.get('_contexts')
+        if local is None:
+            local = self.__dict__.setdefault('_contexts', threading.local())
+        ctx = getattr(local, 'context', None)
+        if ctx is None:
+            grid = getattr(self, 'grid', None)
+            if grid is None:
+                grid = Spectrum.attach_grid(self)
+            ctx = _spectrum.SpectrumContext(self.waves, self.flux, self.error, grid=grid)
+            local.context = ctx
+            local.indices = None
+            local.lsf = None
+        if indices is not None and indices is not local.indices and not np.array_equal(indices, local.indices):
+            starts, ends = pairs if pairs is not None else Spectrum.index_pairs(indices)
+            ctx.set_regions(starts, ends)
+            # cached region indices are read-only and can be held as they are
+            writeable = getattr(getattr(indices, 'flags', None), 'writeable', True)
+            local.indices = np.array(indices) if writeable else indices
+        if lsf is not None:
+            lsf = lsf_registry.get(lsf)
+            if lsf is not local.lsf:
+                lsf.attach(ctx, self.waves)
+                local.lsf = lsf
+        if full is not None and bool(full) == ctx.restricted:
+            ctx.set_restricted(not full)
+        if background is not None:
+            ctx.set_background(*background)
+        return ctx
+
+    def __getstate__(self):
+        # extension objects don't pickle.  they are rebuilt on demand.  arrays
+        # read through spectrum_store are attached again from the same files
+        # rather than copied
+        state = dict(self.__dict__)
+        drop = ['grid', '_contexts']
+        if state.get('source') is not None:
+            drop += ['waves', 'flux', 'error', 'abs', 'cont']
+        for key in drop:
+            state.pop(key, None)
+        return state
+
+    def __setstate__(self, state):
+        if state.get('source') is not None:
+            type(self).__init__(self, *state['source'])
+        self.__dict__.update(state)
+
+    @staticmethod
+    def index_pairs(indices):
+        """split sorted pixel indices into contiguous [start, end) runs"""
+        ind = np.asarray(indices, dtype=int)
+        if ind.shape[0] == 0:
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+        breaks = np.where(np.diff(ind) > 1)[0]
+        starts = np.concatenate(([ind[0]], ind[breaks + 1]))
+        ends = np.concatenate((ind[breaks], [ind[-1]])) + 1
+        return starts, ends
+
     @staticmethod
     def sniffer(filename, *args, **kwargs):
         """
@@ -124,40 +391,26 @@ class Spectrum(object):
     # @staticmethod
     # @profile
     @staticmethod
-    def fit_absorption(spec, model, vsig=3.4, vdisp=2.14,
-                       ab_to_fit=None, cont_to_fit=None, get_all=False):
+    def line_arrays(spec, model, ab_to_fit=None):
         """
         Input:
         ------
         spec : specParser.Spectrum instance
         model : model.Model instance
-        ab_to_fit: included absorbers.  to include no absorbers, include as []
+        ab_to_fit: included absorbers, defaults to model.absorber_list
 
         Output:
         -------
-        cont : the continuum of the spectrum
-        absorption : absorption of the spectrum
-        chi2 : chi-square calculated for spectral regions specified in
-               model.RegionList 
-
-        Raises:
-        -------
-        AssertionError
+        N, b, z, rest, gamma, f : arrays with one entry per spectral line
+                                  that falls on the spectrum
 
         """
-        try:
-            vdisp, vsig = float(vdisp), float(vsig)
-        except:
-            print(vdisp, vsig)
-            raise Exception()
-        wv, flux, e = spec.waves, spec.flux, spec.error
-
-        # wv, flux, e = Spectrum.truncate(spec, indices)
-        abslst = ab_to_fit if ab_to_fit else model.absorber_list
-        cont_points = cont_to_fit if cont_to_fit else model.cont_point_list
-        cont_points = sorted(cont_points, key=lambda pt: pt.x)
-        x = np.array([float(item.x) for item in cont_points])
-        y = np.array([float(item.y) for item in cont_points])
+        wv = spec.waves
+        if not ab_to_fit:
+            # the model's line table is kept between calls
+            table = model.line_table
+            return table.arrays(table.mask(wv))
+        abslst = ab_to_fit
 
         spec_lines = []
 
@@ -175,42 +428,225 @@ class Spectrum(object):
                       wv[4] < it.get_obs(it.z) < wv[-4] and it.get_equiv_width(it.N, it.z, pixels=True) > 0.29]
 
         # convert into numpy array for c extension use
-        N = np.array([item.N for item in spec_lines], dtype=np.float)
-        b = np.array([item.b for item in spec_lines], dtype=np.float)
-        z = np.array([item.z for item in spec_lines], dtype=np.float)
-        rest = np.array([item.wave for item in spec_lines], dtype=np.float)
-        gamma = np.array([item.gamma for item in spec_lines], dtype=np.float)
-        f = np.array([item.f for item in spec_lines], dtype=np.float)
-
-        cont, absorption = _spectrum.spectrum(wv,
-                                              x, y,
-                                              N, b, z, rest, gamma, f)
-
-        ind = model.get_indices()
-        width = int((6.0 * float(vsig) / float(vdisp))) + 1
-        # kernel = 1.0 / (vsig * np.sqrt(2.0 * np.pi))
-        kernel = np.exp(-0.5 * ((np.arange(width) * vdisp) / vsig) ** 2.)
-        kernel /= np.sum(kernel)
-        absorption = convolve(absorption, kernel, mode='same')
-        absorption = np.concatenate((np.zeros(3), absorption[:-3]))  # looks like the convolve offsets abs by 5 or so
-
-        model.update_dof()
-        # ind = model.get_indices()
-
-        chi2 = Spectrum.get_chi2(flux, absorption, e, ind)
-        gc.collect()
+        N = np.array([item.N for item in spec_lines], dtype=float)
+        b = np.array([item.b for item in spec_lines], dtype=float)
+        z = np.array([item.z for item in spec_lines], dtype=float)
+        rest = np.array([item.wave for item in spec_lines], dtype=float)
+        gamma = np.array([item.gamma for item in spec_lines], dtype=float)
+        f = np.array([item.f for item in spec_lines], dtype=float)
+        return N, b, z, rest, gamma, f
+
+    @staticmethod
+    def split_lines(spec, model):
+        """
+        the model's lines on the spectrum (as line_arrays picks them) split
+        into those that vary and those that don't, because all of their
+        absorber's parameters are locked (see Model.static_lines)
+
+        Output:
+        -------
+        (N, b, z, rest, gamma, f), (N, b, z, rest, gamma, f) : varying and
+            static lines
+        """
+        table = model.line_table
+        on_spec = table.mask(spec.waves)
+        static = model.static_lines()
+        return table.arrays(on_spec & ~static), table.arrays(on_spec & static)
+
+    @staticmethod
+    def cont_arrays(model, cont_to_fit=None):
+        """continuum point x and y arrays, sorted by x"""
+        cont_points = cont_to_fit if cont_to_fit else model.cont_point_list
+        cont_points = sorted(cont_points, key=lambda pt: pt.x)
+        x = np.array([float(item.x) for item in cont_points])
+        y = np.array([float(item.y) for item in cont_points])
+        return x, y
+
+    @staticmethod
+    def lsf_kernel(vsig=None, vdisp=None):
+        """
+        (kernel, offset) of the gaussian line spread function, by default
+        the one set by Config.vsig and Config.vdisp.  see gaussian_kernel
+        """
+        return lsf_registry.get(None, vsig, vdisp).kernels[0]
+
+    @staticmethod
+    def convolve(absorption, vsig=None, vdisp=None, lsf=None, waves=None):
+        """
+        convolve absorption with the line spread function, lsf if given
+        (see LSFRegistry.get), otherwise a gaussian of vsig and vdisp which
+        default to Config's
+        """
+        return lsf_registry.get(lsf, vsig, vdisp).convolve(absorption, waves)
+
+    @staticmethod
+    def fit_absorption(spec, model, vsig=None, vdisp=None,
+                       ab_to_fit=None, cont_to_fit=None, get_all=False, arrays=True, full=False, lsf=None):
+        """
+        Input:
+        ------
+        spec : specParser.Spectrum or CompositeSpectrum instance
+        model : model.Model instance
+        vsig, vdisp : gaussian line spread function and pixel width in km/s,
+                      Config.vsig and Config.vdisp by default
+        ab_to_fit: included absorbers.  to include no absorbers, include as []
+        arrays: if False, absorption and cont come back as None.  convolution
+                and chi2 are done in the c extension over the fit regions
+                only, so nothing spectrum-sized is copied when just chi2 is
+                needed
+        full: if False, the model is only evaluated over the fit regions
+              padded by the line spread function, and absorption and cont
+              are zero elsewhere.  set it to get the whole spectrum, e.g.
+              for plotting.  chi2 is the same either way
+        lsf: line spread function in place of vsig and vdisp, e.g. one that
+             varies by wavelength segment.  see LSFRegistry.get
+
+        Output:
+        -------
+        cont : the continuum of the spectrum
+        absorption : absorption of the spectrum, convolved with the line
+                     spread function
+        chi2 : chi-square calculated for spectral regions specified in
+               model.RegionList.  nan and inf pixels are left out
+
+        Raises:
+        -------
+        AssertionError
+
+        """
+        if isinstance(spec, CompositeSpectrum):
+            return spec.fit_absorption(model, vsig, vdisp, ab_to_fit=ab_to_fit, cont_to_fit=cont_to_fit,
+                                       arrays=arrays, full=full, lsf=lsf)
+        lsf = lsf_registry.get(lsf, vsig, vdisp)
+        flux, e = spec.flux, spec.error
+
+        with timing.stage('fit.lines'):
+            x, y = Spectrum.cont_arrays(model, cont_to_fit)
+            if ab_to_fit:
+                N, b, z, rest, gamma, f = Spectrum.line_arrays(spec, model, ab_to_fit)
+                background = [np.zeros(0)] * 6
+            else:
+                # fully locked absorbers are computed once and kept in the context
+                (N, b, z, rest, gamma, f), background = Spectrum.split_lines(spec, model)
+
+        with timing.stage('fit.regions'):
+            region = model.region_index()
+        with timing.stage('fit.context'):
+            context = Spectrum.get_context(spec, region.indices, lsf=lsf,
+                                           pairs=(region.starts, region.ends), full=full, background=background)
+        with timing.stage('fit.evaluate'):
+            if arrays:
+                cont, _, chi2 = context.evaluate(N, b, z, rest, gamma, f, x, y)
+            else:
+                chi2 = context.evaluate(N, b, z, rest, gamma, f, x, y, arrays=False)
+                absorption, cont = None, None
+        if arrays:
+            with timing.stage('fit.convolve'):
+                absorption = context.convolved()
+
+        with timing.stage('fit.dof'):
+            model.update_dof()
 
         return absorption, cont, chi2
 
+    @staticmethod
+    def fit_absorption_many(spec, models, vsig=None, vdisp=None, lsf=None,
+                            workers=None, processes=False, chunk_size=256, update=False):
+        """
+        score several models against one spectrum, e.g. the models of a
+        ModelDB or a set of annealing proposals.  models with the same number
+        of lines and continuum points and the same regions go to the c
+        extension as one batch, in chunks of at most chunk_size models.
+
+        Input:
+        ------
+        spec : specParser.Spectrum instance
+        models : list of model.Model instances
+        vsig, vdisp, lsf : line spread function, as for fit_absorption
+        workers : score chunks in a pool of this many workers.  serially in
+                  this thread if None or 1
+        processes : use a process pool rather than a thread pool.  the c
+                    extension lets go of the GIL, so threads are usually
+                    enough.  each process attaches the spectrum once
+        chunk_size : most models sent to the c extension at a time
+        update : write each chi2 back to its model
+
+        Output:
+        -------
+        array (len(models), 3) of chi2, pixels and dof, one row per model in
+        the same order as models
+
+        """
+        lsf = lsf_registry.get(lsf, vsig, vdisp)
+        out = np.zeros((len(models), 3))
+        with timing.stage('many.prepare'):
+            batches = {}
+            for i, model in enumerate(models):
+                model.update_dof()
+                out[i, 1:] = model.pixels, model.dof
+                region = model.region_index()
+                arrays = Spectrum.line_arrays(spec, model) + Spectrum.cont_arrays(model)
+                key = (arrays[0].shape[0], arrays[-1].shape[0], id(region))
+                batches.setdefault(key, (region, []))[1].append((i, arrays))
+
+            chunks = []
+            for region, batch in batches.values():
+                rows = np.array([i for i, _ in batch])
+                stacked = [np.vstack(arrs) for arrs in zip(*[arrays for _, arrays in batch])]
+                for beg in range(0, rows.shape[0], max(int(chunk_size), 1)):
+                    end = beg + max(int(chunk_size), 1)
+                    chunks.append((rows[beg:end], tuple(region), [arr[beg:end] for arr in stacked]))
+
+        def score(chunk):
+            return _score_chunk(spec, lsf.segments, *chunk[1:])
+
+        with timing.stage('many.score'):
+            if workers is None or workers <= 1 or len(chunks) <= 1:
+                scores = [score(chunk) for chunk in chunks]
+            elif processes:
+                with ProcessPoolExecutor(workers, initializer=_attach_spectrum, initargs=(spec,)) as pool:
+                    scores = list(pool.map(_score_chunk, *zip(*[(None, lsf.segments) + chunk[1:] for chunk in chunks])))
+            else:
+                with ThreadPoolExecutor(workers) as pool:
+                    scores = list(pool.map(score, chunks))
+        for (rows, _, _), chi2 in zip(chunks, scores):
+            out[rows, 0] = chi2
+
+        if update:
+            for model, chi2 in zip(models, out[:, 0]):
+                model.chi2 = float(chi2)
+        return out
+
+
+# spectrum of a fit_absorption_many worker process, see _attach_spectrum
+_worker_spectrum = None
+
+
+def _attach_spectrum(spec):
+    """process pool initializer: keep the spectrum for every chunk this worker scores"""
+    global _worker_spectrum
+    _worker_spectrum = spec
+
+
+def _score_chunk(spec, segments, region, stacked):
+    """chi2 of one chunk of fit_absorption_many, spec is None in a worker process"""
+    spec = _worker_spectrum if spec is None else spec
+    indices, starts, ends = region
+    context = Spectrum.get_context(spec, indices, lsf=segments, pairs=(starts, ends),
+                                   full=False, background=[np.zeros(0)] * 6)
+    return context.evaluate_many(*stacked)
+
 
 class FitsSpectrum(Spectrum):
     def __init__(self, filename, error=None):
-        self.waves, self.flux = wavelength.xy(filename)
+        self.waves, self.flux, wcs = store.fits(filename)
+        self.attach_grid(wcs)
         if error:
-            _, self.error = wavelength.xy(error)
+            _, self.error, _ = store.fits(error)
         else:
             raise Exception('error is None.  flux file is %s' % (filename))
         self.dump = filename.replace('.fits', '.dat')
+        self.source = (filename, error)
 
 
 class TextSpectrum(Spectrum):
@@ -222,21 +658,20 @@ class TextSpectrum(Spectrum):
                 lst = [kwargs[it] for it in TextSpectrum.attributes]
             except:
                 Exception("bad formatting:\n" + str(kwargs))
+        source = None
         if len(lst) != 5:
-            try:
-                lst = np.loadtxt(dumpfile, unpack=True)
-            except:
-                raise
-                # raise Exception(dumpfile)
+            lst = store.text(dumpfile)
             if len(lst) == 6:
-                lst = np.delete(lst, 0, 0)  # first column is always a bunch of zeroes
+                lst = lst[1:]  # first column is always a bunch of zeroes
             elif len(lst) == 5:
                 pass
             else:
                 raise Exception("bad formatting for " + dumpfile)
+            source = (dumpfile,)
         self.set_data(*lst)
         self.name = dumpfile
         self.dump = dumpfile  # this is an alias for self.name
+        self.source = source  # set if the arrays came from spectrum_store
 
     def set_data(self, *lst):
         assert (len(lst) == 5)
@@ -245,6 +680,7 @@ class TextSpectrum(Spectrum):
         for it in "waves flux error abs cont".split():
             setattr(self, it, lst[i])
             i += 1
+        self.attach_grid()
 
     @staticmethod
     def get_ind(waves, beg, end):
@@ -291,6 +727,136 @@ class TextSpectrum(Spectrum):
         return np.array(xx)
 
 
+class CompositeSpectrum(object):
+    """
+    several spectra of one system, e.g. from different instruments or
+    settings, fit jointly.  every member shares the model's absorbers but
+    has its own spectrum, line spread function and continuum points, and
+    chi2 is summed over the members.  each member is evaluated in a thread
+    of its own, so its context (see Spectrum.get_context) stays warm.
+
+    the first member is the model's own spectrum, with the model's continuum
+    points and regions.  more are added with add().  a CompositeSpectrum
+    goes wherever a Spectrum does in Spectrum.fit_absorption, and so in
+    simulated_annealing and random_sampling (pass it as spectrum=).
+
+    Parameters
+    ----------
+    spec : Spectrum
+        the model's own spectrum (model.flux and model.error)
+    lsf : line spread function of spec, see LSFRegistry.get.  if None, the
+          one fit_absorption is given
+    """
+    Member = namedtuple('Member', ['spec', 'flux', 'error', 'cont_points', 'regions', 'lsf'])
+
+    def __init__(self, spec, lsf=None):
+        self.members = [CompositeSpectrum.Member(spec, None, None, None, None, lsf)]
+
+    def __len__(self):
+        return len(self.members)
+
+    def __getstate__(self):
+        # threads don't pickle, and the member models are rebuilt on demand
+        state = dict(self.__dict__)
+        state.pop('_pools', None)
+        state.pop('_views', None)
+        return state
+
+    def add(self, spec, cont_points, lsf=None, regions=None):
+        """
+        add a spectrum to fit along with the others
+
+        Input:
+        ------
+        spec : FitsSpectrum or TextSpectrum read from file
+        cont_points : list of data_types.ContinuumPoint, this spectrum's continuum
+        lsf : this spectrum's line spread function, see LSFRegistry.get.  if
+              None, the one fit_absorption is given
+        regions : list of data_types.Region.  if None, the model's
+
+        Raises:
+        -------
+        ValueError if spec wasn't read from a file
+        """
+        if getattr(spec, 'source', None) is None:
+            raise ValueError('members of a CompositeSpectrum must be read from file')
+        flux, error = spec.source[0], spec.source[-1]
+        cont_points = ObjList.factory(list(cont_points), tag='ContinuumPoint')
+        if regions is not None:
+            regions = ObjList.factory(list(regions), tag='Region')
+        self.members.append(CompositeSpectrum.Member(spec, flux, error, cont_points, regions, lsf))
+        self.__dict__.pop('_views', None)
+
+    def member_models(self, model):
+        """
+        a Model per member, sharing model's absorbers, ties and (unless the
+        member has its own) regions.  the first is model's own spectrum and
+        continuum.  they are kept and brought up to date with model on each
+        call, so each keeps its line table and dof counts between fits
+        """
+        views = self.__dict__.get('_views')
+        if views is None:
+            views = self._views = [Model(AbsorberList=model.AbsorberList) for _ in self.members]
+        for i, (view, member) in enumerate(zip(views, self.members)):
+            view.AbsorberList, view.tied = model.AbsorberList, model.tied
+            view.RegionList = model.RegionList if member.regions is None else member.regions
+            if i == 0:
+                view.ContinuumPointList, view.flux, view.error = model.ContinuumPointList, model.flux, model.error
+            else:
+                view.ContinuumPointList, view.flux, view.error = member.cont_points, member.flux, member.error
+        return views
+
+    def _submit(self, i, func):
+        """run func in member i's thread.  the first member runs in the caller's"""
+        if i == 0:
+            return None
+        pools = self.__dict__.get('_pools')
+        if pools is None:
+            pools = self._pools = {}
+        if i not in pools:
+            pools[i] = ThreadPoolExecutor(1)
+        return pools[i].submit(func)
+
+    def fit_absorption(self, model, vsig=None, vdisp=None, ab_to_fit=None, cont_to_fit=None,
+                       get_all=False, arrays=True, full=False, lsf=None):
+        """
+        Spectrum.fit_absorption of every member.  cont_to_fit only applies
+        to the first member.  model.pixels is the total over the members and
+        model.params counts the free parameters of absorbers fit in any
+
+        Output:
+        -------
+        absorption : list with each member's, see Spectrum.fit_absorption
+        cont : list with each member's
+        chi2 : summed over the members
+        """
+        default = lsf_registry.get(lsf, vsig, vdisp)
+        views = self.member_models(model)
+
+        def fit(i):
+            member = self.members[i]
+            return Spectrum.fit_absorption(member.spec, views[i], ab_to_fit=ab_to_fit,
+                                           cont_to_fit=cont_to_fit if i == 0 else None,
+                                           arrays=arrays, full=full,
+                                           lsf=default if member.lsf is None else member.lsf)
+
+        with timing.stage('composite.fit'):
+            futures = [self._submit(i, lambda i=i: fit(i)) for i in range(len(self.members))]
+            results = [fit(0)] + [future.result() for future in futures[1:]]
+
+        table = model.line_table
+        model.pixels = sum(view.pixels for view in views)
+        model.fitted = np.any([view.fitted for view in views], axis=0)
+        model.params = int(table.free[model.fitted].sum())
+        absorption, cont, chi2 = zip(*results)
+        return list(absorption), list(cont), float(sum(chi2))
+
+    def close(self):
+        """stop the member threads"""
+        for pool in self.__dict__.pop('_pools', {}).values():
+            pool.shutdown()
+
+
 class LineDump(object):
     def __init__(self, fname=None):
         self.absorbers = []
@@ -0,0 +1,157 @@
+"""
+process-wide store of spectrum arrays read from disk.
+
+fits data are memory-mapped rather than read into memory, and text dumps are
+parsed once and saved next to the source as a binary .npy sidecar, which is
+then memory-mapped too.  a sidecar is stamped with its source's mtime and is
+only trusted while the two match.  every array handed out is read-only and the same object is returned
+on repeat requests, so spectra, models and fits all share one copy.  since
+the arrays are backed by files, worker processes that ask the store for the
+same path map the same pages instead of unpickling copies (see
+spec_parser.Spectrum.__getstate__).
+"""
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+import astropy.io.fits as fits
+import numpy as np
+
+from dudeutils.wavelength import WaveUtils1D
+
+
+def spectrum_key(path):
+    """identifies the contents of a spectrum file: (path, mtime, size)"""
+    st = os.stat(path)
+    return os.path.abspath(path), st.st_mtime_ns, st.st_size
+
+
+def sidecar_path(path):
+    """binary copy of a text dump, see SpectrumStore.text"""
+    return path + '.npy'
+
+
+def _read_only(arr):
+    arr = arr.view()
+    arr.flags.writeable = False
+    return arr
+
+
+class SpectrumStore(object):
+    """
+    least recently used cache of spectrum arrays, keyed by spectrum_key so
+    that a rewritten file is read again.
+
+    Parameters
+    ----------
+    max_bytes : int
+        size limit of the arrays held, evicting the least recently used
+        files first.  the most recent file is always kept
+    sidecars : bool
+        write .npy sidecars for text dumps.  if False, or if the sidecar
+        can't be written, the parsed dump is held in memory only
+    """
+
+    def __init__(self, max_bytes=2 ** 30, sidecars=True):
+        self.max_bytes = int(max_bytes)
+        self.sidecars = bool(sidecars)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def nbytes(self):
+        """bytes of the arrays held"""
+        with self._lock:
+            return sum(nbytes for _, nbytes in self._entries.values())
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _get(self, kind, path, read):
+        key = (kind,) + spectrum_key(path)
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                return self._entries[key][0]
+        val = read(path)
+        nbytes = sum(arr.nbytes for arr in val if isinstance(arr, np.ndarray))
+        with self._lock:
+            # another thread may have read it meanwhile, keep the first copy
+            val = self._entries.setdefault(key, (val, nbytes))[0]
+            self._entries.move_to_end(key)
+            total = sum(size for _, size in self._entries.values())
+            while total > self.max_bytes and len(self._entries) > 1:
+                total -= self._entries.popitem(last=False)[1][1]
+        return val
+
+    def fits(self, path):
+        """
+        memory-mapped 1d fits spectrum
+
+        Input:
+        ------
+        path : fits file
+
+        Output:
+        -------
+        (waves, data, wcs), waves and data read-only arrays and wcs the
+        wavelength.WaveUtils1D wavelength solution
+        """
+        return self._get('fits', path, SpectrumStore._read_fits)
+
+    def text(self, path):
+        """
+        columns of a text dump, like np.loadtxt(path, unpack=True) but as a
+        tuple of contiguous read-only arrays
+        """
+        return self._get('text', path, self._read_text)
+
+    def waves(self, path):
+        """wavelengths of a fits or text spectrum"""
+        if path.endswith('.fits'):
+            return self.fits(path)[0]
+        col1, col2 = self.text(path)[:2]
+        return col2 if np.all(col1 == 0) else col1
+
+    @staticmethod
+    def _read_fits(path):
+        with fits.open(path, memmap=True) as hdu:
+            head = hdu[0].header
+            data = hdu[0].data
+            wcs = WaveUtils1D(head['CRVAL1'], head['CRPIX1'], head['CDELT1'], WaveUtils1D.is_loglin(head))
+        waves = wcs.get_wave(np.arange(0, data.shape[0]))
+        return _read_only(waves), _read_only(data), wcs
+
+    def _read_text(self, path):
+        sidecar = sidecar_path(path)
+        mtime = os.stat(path).st_mtime_ns
+        try:
+            if os.stat(sidecar).st_mtime_ns == mtime:
+                return tuple(np.load(sidecar, mmap_mode='r'))
+        except (OSError, ValueError):
+            pass
+
+        cols = np.ascontiguousarray(np.loadtxt(path, unpack=True, ndmin=2))
+        if not self.sidecars:
+            return tuple(_read_only(cols))
+        try:
+            fd, tmp = tempfile.mkstemp(suffix='.npy', dir=os.path.dirname(os.path.abspath(path)))
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    np.save(f, cols)
+                os.utime(tmp, ns=(mtime, mtime))
+                os.replace(tmp, sidecar)
+            except BaseException:
+                os.remove(tmp)
+                raise
+        except OSError:
+            return tuple(_read_only(cols))
+        return tuple(np.load(sidecar, mmap_mode='r'))
+
+
+store = SpectrumStore()
@@ -0,0 +1,164 @@
+"""
+opt-in wall time and call counts for the stages of the fit path
+(Spectrum.fit_absorption, Anneal.get_chi2, optimizer.optimize).
+
+timing is off by default, and stage() then hands back one shared do-nothing
+context manager, so instrumented code costs little more than a function
+call.  turn it on for a whole run with DUDEUTILS_TIMING=1 in the
+environment (worker processes inherit it), or for a block with
+
+    with timing.enabled():
+        Spectrum.fit_absorption(spec, model)
+    print(timing.report())
+
+random_sampling workers dump their totals to timing-<pid>.json files, which
+the parent merges into timing.json at the end of a run (see collect).
+"""
+import contextlib
+import functools
+import glob
+import json
+import os
+import threading
+import time
+
+_on = os.environ.get('DUDEUTILS_TIMING', '').lower() not in ('', '0', 'false', 'no')
+_totals = {}  # stage name -> [calls, seconds]
+_lock = threading.Lock()
+
+
+class _Stage(object):
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        with _lock:
+            entry = _totals.setdefault(self.name, [0, 0.0])
+            entry[0] += 1
+            entry[1] += elapsed
+        return False
+
+
+class _Off(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_off = _Off()
+
+
+def stage(name):
+    """context manager timing one call of stage name, a no-op unless timing is on"""
+    return _Stage(name) if _on else _off
+
+
+def timed(name):
+    """decorator timing every call of a function as stage name"""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _on:
+                return func(*args, **kwargs)
+            with _Stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def is_enabled():
+    return _on
+
+
+def enable(on=True):
+    """turn timing on (or off) for this process"""
+    global _on
+    _on = bool(on)
+
+
+@contextlib.contextmanager
+def enabled():
+    """time the stages run inside the block"""
+    previous = _on
+    enable()
+    try:
+        yield
+    finally:
+        enable(previous)
+
+
+def reset():
+    with _lock:
+        _totals.clear()
+
+
+def stats():
+    """
+    Output:
+    -------
+    dict of stage name -> {'calls': int, 'seconds': float}, totals since the
+    last reset
+    """
+    with _lock:
+        return {name: {'calls': calls, 'seconds': seconds} for name, (calls, seconds) in _totals.items()}
+
+
+def merge(other):
+    """add totals as returned by stats (e.g. from another process) to this process's"""
+    with _lock:
+        for name, entry in other.items():
+            totals = _totals.setdefault(name, [0, 0.0])
+            totals[0] += int(entry['calls'])
+            totals[1] += float(entry['seconds'])
+
+
+def dump(path):
+    """write stats() to path as json"""
+    with open(path, 'w') as f:
+        json.dump(stats(), f, indent=1, sort_keys=True)
+
+
+def worker_dump(directory):
+    """dump this process's totals for collect, if timing is on"""
+    if _on:
+        dump(os.path.join(directory, 'timing-%d.json' % os.getpid()))
+
+
+def collect(directory, output='timing.json'):
+    """
+    merge the totals dumped by worker processes into this process's and
+    write the lot to directory/output.  the worker files are removed
+
+    Output:
+    -------
+    stats(), or None if timing is off
+    """
+    if not _on:
+        return None
+    for path in glob.glob(os.path.join(directory, 'timing-*.json')):
+        with open(path) as f:
+            merge(json.load(f))
+        os.remove(path)
+    dump(os.path.join(directory, output))
+    return stats()
+
+
+def report(totals=None):
+    """stats as a table, slowest stage first"""
+    totals = stats() if totals is None else totals
+    lines = ['%-28s %10s %12s %12s' % ('stage', 'calls', 'seconds', 'us/call')]
+    for name, entry in sorted(totals.items(), key=lambda item: -item[1]['seconds']):
+        calls, seconds = entry['calls'], entry['seconds']
+        lines.append('%-28s %10d %12.4f %12.2f' % (name, calls, seconds, 1e6 * seconds / max(calls, 1)))
+    return '\n'.join(lines)
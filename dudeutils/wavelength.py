@@ -9,7 +9,7 @@ class WaveUtils1D(object):
         # specify types as a check for type
         self.crval = float(crval)
         self.crpix = int(crpix)
-        self.crdelt = float(cdelt)
+        self.cdelt = float(cdelt)
         self.loglin = bool(loglin)
 
     def get_wave(self, i):
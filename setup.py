@@ -1,6 +1,7 @@
 from setuptools import setup, find_packages
 from setuptools.extension import Extension
 import os
+import sys
 
 
 
@@ -12,10 +13,15 @@ import os
 ext = Extension('_spectrum', 
                  sources=['dudeutils/cext/_spectrum.c', 
                           'dudeutils/cext/spectrum.c', 
+                          'dudeutils/cext/context.c', 
                           'dudeutils/cext/get_absorption.c', 
                           'dudeutils/cext/get_continuum.c',
                           'dudeutils/cext/voigt.c', 
-                          'dudeutils/cext/util.c']
+                          'dudeutils/cext/util.c'],
+                 # line absorption is spread over threads with openmp.  the
+                 # extension still builds (single threaded) without it
+                 extra_compile_args=[] if sys.platform == 'darwin' else ['-fopenmp'],
+                 extra_link_args=[] if sys.platform == 'darwin' else ['-fopenmp'],
                )
  
 setup(  name='dudeutils', 
@@ -58,6 +58,15 @@ class MockSpec(object):
         self.abs, self.cont = 10. * np.ones(1000), 10. * np.ones(1000)
 
 
+def write_spectrum(path, waves, flux=None):
+    """writes a text spectrum to path, random flux unless given"""
+    if flux is None:
+        flux = np.random.rand(waves.shape[0])
+    ones = np.ones_like(waves)
+    np.savetxt(path, np.column_stack([waves, flux, 0.1 * ones, ones, ones]))
+    return path
+
+
 class MockCont(object):
     def __init__(self, **kwargs):
         self.id = kwargs.get('id', 'contid%d' % np.random.randint(0, 2 ** 32))
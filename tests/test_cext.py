@@ -0,0 +1,439 @@
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import _spectrum
+
+c = 299792.458  # speed of light in km/s
+
+
+def loglin_waves(size=20000, start=3600., vdisp=2.14):
+    cdelt = vdisp / c / np.log(10.)
+    return 10. ** (np.log10(start) + cdelt * np.arange(size)), np.log10(start), cdelt
+
+
+class WaveGridTestCase(unittest.TestCase):
+    def setUp(self):
+        self.loglin, self.crval, self.cdelt = loglin_waves()
+        self.linear = np.linspace(3000., 5000., 4001)
+        self.arbitrary = np.sort(np.random.uniform(3000., 5000., 3000))
+
+    def check_index(self, grid):
+        waves = grid.waves
+        query = np.concatenate([np.random.uniform(waves[0] - 5., waves[-1] + 5., 5000),
+                                waves, waves[:-1] + 1e-9])
+        expected = np.clip(np.searchsorted(waves, query, 'right') - 1, -1, waves.shape[0] - 1)
+        self.assertTrue(np.array_equal(grid.index(query), expected))
+
+    def test_kind(self):
+        self.assertEqual(_spectrum.WaveGrid(self.loglin).kind, 'loglin')
+        self.assertEqual(_spectrum.WaveGrid(self.linear).kind, 'linear')
+        self.assertEqual(_spectrum.WaveGrid(self.arbitrary).kind, 'arbitrary')
+
+    def test_index(self):
+        for waves in [self.loglin, self.linear, self.arbitrary]:
+            self.check_index(_spectrum.WaveGrid(waves))
+
+    def test_wcs(self):
+        grid = _spectrum.WaveGrid(self.loglin, crval=self.crval, cdelt=self.cdelt, crpix=1., loglin=True)
+        self.assertEqual(grid.kind, 'loglin')
+        self.check_index(grid)
+
+    def test_scalar(self):
+        grid = _spectrum.WaveGrid(self.linear)
+        self.assertEqual(grid.index(float(self.linear[10])), 10)
+        self.assertEqual(grid.index(self.linear[0] - 1.), -1)
+        self.assertEqual(grid.index(self.linear[-1] + 1.), grid.size - 1)
+
+    def test_uninitialized(self):
+        grid = _spectrum.WaveGrid.__new__(_spectrum.WaveGrid)
+        for get in [lambda: grid.waves, lambda: grid.size, lambda: grid.kind, lambda: grid.index(3000.)]:
+            self.assertRaises(RuntimeError, get)
+        self.assertRaises(RuntimeError, _spectrum.SpectrumContext, self.linear, self.linear, self.linear, grid=grid)
+        with self.assertRaises(TypeError):
+            _spectrum.WaveGrid(self.linear, crval='a', cdelt=1.)
+
+
+class VoigtTestCase(unittest.TestCase):
+    def setUp(self):
+        self.v = np.linspace(-10., 10., 4001)
+
+    def tearDown(self):
+        _spectrum.set_voigt('table')
+
+    def test_accuracy(self):
+        from scipy.special import wofz
+        for a in [1e-5, 1e-3, 0.1, 1.]:
+            ref = wofz(self.v + 1j * a).real
+            err = np.fabs(_spectrum.voigt(self.v, a, 'humlicek') - ref).max()
+            self.assertLess(err, 1e-4)
+            if a < 0.5:
+                self.assertLess(np.fabs(_spectrum.voigt(self.v, a, 'table') - ref).max(), 5e-3)
+        self.assertTrue(np.allclose(_spectrum.voigt(self.v, 0., 'fast'), np.exp(-self.v ** 2.)))
+
+    def test_select(self):
+        self.assertEqual(_spectrum.get_voigt(), 'table')
+        _spectrum.set_voigt('humlicek')
+        self.assertEqual(_spectrum.get_voigt(), 'humlicek')
+        self.assertTrue(np.array_equal(_spectrum.voigt(self.v, 1e-3),
+                                       _spectrum.voigt(self.v, 1e-3, 'humlicek')))
+        with self.assertRaises(ValueError):
+            _spectrum.set_voigt('lorentz')
+
+    def test_absorption(self):
+        """every method gives nearly the same spectrum"""
+        waves, _, _ = loglin_waves()
+        lines = mock_lines(waves)
+        ctx = _spectrum.SpectrumContext(waves, np.ones(waves.shape[0]), np.ones(waves.shape[0]))
+        args = [lines[k] for k in 'N b z rest gamma f'.split()] + [waves[[0, 1, 2, -3, -2, -1]], np.ones(6)]
+        results = {}
+        for method in ['table', 'humlicek', 'fast']:
+            _spectrum.set_voigt(method)
+            ctx.reset()
+            results[method] = ctx.evaluate(*args)[1]
+        self.assertLess(np.fabs(results['table'] - results['humlicek']).max(), 1e-2)
+        self.assertLess(np.fabs(results['fast'] - results['humlicek']).max(), 1e-2)
+
+
+def mock_lines(waves, num=30, seed=2):
+    rng = np.random.RandomState(seed)
+    rest = rng.choice([1215.6701, 1025.7223, 1548.195, 1550.770], num)
+    obs = rng.uniform(waves[50], waves[-50], num)
+    z = obs / rest - 1.
+    return dict(N=rng.uniform(12., 15., num), b=rng.uniform(5., 30., num), z=z, rest=rest,
+                gamma=np.full(num, 6.265E8), f=rng.uniform(0.1, 0.5, num))
+
+
+class SpectrumContextTestCase(unittest.TestCase):
+    def setUp(self):
+        self.waves, _, _ = loglin_waves()
+        self.flux = np.full(self.waves.shape[0], 1e-14)
+        self.error = np.full(self.waves.shape[0], 1e-16)
+        self.x = np.linspace(self.waves[0] - 5., self.waves[-1] + 5., 20)
+        self.y = 1e-14 * np.ones(20)
+        self.lines = mock_lines(self.waves)
+        self.ctx = _spectrum.SpectrumContext(self.waves, self.flux, self.error,
+                                             starts=[100, 5000], ends=[3000, 9000])
+
+    def evaluate(self, **kwargs):
+        lines = dict(self.lines, **kwargs)
+        return self.ctx.evaluate(*[lines[k] for k in 'N b z rest gamma f'.split()], self.x, self.y)
+
+    def test_chi2(self):
+        cont, absorption, chi2 = self.evaluate()
+        resid = ((self.flux - absorption) / self.error) ** 2.
+        self.assertAlmostEqual(chi2 / (resid[100:3000].sum() + resid[5000:9000].sum()), 1.)
+        self.assertTrue(np.all(absorption <= cont))
+
+    def test_uninitialized(self):
+        ctx = _spectrum.SpectrumContext.__new__(_spectrum.SpectrumContext)
+        lines = [self.lines[k] for k in 'N b z rest gamma f'.split()]
+        calls = [lambda: ctx.grid, lambda: ctx.regions, lambda: ctx.active, lambda: ctx.restricted,
+                 lambda: ctx.dirty, ctx.reset, lambda: ctx.evaluate(*lines, self.x, self.y),
+                 lambda: ctx.jacobian(*lines, self.x, self.y, np.zeros((6, 3), dtype=int), np.zeros(20, dtype=int)),
+                 lambda: ctx.set_regions([0], [10]), lambda: ctx.set_restricted(True)]
+        for call in calls:
+            self.assertRaises(RuntimeError, call)
+
+        # a failed __init__ leaves it unusable, but a later one can still succeed
+        self.assertRaises(ValueError, ctx.__init__, self.waves, self.flux[1:], self.error)
+        self.assertRaises(RuntimeError, lambda: ctx.grid)
+        ctx.__init__(self.waves, self.flux, self.error)
+        self.assertEqual(ctx.grid.size, self.waves.shape[0])
+
+    def test_reuse(self):
+        first = self.evaluate()
+        self.evaluate(N=self.lines['N'] + 1.)
+        again = self.evaluate()
+        self.assertTrue(np.allclose(first[1], again[1], rtol=1e-12, atol=0.))
+        self.assertAlmostEqual(first[2] / again[2], 1.)
+
+    def test_incremental(self):
+        """moving a few lines at a time agrees with evaluating from scratch"""
+        self.evaluate()
+        z = self.lines['z'].copy()
+        for i in [0, 3, 3, 17]:
+            z[i] += 2e-4
+            cont, absorption, chi2 = self.evaluate(z=z)
+        self.ctx.reset()
+        _, expected, expected_chi2 = self.evaluate(z=z)
+        self.assertTrue(np.allclose(absorption, expected, rtol=1e-12, atol=0.))
+        self.assertAlmostEqual(chi2 / expected_chi2, 1.)
+
+    def test_continuum_point(self):
+        """moving one continuum point redraws only the spans around it"""
+        self.evaluate()
+        self.evaluate()
+        self.assertIsNone(self.ctx.dirty)
+        for i in [0, 8, 19]:
+            self.y = self.y.copy()
+            self.y[i] *= 1.05
+            cont, absorption, chi2 = self.evaluate()
+            start, end = self.ctx.dirty
+            self.assertLess(end - start, self.waves.shape[0])
+        self.ctx.reset()
+        expected = self.evaluate()
+        self.assertTrue(np.array_equal(cont, expected[0]))
+        self.assertTrue(np.allclose(absorption, expected[1], rtol=1e-12, atol=0.))
+        self.assertAlmostEqual(chi2 / expected[2], 1.)
+
+    def test_evaluate_many(self):
+        rows = np.array([self.lines['N'] + dN for dN in [0., 0.3, -0.2]])
+        chi2, absorption = self.ctx.evaluate_many(rows, *[self.lines[k] for k in 'b z rest gamma f'.split()],
+                                                  self.x, self.y, absorption=True)
+        self.assertEqual(absorption.shape, (3, self.waves.shape[0]))
+        for row, expected_chi2, expected_abs in zip(rows, chi2, absorption):
+            self.ctx.reset()
+            _, abs_, chi2_ = self.evaluate(N=row)
+            self.assertAlmostEqual(chi2_ / expected_chi2, 1.)
+            self.assertTrue(np.allclose(abs_, expected_abs, rtol=1e-12, atol=0.))
+        self.assertEqual(self.ctx.evaluate_many(rows, *[self.lines[k] for k in 'b z rest gamma f'.split()],
+                                                self.x, self.y).shape, (3,))
+        with self.assertRaises(ValueError):
+            self.ctx.evaluate_many(rows, rows[:2], *[self.lines[k] for k in 'z rest gamma f'.split()],
+                                   self.x, self.y)
+
+    def test_threads(self):
+        default = _spectrum.get_num_threads()
+        _, expected, expected_chi2 = self.evaluate()
+        try:
+            _spectrum.set_num_threads(3)
+            self.assertEqual(_spectrum.get_num_threads(), 3)
+            self.ctx.reset()
+            _, absorption, chi2 = self.evaluate()
+        finally:
+            _spectrum.set_num_threads(0)
+        self.assertEqual(_spectrum.get_num_threads(), default)
+        self.assertTrue(np.allclose(absorption, expected, rtol=1e-12, atol=0.))
+        self.assertAlmostEqual(chi2 / expected_chi2, 1.)
+
+    def test_concurrent(self):
+        """contexts sharing one spectrum can evaluate from several threads"""
+        _, _, expected = self.evaluate()
+
+        def fit(_):
+            ctx = _spectrum.SpectrumContext(self.waves, self.flux, self.error, grid=self.ctx.grid,
+                                            starts=[100, 5000], ends=[3000, 9000])
+            lines = [self.lines[k] for k in 'N b z rest gamma f'.split()]
+            return [ctx.evaluate(*lines, self.x, self.y)[-1] for _ in range(3)]
+
+        with ThreadPoolExecutor(4) as pool:
+            for chi2 in pool.map(fit, range(8)):
+                self.assertTrue(np.allclose(chi2, expected))
+
+    def test_lsf(self):
+        """chi2 is taken against the convolved absorption, skipping bad pixels"""
+        kernel = np.exp(-0.5 * np.arange(-4, 5) ** 2. / 2.)
+        kernel /= kernel.sum()
+        self.flux = self.flux.copy()
+        self.flux[[150, 5100]] = np.nan
+        self.ctx = _spectrum.SpectrumContext(self.waves, self.flux, self.error,
+                                             starts=[100, 5000], ends=[3000, 9000])
+        self.ctx.set_lsf(kernel, offset=5)
+        _, absorption, chi2 = self.evaluate()
+        convolved = np.convolve(absorption, kernel)[5:5 + absorption.shape[0]]
+        self.assertTrue(np.allclose(self.ctx.convolved(), convolved, rtol=1e-12, atol=0.))
+        resid = ((self.flux - convolved) / self.error) ** 2.
+        expected = np.nansum(resid[100:3000]) + np.nansum(resid[5000:9000])
+        self.assertAlmostEqual(chi2 / expected, 1.)
+
+        z = self.lines['z'].copy()
+        z[4] += 1e-4
+        chi2 = self.evaluate(z=z)[-1]
+        self.ctx.reset()
+        self.assertAlmostEqual(chi2 / self.evaluate(z=z)[-1], 1.)
+        self.assertIsInstance(self.ctx.evaluate(*[self.lines[k] for k in 'N b z rest gamma f'.split()],
+                                                self.x, self.y, arrays=False), float)
+
+    def test_lsf_segments(self):
+        """each segment convolves with its own kernel, reading across the boundary"""
+        narrow = np.exp(-0.5 * np.arange(-2, 3) ** 2.)
+        wide = np.exp(-0.5 * np.arange(-6, 7) ** 2. / 9.)
+        kernels = [narrow / narrow.sum(), wide / wide.sum()]
+        self.ctx.set_lsf_segments([0, 2000], kernels)
+        _, absorption, chi2 = self.evaluate()
+        expected = np.convolve(absorption, kernels[0], mode='same')
+        expected[2000:] = np.convolve(absorption, kernels[1], mode='same')[2000:]
+        self.assertTrue(np.allclose(self.ctx.convolved(), expected, rtol=1e-12, atol=0.))
+
+        self.ctx.set_restricted()
+        self.assertTrue(np.array_equal(self.ctx.active, [[94, 3006], [4994, 9006]]))
+        self.assertAlmostEqual(self.evaluate()[-1] / chi2, 1.)
+        with self.assertRaises(ValueError):
+            self.ctx.set_lsf_segments([2000, 0], kernels)
+
+    def test_jacobian(self):
+        """analytic derivatives agree with finite differences of the convolved model"""
+        kernel = np.exp(-0.5 * np.arange(-4, 5) ** 2. / 2.)
+        self.ctx.set_lsf(kernel / kernel.sum())
+        num = self.lines['N'].shape[0]
+        columns = np.full((num, 3), -1)
+        columns[4] = [0, 1, 2]
+        columns[8] = [3, 4, 5]
+        columns[9] = [3, 4, 5]  # lines of one absorber share columns
+        point_columns = np.full(20, -1)
+        point_columns[[2, 9]] = [6, 7]
+        keys = 'N b z rest gamma f'.split()
+        try:
+            _spectrum.set_voigt('humlicek')
+            pixels, model, jac = self.ctx.jacobian(*[self.lines[k] for k in keys], self.x, self.y,
+                                                   columns, point_columns)
+
+            def convolved(**kwargs):
+                self.ctx.reset()
+                self.evaluate(**kwargs)
+                return self.ctx.convolved()[pixels]
+
+            self.assertTrue(np.array_equal(pixels, np.r_[100:3000, 5000:9000]))
+            self.assertTrue(np.allclose(model, convolved(), rtol=1e-12, atol=0.))
+            for col, key, which, step in [(0, 'N', [4], 1e-6), (1, 'b', [4], 1e-5), (2, 'z', [4], 1e-9),
+                                          (3, 'N', [8, 9], 1e-6), (5, 'z', [8, 9], 1e-9)]:
+                val = self.lines[key].copy()
+                val[which] += step
+                up = convolved(**{key: val})
+                val[which] -= 2. * step
+                expected = (up - convolved(**{key: val})) / (2. * step)
+                self.assertLess(np.fabs(jac[:, col] - expected).max(), 1e-3 * np.fabs(expected).max())
+            y = self.y
+            self.y = y.copy()
+            self.y[9] *= 1.01
+            expected = (convolved() - model) / (self.y[9] - y[9])
+            self.assertTrue(np.allclose(jac[:, 7], expected, rtol=1e-6, atol=1e-12 * np.fabs(expected).max()))
+        finally:
+            _spectrum.set_voigt('table')
+
+    def test_restricted(self):
+        """evaluating only the active pixels gives the same chi2 and region model"""
+        kernel = np.exp(-0.5 * np.arange(-4, 5) ** 2. / 2.)
+        self.ctx.set_lsf(kernel / kernel.sum())
+        cont, absorption, chi2 = self.evaluate()
+        convolved = self.ctx.convolved()
+        keys = 'N b z rest gamma f'.split()
+        columns = np.arange(3 * self.lines['N'].shape[0]).reshape(-1, 3)
+        _, model, jac = self.ctx.jacobian(*[self.lines[k] for k in keys], self.x, self.y, columns, np.full(20, -1))
+
+        self.ctx.set_restricted()
+        self.assertTrue(self.ctx.restricted)
+        self.assertTrue(np.array_equal(self.ctx.active, [[96, 3004], [4996, 9004]]))
+        r_cont, r_absorption, r_chi2 = self.evaluate()
+        self.assertAlmostEqual(r_chi2 / chi2, 1.)
+        pixels = np.r_[100:3000, 5000:9000]
+        self.assertTrue(np.allclose(self.ctx.convolved()[pixels], convolved[pixels], rtol=1e-12, atol=0.))
+        self.assertFalse(np.any(r_absorption[np.r_[:96, 3004:4996, 9004:r_absorption.shape[0]]]))
+        _, r_model, r_jac = self.ctx.jacobian(*[self.lines[k] for k in keys], self.x, self.y, columns, np.full(20, -1))
+        self.assertTrue(np.allclose(r_model, model, rtol=1e-12, atol=0.))
+        self.assertTrue(np.allclose(r_jac, jac, rtol=1e-12, atol=1e-12 * np.fabs(jac).max()))
+
+        z = self.lines['z'].copy()
+        z[[0, 4]] += 2e-4
+        r_chi2 = self.evaluate(z=z)[-1]
+        self.ctx.set_restricted(False)
+        self.assertTrue(np.array_equal(self.ctx.active, [[0, self.waves.shape[0]]]))
+        self.assertAlmostEqual(self.evaluate(z=z)[-1] / r_chi2, 1.)
+
+    def test_background(self):
+        """fixed lines set as the background add up with the rest"""
+        keys = 'N b z rest gamma f'.split()
+        cont, absorption, chi2 = self.evaluate()
+        fixed = np.arange(self.lines['N'].shape[0]) % 3 == 0
+        self.ctx.set_background(*[self.lines[k][fixed] for k in keys])
+        lines = [self.lines[k][~fixed] for k in keys]
+        _, b_absorption, b_chi2 = self.ctx.evaluate(*lines, self.x, self.y)
+        self.assertTrue(np.allclose(b_absorption, absorption, rtol=1e-12, atol=0.))
+        self.assertAlmostEqual(b_chi2 / chi2, 1.)
+
+        lines[1] = lines[1] * 1.1
+        expected = self.ctx.evaluate(*lines, self.x, self.y)[-1]
+        self.ctx.set_background(*[self.lines[k][fixed] for k in keys])  # unchanged, nothing to redo
+        self.assertAlmostEqual(self.ctx.evaluate(*lines, self.x, self.y)[-1] / expected, 1.)
+        self.assertIsNone(self.ctx.dirty)
+        self.ctx.set_background(*[np.zeros(0)] * 6)
+        self.assertAlmostEqual(self.evaluate()[-1] / chi2, 1.)
+
+    def test_regions(self):
+        self.assertTrue(np.array_equal(self.ctx.regions, [[100, 3000], [5000, 9000]]))
+        self.ctx.set_regions([10], [20])
+        self.assertTrue(np.array_equal(self.ctx.regions, [[10, 20]]))
+
+
+class SpectrumFunctionTestCase(unittest.TestCase):
+    def setUp(self):
+        self.waves, _, _ = loglin_waves()
+        flux = np.full(self.waves.shape[0], 1e-14)
+        error = np.full(self.waves.shape[0], 1e-16)
+        lines = mock_lines(self.waves)
+        self.x = np.linspace(self.waves[0] - 5., self.waves[-1] + 5., 20)
+        self.y = 1e-14 * np.ones(20)
+        self.lines = [lines[k] for k in 'N b z rest gamma f'.split()]
+        self.args = [self.waves, flux, error, self.x, self.y] + self.lines + \
+                    [self.waves[[100, 5000]], self.waves[[3000, 9000]]]
+        self.ctx = _spectrum.SpectrumContext(self.waves, flux, error)
+
+    def test_spectrum(self):
+        cont, absorption, chi2 = _spectrum.spectrum(*self.args)
+        expected = self.ctx.evaluate(*self.lines, self.x, self.y)
+        self.assertTrue(np.array_equal(cont, expected[0]))
+        self.assertTrue(np.allclose(absorption, expected[1], rtol=1e-12, atol=0.))
+        self.assertGreater(chi2, 0.)
+
+    def test_out(self):
+        expected = _spectrum.spectrum(*self.args)
+        out_cont, out_abs = np.empty(self.waves.shape[0]), np.empty(self.waves.shape[0])
+        cont, absorption, chi2 = _spectrum.spectrum(*self.args, out_cont=out_cont, out_abs=out_abs)
+        self.assertIs(cont, out_cont)
+        self.assertIs(absorption, out_abs)
+        self.assertTrue(np.array_equal(absorption, expected[1]))
+        self.assertEqual(chi2, expected[2])
+        with self.assertRaises(ValueError):
+            _spectrum.spectrum(*self.args, out_cont=np.empty(10))
+        with self.assertRaises(ValueError):
+            _spectrum.spectrum(*self.args, out_abs=np.empty(self.waves.shape[0], dtype=np.float32))
+
+        out_cont[:] = 0.
+        cont, absorption, _ = self.ctx.evaluate(*self.lines, self.x, self.y, out_cont=out_cont, out_abs=out_abs)
+        self.assertIs(cont, out_cont)
+        self.assertTrue(np.array_equal(cont, expected[0]))
+        self.assertIs(self.ctx.convolved(out=out_abs), out_abs)
+
+    def test_workspace(self):
+        expected = _spectrum.spectrum(*self.args)
+        ws = _spectrum.Workspace(self.waves.shape[0])
+        self.assertEqual(ws.size, self.waves.shape[0])
+        for _ in range(3):
+            cont, absorption, chi2 = _spectrum.spectrum(*self.args, workspace=ws)
+            self.assertIs(cont, ws.continuum)
+            self.assertIs(absorption, ws.absorption)
+            self.assertTrue(np.array_equal(absorption, expected[1]))
+            self.assertEqual(chi2, expected[2])
+        with self.assertRaises(ValueError):
+            _spectrum.spectrum(*self.args, workspace=_spectrum.Workspace(10))
+
+        ws = _spectrum.Workspace.__new__(_spectrum.Workspace)
+        for call in [lambda: ws.size, lambda: ws.continuum, lambda: _spectrum.spectrum(*self.args, workspace=ws)]:
+            self.assertRaises(RuntimeError, call)
+
+    def test_grid(self):
+        expected = _spectrum.spectrum(*self.args)
+        grid = _spectrum.WaveGrid(self.waves)
+        self.assertEqual(_spectrum.spectrum(*self.args, grid=grid)[2], expected[2])
+
+        # a grid made for other wavelengths of the same length is not reused
+        shifted = _spectrum.WaveGrid(self.waves + 50.)
+        self.assertEqual(shifted.size, self.waves.shape[0])
+        cont, absorption, chi2 = _spectrum.spectrum(*self.args, grid=shifted)
+        self.assertTrue(np.array_equal(cont, expected[0]))
+        self.assertTrue(np.array_equal(absorption, expected[1]))
+        self.assertEqual(chi2, expected[2])
+
+    def test_many_lines(self):
+        # longer than the line list would fit on the stack
+        many = [np.tile(line, 7000) for line in self.lines]
+        cont, absorption, chi2 = _spectrum.spectrum(*self.args[:5], *many, *self.args[-2:])
+        expected = self.ctx.evaluate(*many, self.x, self.y)
+        self.assertTrue(np.array_equal(cont, expected[0]))
+        self.assertTrue(np.allclose(absorption, expected[1], rtol=1e-12, atol=0.))
+        self.assertTrue(np.all(absorption <= _spectrum.spectrum(*self.args)[1]))
+
+if __name__ == '__main__':
+    unittest.main()
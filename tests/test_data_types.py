@@ -1,3 +1,4 @@
+import pickle
 import unittest
 from copy import deepcopy
 
@@ -75,6 +76,40 @@ class DataTestCase(unittest.TestCase):
         for attr in Absorber.node_attrib:
             self.assertTrue(hasattr(ab, attr))
 
+    def test_lazy_node(self):
+        ab = self.lst[2]
+        node = ab.node
+        self.assertEqual(node.get('N'), '12.906365')
+        self.assertIs(ab.node, node)
+        ab.set_data(N=13.5, NLocked='true')
+        self.assertIsNot(ab.node, node)
+        self.assertEqual(ab.node.get('N'), '13.5')
+        self.assertEqual(ab.node.get('NLocked'), 'true')
+        self.assertIs(ab.NLocked, True)
+        self.assertIs(ab.node, ab.node)
+
+        self.assertNotIn('_node', ab.__getstate__())
+        tmp = deepcopy(ab)
+        self.assertEqual(tmp.node.attrib, ab.node.attrib)
+
+        cont = ContinuumPoint(x=123., y=456., xLocked='true', yLocked='false')
+        self.assertEqual(cont.node.tag, 'ContinuumPoint')
+        self.assertEqual((cont.node.get('x'), cont.node.get('yLocked')), ('123.0', 'false'))
+
+    def test_slots(self):
+        ab = self.lst[2]
+        self.assertFalse(hasattr(ab, '__dict__'))
+        self.assertIs(ab.ionName, Absorber(id='CIV7', ionName='C IV', N=13., b=6., z=1.).ionName)
+        ab.comment = 'anything else still works'
+        self.assertEqual(ab.comment, 'anything else still works')
+        self.assertFalse(hasattr(ab, 'other'))
+
+        copy = pickle.loads(pickle.dumps(ab))
+        self.assertEqual(copy, ab)
+        self.assertEqual(copy.comment, ab.comment)
+        self.assertEqual(copy.node.attrib, ab.node.attrib)
+        self.assertEqual(deepcopy(self.lst[0]), self.lst[0])
+
 
 class ObjListTestCase(unittest.TestCase):
     def setUp(self):
@@ -96,6 +131,35 @@ class ObjListTestCase(unittest.TestCase):
         self.assertNotEqual(self.obj.objlist, other_.objlist)
         self.assertNotEqual(self.obj, other_)
 
+    def test_id_index(self):
+        lst = ObjList.factory(Data.read(test_xml, tag='ContinuumPoint'))
+        self.assertEqual(lst.positions('test_pt'), [1])
+        self.assertIs(lst.get_item('test_pt'), lst[1])
+        lst.append_datum('ContinuumPoint', x='3200.', y='1.', id='new_pt')
+        self.assertEqual(lst.positions('new_pt'), [2])
+
+        lst[0] = ContinuumPoint(x=3100., y=1., id='other_pt')
+        self.assertEqual(lst.positions('null'), [])
+        self.assertEqual(lst.positions('other_pt'), [0])
+        del lst[0]
+        self.assertEqual(lst.positions('new_pt'), [1])
+        lst[0].id = 'renamed'  # set directly, so the index is stale until looked up
+        self.assertEqual(lst.positions('renamed'), [0])
+        self.assertIsNone(lst.get_item('test_pt'))
+
+        lst = lst + ObjList.factory([ContinuumPoint(x=3300., y=1., id='renamed')])
+        self.assertEqual(lst.positions('renamed'), [0, 2])
+        lst.patch_list([ContinuumPoint(x=3400., y=2., id='new_pt')])
+        self.assertEqual(lst.get_item('new_pt').x, 3400.)
+        self.assertEqual(deepcopy(lst).positions('new_pt'), [1])
+
+        # an item renamed directly, then replaced before any lookup
+        lst[0].id = 'renamed_again'
+        lst[0] = ContinuumPoint(x=3100., y=1., id='replaced')
+        self.assertEqual(lst.positions('replaced'), [0])
+        self.assertEqual(lst.positions('renamed_again'), [])
+        self.assertEqual(lst.positions('renamed'), [2])
+
 
 if __name__ == '__main__':
     unittest.main()
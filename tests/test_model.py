@@ -1,10 +1,19 @@
+import os
+import tempfile
 import unittest
 from copy import deepcopy
 
+import numpy as np
+
 from dudeutils.data_types import Data, Region, Absorber, ContinuumPoint, ObjList, AbsorberList, ContinuumPointList, \
     RegionList
+from dudeutils.config import Config
 from dudeutils.model import Model
-from tests.mock_types import test_xml
+from tests.mock_types import test_xml, write_spectrum
+
+# 0.01 Angstrom pixels over the regions of test_xml, and the pixels inside them
+waves = np.linspace(3230., 3250., 2001)
+region_pixels = np.r_[407:733, 901:941, 1791:1809]
 
 
 class ModelTestCase(unittest.TestCase):
@@ -42,6 +51,14 @@ class ModelTestCase(unittest.TestCase):
             self.assertNotEqual(self.mod.absorber_list[i], copy_mod.absorber_list[i], 'abs should be equal')
         self.assertNotEqual(copy_mod, self.mod, "%s \n==\n %s" % (str(copy_mod), str(self.mod)))
 
+    def test_build_xml(self):
+        ab = self.mod.absorber_list[0]
+        nodes = [item.node for item in self.mod.cont_point_list]
+        ab.N = 14.
+        root = self.mod.build_xml(raw_data='spec.fits')
+        self.assertEqual(root.find('CompositeSpectrum').find('Absorber').get('N'), '14.0')
+        self.assertEqual([item.node for item in self.mod.cont_point_list], nodes)  # unchanged, so reused
+
     def test_lst_decorator(self):
         self.assertEqual(len(self.mod.absorber_list), 1)
         self.assertEqual(len(self.mod.cont_point_list), 2)
@@ -60,6 +77,14 @@ class ModelTestCase(unittest.TestCase):
         for i, val in enumerate(lst):
             self.assertEqual(i, Model._get_item(getattr(val, 'id'), lst))
 
+    def test_lookup_by_id(self):
+        self.mod.set_val('test_pt', 'ContinuumPoint', y=2.)
+        self.assertEqual(self.mod.get_datum('test_pt', 'ContinuumPoint', 'y'), 2.)
+        self.assertEqual(self.mod.get_datum('null', 'ContinuumPoint', 'y'), self.mod.cont_point_list[0].y)
+        self.assertEqual(self.mod.get_cont_index('test_pt'), 1)
+        with self.assertRaises(Exception):
+            self.mod.get_datum('missing', 'Absorber')
+
     def test_split_lst(self):
         self.assertIsInstance(test_xml, str)
         lst = Data.read(test_xml)
@@ -90,6 +115,136 @@ class ModelTestCase(unittest.TestCase):
         self.assertEqual(new_abs, self.mod.absorber_list)
         self.assertEqual(self.mod.absorber_list[0].z, -1.)
 
+    def test_line_table(self):
+        table = self.mod.line_table
+        ab = self.mod.absorber_list[0]
+        lines = ab.get_lines()
+        self.assertEqual(len(table), len(lines))
+        self.assertTrue(np.array_equal(table.rest, [line.wave for line in lines]))
+        self.assertTrue(np.all(table.absorber == 0))
+        self.assertTrue(np.allclose(table.equiv_width(),
+                                    [line.get_equiv_width(ab.N, ab.z, pixels=True) for line in lines]))
+
+        self.mod.set_val(ab, N=ab.N + 1.)
+        self.assertIs(self.mod.line_table, table)
+        self.assertTrue(np.all(table.N == ab.N))
+        ab.z = 0.5  # direct edits are picked up too
+        self.assertTrue(np.all(self.mod.line_table.z == 0.5))
+        self.assertEqual(table.update(self.mod.absorber_list), [])
+
+        self.mod.set_absorbers(deepcopy(self.mod.absorber_list))
+        self.assertIsNone(table.update(self.mod.absorber_list))
+        self.assertIs(table.absorbers[0], self.mod.absorber_list[0])
+
+    def test_static_lines(self):
+        ab = self.mod.absorber_list[0]
+        self.mod.toggle_locks({ab.id: ['N', 'b', 'z']}, True)
+        static = self.mod.static_lines()
+        self.assertTrue(np.all(static[self.mod.line_table.absorber == 0]))
+        self.assertIs(self.mod.static_lines(), static)
+
+        self.mod.toggle_locks({ab.id: ['b']}, False)
+        self.assertFalse(np.any(self.mod.static_lines()[self.mod.line_table.absorber == 0]))
+        self.mod.toggle_locks({ab.id: ['b']}, True)
+        self.mod.tied.add(ab.id)
+        self.mod.lock_all_cont()
+        self.assertFalse(np.any(self.mod.static_lines()[self.mod.line_table.absorber == 0]))
+        self.mod.tied.discard(ab.id)
+        self.assertTrue(np.all(self.mod.static_lines()[self.mod.line_table.absorber == 0]))
+
+        # locks written directly, not through set_val
+        ab.zLocked = False
+        self.assertFalse(np.any(self.mod.static_lines()[self.mod.line_table.absorber == 0]))
+
+    def test_update_dof(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self.mod.flux = self.mod.error = write_spectrum(os.path.join(tmp, 'spec.txt'), waves)
+            ab = self.mod.absorber_list[0]
+            ab.z = 3236. / 1548.2 - 1.  # C IV 1548 in the second region
+            self.mod.update_dof()
+            self.assertEqual(self.mod.params, 3)
+            self.assertEqual(self.mod.pixels, len(region_pixels))
+
+            # nothing changed, so nothing is recounted
+            self.mod.params = -1
+            self.mod.update_dof()
+            self.assertEqual(self.mod.params, -1)
+
+            ab.NLocked = True
+            self.mod.update_dof()
+            self.assertEqual(self.mod.params, 2)
+            ab.z = 3243. / 1548.2 - 1.  # both lines out of the regions
+            self.mod.update_dof()
+            self.assertEqual(self.mod.params, 0)
+            self.mod.region_list[0].end = 3249.
+            self.mod.update_dof()
+            self.assertEqual(self.mod.params, 2)
+            self.assertEqual(self.mod.pixels, 1900 - 407)  # the first region now spans the others
+
+        obs = np.linspace(3230., 3250., 500)
+        self.assertTrue(np.array_equal(self.mod.region_list.contains(obs),
+                                       [self.mod.region_list.in_regions(val) for val in obs]))
+
+    def test_param_vector(self):
+        abs_, pts = self.mod.absorber_list, self.mod.cont_point_list
+        vec = self.mod.param_vector()
+        names = self.mod.param_names()
+        self.assertEqual(vec.shape, (3 * len(abs_) + 2 * len(pts),))
+        self.assertEqual(len(names), vec.shape[0])
+        index = self.mod.param_index()
+        self.assertEqual(vec[index[abs_[0].id + '_b']], abs_[0].b)
+        self.assertEqual(vec[3 * len(abs_) + 1], pts[0].y)
+        self.assertTrue(np.array_equal(self.mod.param_locks()[:3], [abs_[0].NLocked, abs_[0].bLocked, abs_[0].zLocked]))
+
+        table = self.mod.line_table
+        revision = table.revision
+        vec[0] += 1.
+        vec[-2] += 2.
+        self.assertTrue(np.array_equal(self.mod.set_param_vector(vec), [0, vec.shape[0] - 2]))
+        self.assertEqual(abs_[0].N, vec[0])
+        self.assertTrue(np.all(self.mod.line_table.N[table.absorber == 0] == vec[0]))
+        self.assertNotEqual(table.revision, revision)
+        self.assertEqual(pts[-1].x, vec[-2])
+        self.assertEqual(len(self.mod.set_param_vector([vec[0]], [0])), 0)
+        with self.assertRaises(ValueError):
+            self.mod.set_param_vector(vec[1:])
+
+        lo, hi = self.mod.param_bounds({'N': 0.5, 'y': 0.1})
+        self.assertTrue(np.allclose([lo[0], hi[0]], [vec[0] - 0.5, vec[0] + 0.5]))
+        self.assertTrue(np.isinf(hi[1]))
+        self.assertTrue(np.allclose(hi[3 * len(abs_) + 1], 1.1 * vec[3 * len(abs_) + 1]))
+        Config.ab_cfg = {abs_[0].id: {'b': [1., 2.]}}
+        try:
+            lo, hi = self.mod.param_bounds()
+        finally:
+            Config.ab_cfg = {}
+        self.assertEqual((lo[1], hi[1]), (1., 2.))
+
+    def test_region_index(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            self.mod.flux = self.mod.error = write_spectrum(os.path.join(tmp, 'spec.txt'), waves)
+
+            region = self.mod.region_index()
+            self.assertTrue(np.array_equal(region.indices, region_pixels))
+            # the two overlapping regions merge into one run
+            self.assertTrue(np.array_equal(region.starts, [407, 901, 1791]))
+            self.assertTrue(np.array_equal(region.ends, [733, 941, 1809]))
+            self.assertFalse(region.indices.flags.writeable)
+
+            self.mod.update_dof()
+            self.assertIs(self.mod.indices, region.indices)
+            self.assertIs(self.mod.region_index(), region)  # served from the cache
+
+            self.mod.region_list[0].end += 1.
+            self.assertIsNot(self.mod.region_index(), region)
+            self.mod.region_list[0].end -= 1.
+            self.assertIs(self.mod.region_index(), region)
+
+            # a rewritten spectrum is read again
+            np.savetxt(self.mod.flux, np.column_stack([waves + 1., np.ones_like(waves), 0.1 * np.ones_like(waves)]))
+            os.utime(self.mod.flux, ns=(0, 0))
+            self.assertTrue(np.array_equal(self.mod.get_waves(), waves + 1.))
+
 
 if __name__ == '__main__':
     unittest.main()
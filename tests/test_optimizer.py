@@ -0,0 +1,83 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+
+from dudeutils.config import Config
+from dudeutils.model import Model
+from dudeutils.optimizer import optimize
+from dudeutils.spec_parser import Spectrum, TextSpectrum
+from tests.mock_types import test_xml, write_spectrum
+
+waves = np.linspace(3230., 3250., 2001)
+z = 3236. / 1548.2 - 1.  # C IV 1548 in the second region of test_xml
+
+
+class OptimizerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        # the model of test_xml on a flat continuum, N=13.5 and b=15 at z
+        self.model = Model(xmlfile=test_xml)
+        ab = self.model.absorber_list[0]
+        ab.N, ab.b, ab.z = 13.5, 15., z
+        for x in [3200., 3280.]:
+            self.model.cont_point_list.append_datum('ContinuumPoint', x=str(x), y='1.0', id='pt%d' % x)
+        for pt, x in zip(self.model.cont_point_list, [3220., 3260.]):
+            pt.x, pt.y = x, 1.
+
+        # and a noiseless spectrum of it
+        self.model.flux = self.model.error = write_spectrum(os.path.join(self.tmp.name, 'blank.txt'),
+                                                            waves, np.ones_like(waves))
+        absorption = Spectrum.fit_absorption(TextSpectrum(self.model.flux), self.model, full=True)[0]
+        self.model.flux = self.model.error = write_spectrum(os.path.join(self.tmp.name, 'spec.txt'),
+                                                            waves, absorption)
+        self.spec = TextSpectrum(self.model.flux)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_optimize(self):
+        ab = self.model.absorber_list[0]
+        ab.N, ab.b = 13.2, 11.
+        unlocked, popt, pcov = optimize(self.spec, self.model)
+        self.assertEqual([item.name for item in unlocked], ['N', 'b', 'z'])
+        self.assertAlmostEqual(ab.N, 13.5, places=4)
+        self.assertAlmostEqual(ab.b, 15., places=3)
+        self.assertAlmostEqual(ab.z, z, places=8)
+        self.assertTrue(np.all(np.isfinite(np.diag(pcov))))
+
+    def test_jacobian(self):
+        """the jacobian optimize fits with agrees with finite differences of fit_absorption"""
+        for voigt in ['table', 'humlicek', 'fast']:  # the default first
+            with self.subTest(voigt=voigt):
+                try:
+                    Config.voigt = voigt
+                    self.check_jacobian()
+                finally:
+                    Config.voigt = 'table'
+
+    def check_jacobian(self):
+        model, table = self.model, self.model.line_table
+        region = model.region_index()
+        context = Spectrum.get_context(self.spec, region.indices, pairs=(region.starts, region.ends),
+                                       lsf=(3.4, 2.14), full=False, background=[np.zeros(0)] * 6)
+        mask = table.mask(self.spec.waves, min_width=None)
+        points = sorted(model.cont_point_list, key=lambda pt: pt.x)
+        x, y = np.array([float(pt.x) for pt in points]), np.array([float(pt.y) for pt in points])
+        columns = np.tile([0, 1, 2], (mask.sum(), 1))
+        pixels, flux, jac = context.jacobian(*table.arrays(mask), x, y, columns, np.full(len(points), -1))
+
+        ab = model.absorber_list[0]
+        for col, attr, step in [(0, 'N', 1e-6), (1, 'b', 1e-5), (2, 'z', 1e-9)]:
+            val = float(getattr(ab, attr))
+            setattr(ab, attr, val + step)
+            up = Spectrum.fit_absorption(self.spec, model, lsf=(3.4, 2.14))[0][pixels]
+            setattr(ab, attr, val - step)
+            down = Spectrum.fit_absorption(self.spec, model, lsf=(3.4, 2.14))[0][pixels]
+            setattr(ab, attr, val)
+            expected = (up - down) / (2. * step)
+            self.assertLess(np.fabs(jac[:, col] - expected).max(), 1e-3 * np.fabs(expected).max(), attr)
+
+if __name__ == '__main__':
+    unittest.main()
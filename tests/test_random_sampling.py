@@ -1,6 +1,10 @@
+import os
+import tempfile
 import unittest
+import unittest.mock
 
-from dudeutils.random_sampling import get_region_objects
+import dudeutils.timing as timing
+from dudeutils.random_sampling import RandomSample, get_region_objects
 from tests.mock_types import test_xml, MockCont, MockSpec, MockAb, MockRegion
 
 ab_cfg = {"D": {"N": [12.82, 12.88], "b": [13, 14]}, "H": {"N": [1, 2]}}
@@ -28,6 +32,22 @@ class TestRandomSample(unittest.TestCase):
         self.assertNotEqual(id(ablst), id(self.model.absorber_list))
         self.assertNotEqual(id(cntlst), id(self.model.cont_point_list))
 
+    @unittest.mock.patch('dudeutils.random_sampling.simulated_annealing')
+    def test_call(self, mock_anneal):
+        # no model_outputs, with timing on or off
+        RandomSample(self.model.spec, self.model, None, {})()
+        with timing.enabled():
+            RandomSample(self.model.spec, self.model, None, {})()
+        self.assertEqual(mock_anneal.call_count, 2)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            kwargs = {'model_outputs': os.path.join(tmp, 'out.csv')}
+            RandomSample(self.model.spec, self.model, None, kwargs)()
+            self.assertEqual(os.listdir(tmp), [])
+            with timing.enabled():
+                RandomSample(self.model.spec, self.model, None, kwargs)()
+            self.assertEqual(os.listdir(tmp), ['timing-%d.json' % os.getpid()])
+
         # def test_assemble(self):
         #     assemble_jobs(self.model, ab_cfg, cont_cfg, **glob)
 
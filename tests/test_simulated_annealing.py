@@ -1,3 +1,4 @@
+import copy
 import unittest
 import unittest.mock
 
@@ -8,16 +9,6 @@ from tests.mock_types import MockAb, MockSpec
 
 
 class SimAnnealingTestCase(unittest.TestCase):
-    def test_attr_vary(self):
-        ab = MockAb(N=12, b=13, z=3, NLocked=False, bLocked=False, zLocked=True)
-        old_z = ab.z
-        attr_vary(ab, 'z', [5., 7.], 1.2)
-        self.assertEqual(old_z, ab.z)
-
-        old_N = ab.N
-        attr_vary(ab, 'N', [5., 7.], 3.1)
-        self.assertNotEqual(old_N, ab.N)
-
     def test_ab_in_regions(self):
         ab = Absorber(id='', N=15.1, b=45.3, z=0., ionName='H I')
         regions = ObjList.factory([Region(start=1000., end=1400.)])
@@ -97,10 +88,15 @@ class SimAnnealingTestCase(unittest.TestCase):
                                         ContinuumPoint(x=1001, y=1103)],
                     RegionList=ObjList.factory([Region(start=1000., end=6000.)]))
 
-        mock_ft_abs.return_value = np.array([]), np.array([]), 123.
+        tied = []
+        mock_ft_abs.side_effect = lambda spec, model, **kwargs: (tied.append(set(model.tied)) or
+                                                                 (np.array([]), np.array([]), 123.))
         annealr = Anneal(getattr(mod, 'spec'), mod, tie=('H_z', 'D_z'))
         annealr.randomize_parameters()
         self.assertEqual(mod.absorber_list[0].z, mod.absorber_list[1].z)
+        # the tie only holds while the annealer computes chi2
+        self.assertEqual(tied, [{'H', 'D'}])
+        self.assertEqual(mod.tied, set())
 
         annealr.model.absorber_list[0].zLocked = True
         annealr.model.absorber_list[0].z = 1.23
@@ -109,6 +105,40 @@ class SimAnnealingTestCase(unittest.TestCase):
         annealr.randomize_parameters()
         self.assertEqual(mod.absorber_list[0].z, mod.absorber_list[1].z)
 
+    @unittest.mock.patch('dudeutils.spec_parser.Spectrum.fit_absorption')
+    def test_undo(self, mock_ft_abs):
+        mod = Model(spec=MockSpec(), pixels=75, params=8,
+                    AbsorberList=[Absorber(id='id%d' % i, ionName='H I',
+                                           N=12.1, b=45.3, z=2.34 + 0.01 * i,
+                                           NLocked=False, bLocked=False, zLocked=False) for i in range(5)],
+                    ContinuumPointList=[ContinuumPoint(x=1001, y=1003), ContinuumPoint(x=1010, y=1013),
+                                        ContinuumPoint(x=1001, y=1103)],
+                    RegionList=ObjList.factory([Region(start=1000., end=6000.)]))
+        mock_ft_abs.return_value = np.array([]), np.array([]), 123.
+        annealr = Anneal(getattr(mod, 'spec'), mod)
+        absorbers = list(mod.absorber_list)
+        start = mod.param_vector()
+        self.assertEqual(start.shape, (3 * 5 + 2 * 3,))
+        for _ in range(3):
+            annealr.randomize_parameters()
+        self.assertFalse(np.allclose(mod.param_vector(), start))
+
+        # the best model is only built when asked for, and isn't the model
+        best = annealr.best_model
+        self.assertIs(annealr.best_model, best)
+        self.assertEqual([ab.N for ab in best.absorber_list], [12.1] * 5)
+
+        annealr.model.chi2 = 99.
+        annealr.reset_model()
+        self.assertTrue(np.array_equal(mod.param_vector(), start))
+        self.assertEqual(annealr.model.chi2, 123.)
+        self.assertTrue(all(a is b for a, b in zip(mod.absorber_list, absorbers)))
+
+        annealr.randomize_parameters()
+        moved = mod.param_vector()
+        annealr.reset_best()
+        self.assertIsNot(annealr.best_model, best)
+        self.assertEqual([ab.b for ab in annealr.best_model.absorber_list], list(moved[1:15:3]))
 
     def test_deepcopy(self):
         a = [MockAb(id='test_id%d' % i) for i in range(7)]
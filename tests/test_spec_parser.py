@@ -1,7 +1,32 @@
+import os
+import tempfile
+import threading
 import unittest
 
+import numpy as np
+
+import _spectrum
 from dudeutils.model import Model
-from tests.mock_types import test_xml
+from dudeutils.config import Config
+from dudeutils.spec_parser import CompositeSpectrum, Spectrum, TextSpectrum, lsf_registry
+from tests.mock_types import test_xml, MockSpec, write_spectrum
+
+# 0.01 Angstrom pixels over the regions of test_xml, and the pixels inside them
+waves = np.linspace(3230., 3250., 2001)
+region_pixels = np.r_[407:733, 901:941, 1791:1809]
+
+
+def civ_model(path):
+    """the model of test_xml fit to the spectrum in path, its C IV line in the second region"""
+    model = Model(xmlfile=test_xml)
+    model.flux = model.error = path
+    model.absorber_list[0].z = 3236. / 1548.2 - 1.
+    # a flat continuum at 1, the spline needs four points
+    for x in [3200., 3280.]:
+        model.cont_point_list.append_datum('ContinuumPoint', x=str(x), y='1.0', id='pt%d' % x)
+    for pt, x in zip(model.cont_point_list, [3220., 3260.]):
+        pt.x, pt.y = x, 1.
+    return model
 
 
 class SpecParserTestCase(unittest.TestCase):
@@ -9,5 +34,147 @@ class SpecParserTestCase(unittest.TestCase):
         model=Model(xmlfile=test_xml)
         pass
 
+    def test_index_pairs(self):
+        starts, ends = Spectrum.index_pairs([3, 4, 5, 9, 10, 20])
+        self.assertEqual(list(starts), [3, 9, 20])
+        self.assertEqual(list(ends), [6, 11, 21])
+        starts, ends = Spectrum.index_pairs([])
+        self.assertEqual(len(starts), 0)
+
+    def test_context_reused(self):
+        spec = MockSpec()
+        ctx = Spectrum.get_context(spec, [1, 2, 3])
+        self.assertIs(ctx, Spectrum.get_context(spec, [1, 2, 3]))
+        self.assertTrue(np.array_equal(ctx.regions, [[1, 4]]))
+
+    def test_context_voigt(self):
+        spec = MockSpec()
+        try:
+            Config.voigt = 'humlicek'
+            Spectrum.get_context(spec)
+            self.assertEqual(_spectrum.get_voigt(), 'humlicek')
+        finally:
+            Config.voigt = 'table'
+            Spectrum.get_context(spec)
+        self.assertEqual(_spectrum.get_voigt(), 'table')
+
+    def test_context_per_thread(self):
+        spec = MockSpec()
+        ctx = Spectrum.get_context(spec)
+        other = []
+        thread = threading.Thread(target=lambda: other.append(Spectrum.get_context(spec)))
+        thread.start()
+        thread.join()
+        self.assertIsNot(ctx, other[0])
+        self.assertIs(ctx.grid, other[0].grid)
+
+    def test_lsf_registry(self):
+        lsf = lsf_registry.get()
+        self.assertIs(lsf, lsf_registry.get(None, Config.vsig, Config.vdisp))
+        kernel, offset = lsf.kernels[0]
+        self.assertEqual(kernel.shape[0], 2 * offset + 1)
+        self.assertTrue(np.allclose(kernel, kernel[::-1]))
+        self.assertAlmostEqual(kernel.sum(), 1.)
+
+        # a centered kernel leaves a symmetric line where it was
+        line = np.exp(-0.5 * (np.arange(101) - 50.) ** 2 / 4.)
+        self.assertEqual(np.argmax(Spectrum.convolve(line)), 50)
+
+        # piecewise resolution agrees with the c extension
+        spec = MockSpec()
+        split = spec.waves[spec.waves.shape[0] // 2]
+        lsf = lsf_registry.get([(spec.waves[0], 3.4, 2.14), (split, 7., 2.14)])
+        self.assertIs(lsf.kernels[0], lsf_registry.kernel(3.4, 2.14))
+        ctx = Spectrum.get_context(spec, lsf=lsf)
+        x = np.linspace(3000., 5000., 200)
+        _, absorption, _ = ctx.evaluate(*[np.zeros(0)] * 6, x, np.random.rand(200))
+        self.assertTrue(np.allclose(ctx.convolved(), lsf.convolve(absorption, spec.waves)))
+
+    def test_fit_absorption_many(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = write_spectrum(os.path.join(tmp, 'spec.txt'), waves)
+            spec = TextSpectrum(path)
+            models = []
+            for i in range(7):
+                model = civ_model(path)
+                model.absorber_list[0].z += 1e-5 * i
+                model.absorber_list[0].N = 12.5 + 0.1 * i
+                models.append(model)
+            expected = [Spectrum.fit_absorption(spec, model, arrays=False)[-1] for model in models]
+            self.assertEqual(len(set(expected)), 7)
+
+            for kwargs in [{}, {'workers': 2, 'chunk_size': 3}, {'workers': 2, 'chunk_size': 2, 'processes': True}]:
+                scores = Spectrum.fit_absorption_many(spec, models, **kwargs)
+                self.assertEqual(scores.shape, (7, 3))
+                self.assertTrue(np.allclose(scores[:, 0], expected, rtol=1e-10, atol=0.))
+                self.assertTrue(np.array_equal(scores[:, 1], [model.pixels for model in models]))
+                self.assertTrue(np.array_equal(scores[:, 2], [model.dof for model in models]))
+
+            Spectrum.fit_absorption_many(spec, models, update=True)
+            self.assertTrue(np.allclose([model.chi2 for model in models], expected, rtol=1e-10, atol=0.))
+
+    def test_fit_absorption_full(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            model = civ_model(write_spectrum(os.path.join(tmp, 'spec.txt'), waves))
+            spec = TextSpectrum(model.flux)
+
+            absorption, cont, chi2 = Spectrum.fit_absorption(spec, model)
+            self.assertTrue(np.array_equal(np.flatnonzero(absorption), region_pixels))
+            self.assertEqual(model.pixels, len(region_pixels))
+            full_absorption, full_cont, full_chi2 = Spectrum.fit_absorption(spec, model, full=True)
+            self.assertEqual(full_absorption.shape, waves.shape)
+            self.assertEqual(full_cont.shape, waves.shape)
+            self.assertTrue(np.allclose(full_cont, 1.))
+            self.assertTrue(np.all(full_absorption > 0.))
+            self.assertAlmostEqual(full_chi2 / chi2, 1.)
+            # the regions themselves agree either way
+            self.assertTrue(np.allclose(full_absorption[region_pixels], absorption[region_pixels]))
+            # the doublet sits at 3235.99 and 3241.37 Angstrom, 1548 the stronger
+            inner = full_absorption[100:-100]
+            self.assertEqual(np.argmin(inner) + 100, 599)
+            self.assertEqual(np.argmin(inner[1000:]) + 1100, 1137)
+            self.assertLess(full_absorption[599], full_absorption[1137])
+            self.assertTrue(np.allclose(inner[1300:1600], 1.))  # nothing from 3244 to 3247 Angstrom
+
+    def test_composite_spectrum(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            paths = [os.path.join(tmp, name) for name in ['blue.txt', 'red.txt']]
+            model = civ_model(write_spectrum(paths[0], waves))
+            write_spectrum(paths[1], waves)
+
+            composite = CompositeSpectrum(TextSpectrum(paths[0]))
+            other = model.copy()
+            other.flux = other.error = paths[1]
+            for pt in other.cont_point_list:
+                pt.y = 0.9
+            composite.add(TextSpectrum(paths[1]), other.cont_point_list, lsf=(7., 2.14))
+
+            absorption, cont, chi2 = Spectrum.fit_absorption(composite, model)
+            self.assertEqual(len(absorption), 2)
+            expected = Spectrum.fit_absorption(TextSpectrum(paths[0]), model.copy(), arrays=False)[-1] + \
+                Spectrum.fit_absorption(TextSpectrum(paths[1]), other, lsf=(7., 2.14), arrays=False)[-1]
+            self.assertAlmostEqual(chi2 / expected, 1.)
+            self.assertEqual(model.pixels, 2 * len(region_pixels))
+            self.assertEqual(model.params, 3)
+
+            # absorbers are shared, even when the list is replaced
+            model.absorber_list[0].N += 0.5
+            model.absorber_list = [item for item in model.absorber_list]
+            self.assertNotAlmostEqual(Spectrum.fit_absorption(composite, model, arrays=False)[-1], chi2)
+
+            # and so are parameters written through set_param_vector, as Anneal does
+            vec = model.param_vector()
+            vec[0] += 0.5
+            model.set_param_vector(vec)
+            fresh = CompositeSpectrum(TextSpectrum(paths[0]))
+            fresh.add(TextSpectrum(paths[1]), other.cont_point_list, lsf=(7., 2.14))
+            self.assertAlmostEqual(Spectrum.fit_absorption(composite, model, arrays=False)[-1] /
+                                   Spectrum.fit_absorption(fresh, model.copy(), arrays=False)[-1], 1.)
+            fresh.close()
+            composite.close()
+
+            with self.assertRaises(ValueError):
+                composite.add(MockSpec(source=None), [])
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,100 @@
+import os
+import pickle
+import tempfile
+import unittest
+
+import astropy.io.fits as fits
+import numpy as np
+
+from dudeutils.spec_parser import TextSpectrum, FitsSpectrum
+from dudeutils.spectrum_store import SpectrumStore, sidecar_path, store
+
+
+class SpectrumStoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.waves = np.linspace(3230., 3250., 201)
+        self.cols = np.vstack([np.zeros_like(self.waves), self.waves] + [np.random.rand(201) for _ in range(4)])
+        self.dump = self.path('spec.dat')
+        np.savetxt(self.dump, self.cols.T)
+
+    def tearDown(self):
+        store.clear()
+        self.tmp.cleanup()
+
+    def path(self, name):
+        return os.path.join(self.tmp.name, name)
+
+    def write_fits(self, name, data):
+        hdu = fits.PrimaryHDU(data)
+        hdu.header['CTYPE1'] = 'LINEAR'
+        hdu.header['DC-FLAG'] = 1
+        hdu.header['CRVAL1'] = np.log10(3230.)
+        hdu.header['CDELT1'] = 1.0E-5
+        hdu.header['CRPIX1'] = 1
+        hdu.writeto(self.path(name))
+        return self.path(name)
+
+    def test_text(self):
+        st = SpectrumStore()
+        cols = st.text(self.dump)
+        self.assertTrue(np.allclose(cols, self.cols))
+        self.assertFalse(cols[1].flags.writeable)
+        self.assertTrue(cols[1].flags.c_contiguous)
+        self.assertIs(st.text(self.dump), cols)
+        self.assertIs(st.waves(self.dump), st.waves(self.dump))
+        self.assertTrue(np.allclose(st.waves(self.dump), self.waves))
+        self.assertTrue(os.path.exists(sidecar_path(self.dump)))
+
+        # a new store reads the sidecar
+        other = SpectrumStore()
+        self.assertIsInstance(other.text(self.dump)[0], np.memmap)
+
+        # a rewritten dump is parsed again
+        np.savetxt(self.dump, 2 * self.cols.T)
+        os.utime(self.dump, ns=(0, 0))
+        self.assertTrue(np.allclose(st.text(self.dump), 2 * self.cols))
+
+    def test_waves(self):
+        # the second column holds the waves only when the first is all zero
+        self.assertTrue(np.allclose(store.waves(self.dump), self.waves))
+        first = np.arange(201.)  # a single 0, the rest not
+        np.savetxt(self.path('first.dat'), np.vstack([first, self.waves]).T)
+        self.assertTrue(np.array_equal(store.waves(self.path('first.dat')), first))
+
+    def test_fits(self):
+        path = self.write_fits('spec.fits', np.arange(100, dtype='>f4'))
+        waves, flux, wcs = store.fits(path)
+        self.assertIs(store.fits(path)[1], flux)
+        self.assertFalse(flux.flags.writeable)
+        self.assertTrue(np.allclose(flux, np.arange(100)))
+        self.assertAlmostEqual(waves[0], 3230.)
+        self.assertTrue(wcs.loglin)
+
+    def test_eviction(self):
+        st = SpectrumStore(max_bytes=self.cols.nbytes + 1)
+        cols = st.text(self.dump)
+        other = self.path('other.dat')
+        np.savetxt(other, self.cols.T)
+        st.text(other)
+        self.assertEqual(len(st), 1)
+        self.assertLessEqual(st.nbytes, st.max_bytes)
+        self.assertIsNot(st.text(self.dump), cols)
+
+    def test_pickle(self):
+        spec = TextSpectrum(self.dump)
+        copy = pickle.loads(pickle.dumps(spec))
+        self.assertIs(copy.flux, spec.flux)
+        self.assertEqual(copy.name, self.dump)
+        self.assertLess(len(pickle.dumps(spec)), spec.flux.nbytes)
+
+        flux = self.write_fits('flux.fits', np.arange(100, dtype='>f4'))
+        error = self.write_fits('error.fits', np.ones(100, dtype='>f4'))
+        spec = FitsSpectrum(flux, error=error)
+        copy = pickle.loads(pickle.dumps(spec))
+        self.assertIs(copy.error, spec.error)
+        self.assertIsNotNone(copy.grid)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import os
+import tempfile
+import unittest
+
+import dudeutils.timing as timing
+
+
+class TimingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.was_on = timing.is_enabled()
+        timing.enable(False)
+        timing.reset()
+
+    def tearDown(self):
+        timing.enable(self.was_on)
+        timing.reset()
+
+    def test_off(self):
+        with timing.stage('a'):
+            pass
+        self.assertIs(timing.stage('a'), timing.stage('b'))
+        self.assertEqual(timing.stats(), {})
+
+    def test_enabled(self):
+        @timing.timed('b')
+        def twice(x):
+            return 2 * x
+
+        with timing.enabled():
+            for _ in range(3):
+                with timing.stage('a'):
+                    self.assertEqual(twice(2), 4)
+        twice(1)
+        stats = timing.stats()
+        self.assertFalse(timing.is_enabled())
+        self.assertEqual(stats['a']['calls'], 3)
+        self.assertEqual(stats['b']['calls'], 3)
+        self.assertGreaterEqual(stats['a']['seconds'], stats['b']['seconds'])
+        self.assertIn('a', timing.report())
+
+    def test_collect(self):
+        with tempfile.TemporaryDirectory() as tmp, timing.enabled():
+            with timing.stage('a'):
+                pass
+            timing.worker_dump(tmp)
+            os.rename(os.path.join(tmp, 'timing-%d.json' % os.getpid()), os.path.join(tmp, 'timing-0.json'))
+            timing.worker_dump(tmp)
+            stats = timing.collect(tmp)
+            self.assertEqual(stats['a']['calls'], 3)
+            self.assertEqual(os.listdir(tmp), ['timing.json'])
+
+
+if __name__ == '__main__':
+    unittest.main()